@@ -25,11 +25,23 @@ from gi.repository import (
     GLib,
 )
 
+from .caching import LRUCache, python_subcache
+from .functional import propagate_cancellation, single_flight_closure
+from .responses import format_etag_for_bytes
+
 ApplicationListing = namedtuple('ApplicationListing',
                                 ('app_id display_name short_description '
                                  'icon language eknservices_name '
                                  'search_provider_name'))
 
+ApplicationIcon = namedtuple('ApplicationIcon', 'image_bytes etag')
+
+# Icons are always loaded at this size, see ICON_SIZE in
+# eos-companion-app-integration-helper.c
+APPLICATION_ICON_SIZE = 64
+
+_APPLICATION_ICONS_MAX_SIZE = 4 * 1024 * 1024
+
 
 def maybe_get_app_info_string(app_info, name):
     '''Conditionally get the locale-independent string for name.
@@ -86,3 +98,62 @@ def list_all_applications(cache, cancellable, callback):
         ])
 
     EosCompanionAppService.list_application_infos(cache, cancellable, _callback)
+
+
+def application_icons_cache(cache):
+    '''Get the cache of application icons attached to :cache:.
+
+    The cache maps (icon_name, size) to an ApplicationIcon.
+    '''
+    return python_subcache(cache,
+                           'application-icons',
+                           lambda: LRUCache(max_size=_APPLICATION_ICONS_MAX_SIZE,
+                                            size_func=lambda icon: icon.image_bytes.get_size()))
+
+
+_load_application_icon_once = single_flight_closure()
+
+
+def load_application_icon_async(cache, icon_name, cancellable, callback):
+    '''Load the PNG data for the icon called :icon_name:.
+
+    Loading an icon means looking it up in the icon theme, then decoding
+    and encoding it again as PNG, so icons are kept in the application
+    icons cache. Concurrent requests for the same icon share one load.
+    The callback gets an ApplicationIcon.
+
+    :cancellable: only cancels waiting for the icon, since the load
+    may be shared with other requests.
+    '''
+    def _load(done):
+        '''Load the icon, inserting it into the cache.'''
+        def _on_loaded(_, result):
+            '''Callback for when the icon has been loaded.'''
+            try:
+                image_bytes = EosCompanionAppService.finish_load_application_icon_data_async(result)
+            except GLib.Error as error:
+                done(error, None)
+                return
+
+            icon = ApplicationIcon(image_bytes, format_etag_for_bytes(image_bytes))
+            icons.insert(key, icon)
+            done(None, icon)
+
+        EosCompanionAppService.load_application_icon_data_async(icon_name,
+                                                                cancellable=None,
+                                                                callback=_on_loaded)
+
+    # If the cache is cleared whilst the icon is loading, the icon goes
+    # into the old subcache and is not shared with later requests, since
+    # it may have come from an application which is no longer installed
+    icons = application_icons_cache(cache)
+    key = (icon_name, APPLICATION_ICON_SIZE)
+    icon = icons.lookup(key)
+
+    if icon is not None:
+        GLib.idle_add(lambda: callback(None, icon))
+        return
+
+    _load_application_icon_once((id(icons), key),
+                                _load,
+                                propagate_cancellation(cancellable, callback))
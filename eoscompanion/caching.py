@@ -0,0 +1,152 @@
+# /eoscompanion/caching.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Python-side caches for eoscompanion.
+
+EosCompanionAppService.ManagedCache can only hold values that can be
+marshalled into C, so caches of python objects are kept here instead. They
+are attached to a ManagedCache and dropped along with it when the Flatpak
+installation state changes (see configure_drop_cache_on_changes).
+'''
+
+from collections import OrderedDict
+
+import weakref
+
+from gi.repository import GLib
+
+
+# pylint: disable=too-many-instance-attributes
+class LRUCache(object):
+    '''A least-recently-used cache with an optional size budget and expiry.
+
+    :max_entries: is the maximum number of entries to keep.
+    :max_size: is the maximum total size of all entries, as measured by
+               :size_func:, which is called on each value.
+    :ttl: is the number of seconds after which an entry expires, or
+          None if entries should never expire.
+
+    The hits and misses counters can be used to examine how effective
+    the cache is.
+    '''
+
+    def __init__(self, max_entries=None, max_size=None, size_func=len, ttl=None):
+        '''Initialize an empty cache.'''
+        super().__init__()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+        self._max_size = max_size
+        self._size_func = size_func
+        self._ttl_usec = ttl * GLib.USEC_PER_SEC if ttl is not None else None
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        '''Number of entries in the cache.'''
+        return len(self._entries)
+
+    @property
+    def size(self):
+        '''Total size of all entries, as measured by size_func.'''
+        return self._size
+
+    def _remove(self, key):
+        '''Remove the entry for :key:.'''
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def lookup(self, key):
+        '''Look up :key:, returning None if it is not in the cache.'''
+        entry = self._entries.get(key, None)
+
+        if entry is not None:
+            value, _, expiry = entry
+
+            if expiry is None or expiry > GLib.get_monotonic_time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+
+            self._remove(key)
+
+        self.misses += 1
+        return None
+
+    def insert(self, key, value):
+        '''Insert :value: for :key:, evicting older entries if necessary.
+
+        Values which are larger than the size budget on their own
+        are not inserted at all.
+        '''
+        size = self._size_func(value) if self._max_size is not None else 0
+
+        if key in self._entries:
+            self._remove(key)
+
+        if self._max_size is not None and size > self._max_size:
+            return
+
+        expiry = (GLib.get_monotonic_time() + self._ttl_usec
+                  if self._ttl_usec is not None else None)
+        self._entries[key] = (value, size, expiry)
+        self._size += size
+
+        while ((self._max_entries is not None and
+                len(self._entries) > self._max_entries) or
+               (self._max_size is not None and self._size > self._max_size)):
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        '''Drop all entries from the cache.'''
+        self._entries.clear()
+        self._size = 0
+
+
+_PYTHON_SUBCACHES = weakref.WeakKeyDictionary()
+
+
+def python_subcache(cache, name, factory):
+    '''Get the python-side subcache called :name: attached to :cache:.
+
+    If there is no such subcache yet, it is created by calling :factory:
+    with no arguments. The subcache must have a clear() method.
+
+    Subcaches are replaced when they are cleared, so callers should not
+    keep hold of a subcache beyond a single request. An asynchronous
+    operation which gets the subcache when it starts and inserts into
+    it when it finishes never puts a result which was computed before
+    the cache was cleared into the new subcache.
+    '''
+    subcaches = _PYTHON_SUBCACHES.setdefault(cache, {})
+
+    try:
+        return subcaches[name]
+    except KeyError:
+        subcache = subcaches[name] = factory()
+        return subcache
+
+
+def clear_python_subcaches(cache):
+    '''Clear all python-side subcaches attached to :cache:.
+
+    The cleared subcaches are detached from :cache:, and new ones are
+    created the next time they are needed.
+    '''
+    for subcache in _PYTHON_SUBCACHES.pop(cache, {}).values():
+        subcache.clear()
@@ -0,0 +1,184 @@
+# /eoscompanion/compression.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Compression of response bodies.
+
+Text responses are compressed with gzip if the client says that it
+accepts it in the Accept-Encoding header. Whether a response is
+compressed only depends on the request and the content type, so that
+the ETag for a response can be worked out before its body.
+'''
+
+from gi.repository import (
+    EosCompanionAppService,
+    Gio,
+    GLib
+)
+
+from .caching import LRUCache, python_subcache
+from .ekn_data import chunk_size_for_content_size
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+    'text/css',
+    'text/html',
+    'text/plain'
+)
+
+_COMPRESSED_BODIES_MAX_SIZE = 8 * 1024 * 1024
+
+
+def accepts_gzip(request_headers):
+    '''Check whether the Accept-Encoding request header allows gzip.'''
+    accept_encoding = request_headers.get_list('Accept-Encoding')
+
+    if accept_encoding is None:
+        return False
+
+    for coding in accept_encoding.split(','):
+        name, _, parameters = coding.partition(';')
+
+        if name.strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+
+        # A quality of zero means that the coding is not acceptable
+        quality = parameters.strip()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+
+        return True
+
+    return False
+
+
+def should_compress(request_headers, content_type):
+    '''Check whether a response with :content_type: should be compressed.
+
+    Range requests are never compressed, since the ranges would then
+    refer to the compressed body, which is not what clients expect.
+    '''
+    return (content_type in COMPRESSIBLE_CONTENT_TYPES and
+            request_headers.get_one('Range') is None and
+            accepts_gzip(request_headers))
+
+
+def gzip_etag(etag):
+    '''Get the ETag for the compressed version of the response with :etag:.'''
+    return '{}-gzip"'.format(etag[:-1])
+
+
+def negotiated_etag(request_headers, content_type, etag):
+    '''Get the ETag for the response with :etag: as it will be sent.
+
+    Compressed and uncompressed responses are different representations,
+    so they need different strong ETags.
+    '''
+    if etag is not None and should_compress(request_headers, content_type):
+        return gzip_etag(etag)
+
+    return etag
+
+
+def set_compression_headers(msg, content_type, compressed):
+    '''Set the headers that describe how a response with :content_type: is encoded.
+
+    Responses that could have been compressed vary on Accept-Encoding,
+    even when they are not compressed, so that caches do not serve
+    a compressed response to a client that does not accept it.
+    '''
+    response_headers = msg.get_property('response-headers')
+
+    if content_type in COMPRESSIBLE_CONTENT_TYPES:
+        response_headers.append('Vary', 'Accept-Encoding')
+
+    if compressed:
+        response_headers.replace('Content-Encoding', 'gzip')
+
+
+def compress_bytes_async(content_bytes, cancellable, callback):
+    '''Compress :content_bytes: with gzip in a worker thread.
+
+    The callback gets the compressed GLib.Bytes.
+    '''
+    def _on_compressed(_, result):
+        '''Marshal the GAsyncReady callback into an (error, data) callback.'''
+        try:
+            compressed_bytes = EosCompanionAppService.finish_load_all_in_stream_to_bytes(result)
+        except GLib.Error as error:
+            callback(error, None)
+            return
+
+        callback(None, compressed_bytes)
+
+    # Reading the converter stream is what does the compression, and
+    # load_all_in_stream_to_bytes reads it in a worker thread.
+    converter_stream = Gio.ConverterInputStream.new(
+        Gio.MemoryInputStream.new_from_bytes(content_bytes),
+        Gio.ZlibCompressor.new(Gio.ZlibCompressorFormat.GZIP, -1)
+    )
+    EosCompanionAppService.load_all_in_stream_to_bytes(converter_stream,
+                                                       chunk_size=chunk_size_for_content_size(
+                                                           content_bytes.get_size() // 4
+                                                       ),
+                                                       cancellable=cancellable,
+                                                       callback=_on_compressed)
+
+
+def compressed_bodies_cache(cache):
+    '''Get the cache of compressed response bodies attached to :cache:.
+
+    The cache maps a key identifying an uncompressed body to the
+    compressed GLib.Bytes.
+    '''
+    return python_subcache(cache,
+                           'compressed-bodies',
+                           lambda: LRUCache(max_size=_COMPRESSED_BODIES_MAX_SIZE,
+                                            size_func=lambda b: b.get_size()))
+
+
+def compress_bytes_cached_async(cache, key, content_bytes, cancellable, callback):
+    '''Compress :content_bytes:, using the compressed bodies cache.
+
+    :key: must identify :content_bytes: exactly. If it is None, the
+    result is not cached.
+    '''
+    def _on_compressed(error, compressed_bytes):
+        '''Insert the compressed bytes into the cache.'''
+        if error is not None:
+            callback(error, None)
+            return
+
+        compressed_bodies_cache(cache).insert(key, compressed_bytes)
+        callback(None, compressed_bytes)
+
+    if key is None:
+        compress_bytes_async(content_bytes, cancellable, callback)
+        return
+
+    compressed_bytes = compressed_bodies_cache(cache).lookup(key)
+
+    if compressed_bytes is not None:
+        GLib.idle_add(lambda: callback(None, compressed_bytes))
+        return
+
+    compress_bytes_async(content_bytes, cancellable, _on_compressed)
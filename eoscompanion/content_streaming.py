@@ -22,13 +22,15 @@ These functions take a raw content stream and either adjust it or
 set the right headers so that it will be streamed properly.
 '''
 
+import uuid
+
 from gi.repository import (
     EosCompanionAppService,
     Gio,
     GLib
 )
 
-from .ekn_data import BYTE_CHUNK_SIZE
+from .ekn_data import chunk_size_for_content_size
 
 
 def define_content_range_from_headers_and_size(request_headers, content_size):
@@ -42,6 +44,149 @@ def define_content_range_from_headers_and_size(request_headers, content_size):
     return ranges[0].start, ranges[0].end, ranges[0].end - ranges[0].start + 1
 
 
+# Responses with multiple ranges are built in memory, so limit how
+# many ranges a request may have and how large they may be in total.
+# Requests over these limits just get the first range.
+_MAX_MULTIPART_RANGES = 16
+_MAX_MULTIPART_RANGES_SIZE = 4 * 1024 * 1024
+
+
+def define_multiple_content_ranges_from_headers_and_size(request_headers,
+                                                          content_size):
+    '''Determine whether to respond with multiple ranges, and which.
+
+    Returns a list of inclusive (start, end) tuples if the request has
+    more than one range, in ascending order and without overlaps, within
+    the limits above. Otherwise returns None, in which case the response
+    should just use the first range.
+    '''
+    has_ranges, ranges = request_headers.get_ranges(content_size)
+
+    if not has_ranges or not 1 < len(ranges) <= _MAX_MULTIPART_RANGES:
+        return None
+
+    spans = [(r.start, r.end) for r in ranges]
+
+    if any([
+            previous_end >= start
+            for (_, previous_end), (start, _) in zip(spans, spans[1:])
+    ]):
+        return None
+
+    if sum([end - start + 1 for start, end in spans]) > _MAX_MULTIPART_RANGES_SIZE:
+        return None
+
+    return spans
+
+
+def read_stream_ranges_async(stream, ranges, cancellable, callback):
+    '''Read each of :ranges: from :stream: and pass them to callback.
+
+    :ranges: must be a list of inclusive (start, end) tuples in ascending
+    order which do not overlap, such as the ones returned by
+    define_multiple_content_ranges_from_headers_and_size. The stream is
+    skipped forward to each range in turn, using fast_skip_stream_async.
+    The callback receives a list of bytes, one for each range.
+    '''
+    chunks = []
+    pending = []
+    position = 0
+
+    def _read_rest_of_range(count):
+        '''Read the next :count: bytes of the current range.'''
+        stream.read_bytes_async(count,
+                                GLib.PRIORITY_DEFAULT,
+                                cancellable,
+                                _on_read_bytes)
+
+    def _on_read_bytes(src, result):
+        '''Continue reading the current range, or move to the next one.'''
+        nonlocal position
+
+        try:
+            read_bytes = src.read_bytes_finish(result)
+        except GLib.Error as error:
+            callback(error, None)
+            return
+
+        if read_bytes.get_size() == 0:
+            callback(GLib.Error('Unexpected end of stream',
+                                GLib.quark_to_string(Gio.io_error_quark()),
+                                Gio.IOErrorEnum.FAILED),
+                     None)
+            return
+
+        pending.append(read_bytes.get_data())
+        position += read_bytes.get_size()
+
+        _, end = ranges[len(chunks)]
+
+        if position <= end:
+            _read_rest_of_range(end - position + 1)
+            return
+
+        chunks.append(b''.join(pending))
+        del pending[:]
+        _skip_to_next_range()
+
+    def _on_skipped(_, result):
+        '''Start reading the current range.'''
+        nonlocal position
+
+        try:
+            EosCompanionAppService.finish_fast_skip_stream(result)
+        except GLib.Error as error:
+            callback(error, None)
+            return
+
+        start, end = ranges[len(chunks)]
+        position = start
+        _read_rest_of_range(end - start + 1)
+
+    def _skip_to_next_range():
+        '''Skip to the start of the next range, or finish.'''
+        if len(chunks) == len(ranges):
+            callback(None, chunks)
+            return
+
+        start, _ = ranges[len(chunks)]
+        EosCompanionAppService.fast_skip_stream_async(stream,
+                                                      start - position,
+                                                      cancellable,
+                                                      _on_skipped)
+
+    _skip_to_next_range()
+
+
+def format_multipart_byteranges(content_type, content_size, ranges, chunks):
+    '''Format a multipart/byteranges body for :ranges: of some content.
+
+    Returns a tuple of the Content-Type for the response, including the
+    boundary, and the body as bytes.
+    '''
+    boundary = uuid.uuid4().hex
+    parts = []
+
+    for (start, end), chunk in zip(ranges, chunks):
+        parts.append('--{boundary}\r\n'
+                     'Content-Type: {content_type}\r\n'
+                     'Content-Range: bytes {start}-{end}/{total}\r\n'
+                     '\r\n'.format(boundary=boundary,
+                                    content_type=content_type,
+                                    start=start,
+                                    end=end,
+                                    total=content_size).encode('utf-8'))
+        parts.append(chunk)
+        parts.append(b'\r\n')
+
+    parts.append('--{boundary}--\r\n'.format(boundary=boundary).encode('utf-8'))
+
+    return (
+        'multipart/byteranges; boundary={boundary}'.format(boundary=boundary),
+        b''.join(parts)
+    )
+
+
 def conditionally_wrap_stream(stream,
                               content_size,
                               content_type,
@@ -78,8 +223,19 @@ def conditionally_wrap_stream(stream,
                               _content_adjusted_callback)
 
     if adjuster.needs_adjustment(content_type):
+        # If the content was adjusted recently, we can skip reading
+        # the stream and adjusting it again. This makes requests for
+        # further ranges of adjusted content cheap.
+        adjusted = adjuster.lookup_adjusted(content_type, version, query, cache)
+
+        if adjusted is not None:
+            GLib.idle_add(lambda: _content_adjusted_callback(None, adjusted))
+            return
+
         EosCompanionAppService.load_all_in_stream_to_bytes(stream,
-                                                           chunk_size=BYTE_CHUNK_SIZE,
+                                                           chunk_size=chunk_size_for_content_size(
+                                                               content_size
+                                                           ),
                                                            cancellable=cancellable,
                                                            callback=_read_stream_callback)
         return
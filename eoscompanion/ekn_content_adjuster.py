@@ -30,27 +30,43 @@ import os
 
 import re
 
-from urllib.parse import urlparse
+from urllib.parse import quote_plus, urlparse
 
 from gi.repository import (
     Eknr,
     EosCompanionAppService,
-    GLib,
-    Gio
+    GLib
 )
 
 from .applications_query import application_listing_from_app_info
 
+from .caching import LRUCache, python_subcache
+
+from .ekn_data import shards_identity
+
+from .ekn_query import load_set_catalogue
+
 from .format import (
     rewrite_ekn_url,
     rewrite_license_url,
     rewrite_resource_url
 )
 
+from .mustache import compiled_resource_template_closure
+
 _RE_EKN_URL_CAPTURE = re.compile(r'"ekn\:\/\/[a-z0-9\-_\.\\\/]*\/(?P<id>[a-z0-9]+)"')
 _RE_RESOURCE_URL_CAPTURE = re.compile(r'"(?P<uri>(?:resource|file)\:\/\/[A-Za-z0-9\/\-\._]+)"')
 _RE_LICENSE_URL_CAPTURE = re.compile(r'"license\:\/\/(?P<license>[A-Za-z0-9%\/\-\._]+)"')
 
+# All of the above in a single pattern, so that a document can be
+# rewritten in a single pass. Each alternative has exactly one named
+# group, so match.lastgroup says which kind of URL was matched.
+_RE_ANY_URL_CAPTURE = re.compile('|'.join([
+    _RE_EKN_URL_CAPTURE.pattern,
+    _RE_RESOURCE_URL_CAPTURE.pattern,
+    _RE_LICENSE_URL_CAPTURE.pattern
+]))
+
 
 def ekn_url_rewriter(version, query):
     '''Higher order function to rewrite an EKN URL based on query.'''
@@ -73,14 +89,15 @@ def license_url_rewriter(version, query):
                                                        query))
 
 
-def pipeline(src, *funcs):
-    '''Apply each function in funcs to src, in sequence.'''
-    output = src
+def any_url_rewriter(version, query):
+    '''Higher order function to rewrite any URL matched by _RE_ANY_URL_CAPTURE.'''
+    rewriters = {
+        'id': ekn_url_rewriter(version, query),
+        'uri': resource_url_rewriter(version, query),
+        'license': license_url_rewriter(version, query)
+    }
 
-    for func in funcs:
-        output = func(output)
-
-    return output
+    return lambda m: rewriters[m.lastgroup](m)
 
 
 # The code below is a reimplementation of what is in libdmodel (which was
@@ -112,6 +129,63 @@ def link_tables_from_shards(shards):
             yield link_table_record.data.load_as_dictionary()
 
 
+# Each index keeps resolved links in memory, so bound how many
+# indices (one per application) and how many links each may hold.
+_LINK_RESOLUTION_INDICES_MAX_ENTRIES = 16
+_LINK_RESOLUTION_INDEX_MAX_LINKS = 50000
+
+
+class LinkResolutionIndex(object):
+    '''Resolves outgoing links to internal links for a set of shards.
+
+    The link tables are loaded once, when the index is created. The
+    tables can only be probed, not enumerated, so they cannot be merged
+    up front. Instead, each link is resolved once and remembered.
+    '''
+
+    def __init__(self, shards):
+        '''Initialize this LinkResolutionIndex with the link tables in shards.'''
+        super().__init__()
+        self._link_tables = list(link_tables_from_shards(shards))
+        self._resolved = {}
+
+    def resolve(self, outgoing_link):
+        '''Resolve :outgoing_link: to an internal link, or None.'''
+        try:
+            return self._resolved[outgoing_link]
+        except KeyError:
+            pass
+
+        if len(self._resolved) >= _LINK_RESOLUTION_INDEX_MAX_LINKS:
+            self._resolved.clear()
+
+        resolved = resolve_outgoing_link_to_internal_link(self._link_tables,
+                                                          outgoing_link)
+        self._resolved[outgoing_link] = resolved
+        return resolved
+
+
+def link_resolution_index_for_shards(shards, cache):
+    '''Get a LinkResolutionIndex for :shards:, re-using one from :cache:.'''
+    identity = shards_identity(shards)
+
+    if identity is None:
+        return LinkResolutionIndex(shards)
+
+    indices = python_subcache(
+        cache,
+        'link-resolution-indices',
+        lambda: LRUCache(max_entries=_LINK_RESOLUTION_INDICES_MAX_ENTRIES)
+    )
+    index = indices.lookup(identity)
+
+    if index is None:
+        index = LinkResolutionIndex(shards)
+        indices.insert(identity, index)
+
+    return index
+
+
 def maybe_ekn_id_to_server_uri(ekn_uri, version, query):
     '''Convert an EKN URI (ekn:///id) to a URI that resolves on this server.
 
@@ -125,13 +199,46 @@ def maybe_ekn_id_to_server_uri(ekn_uri, version, query):
                            query)
 
 
-_MOBILE_WRAPPER_TEMPLATE_URI = (
-    'resource:///com/endlessm/CompanionAppService/data/templates/mobile-article-wrapper.mst'
+_MOBILE_WRAPPER_TEMPLATE_PATH = (
+    '/com/endlessm/CompanionAppService/data/templates/mobile-article-wrapper.mst'
 )
 
+# The wrapper template is compiled once, on first use (or when
+# prewarm_templates is called) and re-used for every article.
+mobile_wrapper_template = compiled_resource_template_closure(_MOBILE_WRAPPER_TEMPLATE_PATH)
+
+
+def prewarm_templates():
+    '''Load and compile the templates now, rather than on first use.'''
+    mobile_wrapper_template()
+
+
+# The stylesheets and scripts that the wrapper links to. They are in the
+# knowledge library's resources, in the directories the template expects.
+_MOBILE_WRAPPER_RESOURCES_URI = 'resource:///com/endlessm/knowledge/data/templates'
+_MOBILE_WRAPPER_CSS_FILES = [
+    'clipboard.css',
+    'share-actions.css'
+]
+_MOBILE_WRAPPER_JAVASCRIPT_FILES = [
+    'jquery-min.js',
+    'collapse-infotable.js',
+    'crosslink.js'
+]
+
+
+def mobile_wrapper_resource_uris():
+    '''Get the URIs of the resources that every rendered article links to.'''
+    return [
+        '{}/css/{}'.format(_MOBILE_WRAPPER_RESOURCES_URI, name)
+        for name in _MOBILE_WRAPPER_CSS_FILES
+    ] + [
+        '{}/js/{}'.format(_MOBILE_WRAPPER_RESOURCES_URI, name)
+        for name in _MOBILE_WRAPPER_JAVASCRIPT_FILES
+    ]
+
 
-def render_mobile_wrapper(renderer,
-                          app_id,
+def render_mobile_wrapper(app_id,
                           rendered_content,
                           metadata,
                           content_db_conn,
@@ -149,13 +256,12 @@ def render_mobile_wrapper(renderer,
     of outgoing links to internal links. Then we inject some javascript which
     at browser-render time, rewrites the page to resolve all those links.
     '''
-    def _on_queried_sets(error, result):
-        '''Called when we finish querying set objects.'''
+    def _on_loaded_set_catalogue(error, catalogue):
+        '''Called when we have the set catalogue.'''
         if error is not None:
             callback(error, None)
             return
 
-        _, set_objects = result
         content_metadata = {
             'title': metadata.get('title', ''),
             'published': metadata.get('published', ''),
@@ -171,40 +277,22 @@ def render_mobile_wrapper(renderer,
                     'title': set_object['title'],
                     'tags': set_object['tags']
                 }
-                for set_object in set_objects
-                if any([
-                    tag in set_object['child_tags']
-                    for tag in metadata.get('tags', [])
-                    if not tag.startswith('Ekn')
-                ])
+                for set_object in catalogue.sets_for_tags(metadata.get('tags', []))
             ]
         }
 
-        # Now that we have everything, read the template and render it
-        variables = GLib.Variant('a{sv}', {
-            'css-files': GLib.Variant('as', [
-                'clipboard.css',
-                'share-actions.css'
-            ]),
-            'custom-css-files': GLib.Variant('as', []),
-            'javascript-files': GLib.Variant('as', [
-                'jquery-min.js',
-                'collapse-infotable.js',
-                'crosslink.js'
-            ]),
-            'content': GLib.Variant('s', rendered_content),
-            'crosslink-data': GLib.Variant('s', json.dumps(link_resolution_table)),
-            'content-metadata': GLib.Variant('s', json.dumps(content_metadata)),
-            'title': GLib.Variant(
-                's',
-                metadata.get('title', 'Content from {app_id}'.format(app_id=app_id))
-            )
-        })
-
+        # Now that we have everything, render the template
         try:
-            template_file = Gio.File.new_for_uri(_MOBILE_WRAPPER_TEMPLATE_URI)
-            rendered_page = renderer.render_mustache_document_from_file(template_file,
-                                                                        variables)
+            rendered_page = mobile_wrapper_template()({
+                'css-files': _MOBILE_WRAPPER_CSS_FILES,
+                'custom-css-files': [],
+                'javascript-files': _MOBILE_WRAPPER_JAVASCRIPT_FILES,
+                'content': rendered_content,
+                'crosslink-data': json.dumps(link_resolution_table),
+                'content-metadata': json.dumps(content_metadata),
+                'title': metadata.get('title',
+                                      'Content from {app_id}'.format(app_id=app_id))
+            })
         except GLib.Error as page_render_error:
             callback(page_render_error, None)
             return
@@ -219,17 +307,16 @@ def render_mobile_wrapper(renderer,
             callback(error, None)
             return
 
-        content_db_conn.query(application_listing=application_listing_from_app_info(app_info),
-                              query={
-                                  'tags-match-all': ['EknSetObject']
-                              },
-                              cancellable=cancellable,
-                              callback=_on_queried_sets)
+        load_set_catalogue(content_db_conn,
+                           application_listing_from_app_info(app_info),
+                           cache,
+                           cancellable,
+                           _on_loaded_set_catalogue)
 
-    link_tables = list(link_tables_from_shards(shards))
+    link_index = link_resolution_index_for_shards(shards, cache)
     link_resolution_table = [
         maybe_ekn_id_to_server_uri(
-            resolve_outgoing_link_to_internal_link(link_tables, l),
+            link_index.resolve(l),
             version,
             query
         )
@@ -242,6 +329,109 @@ def render_mobile_wrapper(renderer,
                                                  callback=_on_got_application_info)
 
 
+# Rendered articles are kept with this placeholder in place of the
+# deviceUUID, which is the only part of a rendered article that differs
+# between devices. It only contains characters that urlencode leaves
+# alone, so it comes out of URL rewriting intact.
+_DEVICE_UUID_PLACEHOLDER = 'eoscompaniondeviceuuidplaceholder'
+
+_RENDERED_ARTICLES_MAX_SIZE = 32 * 1024 * 1024
+
+# Browsers tend to re-request ranges of an article shortly after first
+# loading it, so keep the bytes that were served to each device around
+# for a little while as well.
+_SERVED_ARTICLES_MAX_SIZE = 8 * 1024 * 1024
+_SERVED_ARTICLES_TTL = 30
+
+
+def rendered_articles_cache(cache):
+    '''Get the cache of rendered articles attached to :cache:.
+
+    The cache maps (app_id, content_id, shards_identity, version) to
+    the bytes of a fully adjusted article, with the deviceUUID
+    placeholder in place of the deviceUUID.
+    '''
+    return python_subcache(cache,
+                           'rendered-articles',
+                           lambda: LRUCache(max_size=_RENDERED_ARTICLES_MAX_SIZE))
+
+
+def rendered_article_key(version, query, shards):
+    '''Get the key for an article in the rendered articles cache.
+
+    Returns None if the article cannot be cached.
+    '''
+    identity = shards_identity(shards) if shards is not None else None
+    content_id = query.get('contentId', None)
+
+    if identity is None or content_id is None:
+        return None
+
+    return (query['applicationId'], content_id, identity, version)
+
+
+def served_articles_cache(cache):
+    '''Get the cache of articles recently served to each device.
+
+    The cache maps a rendered articles cache key and a deviceUUID
+    to the GLib.Bytes that were served for it.
+    '''
+    return python_subcache(cache,
+                           'served-articles',
+                           lambda: LRUCache(max_size=_SERVED_ARTICLES_MAX_SIZE,
+                                            size_func=lambda b: b.get_size(),
+                                            ttl=_SERVED_ARTICLES_TTL))
+
+
+def device_uuid_placeholder_query(query):
+    '''Get a copy of :query: with the deviceUUID placeholder as the deviceUUID.
+
+    Content adjusted using this query can be shared between devices by
+    passing it to splice_device_uuid.
+    '''
+    return dict(query, deviceUUID=_DEVICE_UUID_PLACEHOLDER)
+
+
+def splice_device_uuid(rendered_bytes, device_uuid):
+    '''Replace the deviceUUID placeholder in :rendered_bytes: with :device_uuid:.
+
+    Returns a GLib.Bytes.
+    '''
+    return GLib.Bytes.new(rendered_bytes.replace(
+        _DEVICE_UUID_PLACEHOLDER.encode('utf-8'),
+        quote_plus(device_uuid).encode('utf-8')
+    ))
+
+
+def serve_rendered_article(cache, rendered_key, rendered_bytes, device_uuid):
+    '''Get the bytes to serve for a rendered article to :device_uuid:.
+
+    The result is remembered in the served articles cache.
+    '''
+    served_bytes = splice_device_uuid(rendered_bytes, device_uuid)
+    served_articles_cache(cache).insert((rendered_key, device_uuid),
+                                        served_bytes)
+    return served_bytes
+
+
+def lookup_rendered_article(cache, rendered_key, device_uuid):
+    '''Look up the bytes to serve for a rendered article to :device_uuid:.
+
+    Returns None if the article has not been rendered yet.
+    '''
+    served_bytes = served_articles_cache(cache).lookup((rendered_key, device_uuid))
+
+    if served_bytes is not None:
+        return served_bytes
+
+    rendered_bytes = rendered_articles_cache(cache).lookup(rendered_key)
+
+    if rendered_bytes is None:
+        return None
+
+    return serve_rendered_article(cache, rendered_key, rendered_bytes, device_uuid)
+
+
 def _html_content_adjuster_closure():
     '''Closure for the HTML content adjuster.'''
     renderer = Eknr.Renderer()
@@ -262,7 +452,13 @@ def _html_content_adjuster_closure():
         be resolved by the server.
 
         Right now the way that this is done is a total hack (regex), in future
-        we might want to depend on beautifulsoup and use that instead.
+        we might want to depend on beautifulsoup and use that instead. All
+        the URLs are rewritten in a single pass over the document, which
+        avoids allocating a new copy of the page for each kind of URL.
+
+        Fully adjusted articles are kept in the rendered articles cache,
+        so that repeat views only need to splice in the deviceUUID (see
+        EknContentAdjuster.lookup_adjusted).
         '''
         def _on_rendered_wrapper(error, rendered_page):
             '''Called when rendering the wrapper is complete.'''
@@ -270,29 +466,29 @@ def _html_content_adjuster_closure():
                 callback(error, None)
                 return
 
-            try:
-                response_bytes = EosCompanionAppService.string_to_bytes(
-                    pipeline(
-                        rendered_page,
-                        lambda content: _RE_EKN_URL_CAPTURE.sub(
-                            ekn_url_rewriter(version, query),
-                            content
-                        ),
-                        lambda content: _RE_RESOURCE_URL_CAPTURE.sub(
-                            resource_url_rewriter(version, query),
-                            content
-                        ),
-                        lambda content: _RE_LICENSE_URL_CAPTURE.sub(
-                            license_url_rewriter(version, query),
-                            content
-                        )
-                    )
-                )
-            except GLib.Error as render_bytes_error:
-                callback(render_bytes_error, None)
+            rendered_bytes = _RE_ANY_URL_CAPTURE.sub(
+                any_url_rewriter(version, placeholder_query),
+                rendered_page
+            ).encode('utf-8')
+
+            if rendered_key is None:
+                callback(None, splice_device_uuid(rendered_bytes,
+                                                  query['deviceUUID']))
                 return
 
-            callback(None, response_bytes)
+            rendered_articles_cache(cache).insert(rendered_key, rendered_bytes)
+            callback(None, serve_rendered_article(cache,
+                                                  rendered_key,
+                                                  rendered_bytes,
+                                                  query['deviceUUID']))
+
+        # Render with a placeholder in place of the deviceUUID, so that
+        # the result can be shared between devices
+        placeholder_query = device_uuid_placeholder_query(query)
+        rendered_key = (
+            rendered_article_key(version, query, shards)
+            if metadata is not None and content_db_conn is not None else None
+        )
 
         unrendered_html_string = EosCompanionAppService.bytes_to_string(content_bytes)
 
@@ -315,14 +511,13 @@ def _html_content_adjuster_closure():
             else:
                 rendered_content = unrendered_html_string
 
-            render_mobile_wrapper(renderer,
-                                  query['applicationId'],
+            render_mobile_wrapper(query['applicationId'],
                                   rendered_content,
                                   metadata,
                                   content_db_conn,
                                   shards,
                                   version,
-                                  query,
+                                  placeholder_query,
                                   cache,
                                   cancellable,
                                   _on_rendered_wrapper)
@@ -359,6 +554,22 @@ class EknContentAdjuster(object):
         '''
         return content_type in CONTENT_TYPE_ADJUSTERS.keys()
 
+    def lookup_adjusted(self, content_type, version, query, cache):
+        '''Return already adjusted content as GLib.Bytes, or None.
+
+        If the content has been adjusted before, then the caller does not
+        need to read the content stream or call render_async() at all.
+        '''
+        if content_type != 'text/html' or self._metadata is None:
+            return None
+
+        rendered_key = rendered_article_key(version, query, self._shards)
+
+        if rendered_key is None:
+            return None
+
+        return lookup_rendered_article(cache, rendered_key, query['deviceUUID'])
+
     def render_async(self,
                      content_type,
                      content_bytes,
@@ -18,37 +18,221 @@
 # All rights reserved.
 '''Functions to load content from EKN shards.'''
 
-from gi.repository import (EosCompanionAppService, GLib)
+import json
+import logging
+import os
 
-BYTE_CHUNK_SIZE = 256
+from gi.repository import (EosCompanionAppService, EosShard, GLib)
+
+from .caching import LRUCache, python_subcache
+
+# The size of the first read when reading a stream of unknown size
+# into memory. Subsequent reads double in size.
+BYTE_CHUNK_SIZE = 4096
 
 LOAD_FROM_ENGINE_SUCCESS = 0
 LOAD_FROM_ENGINE_NO_SUCH_CONTENT = 1
 
+# Each shard route is just a small tuple, so the limit is on the
+# number of routes rather than their size.
+_SHARD_ROUTES_MAX_ENTRIES = 8192
+_NOT_IN_SHARDS = -1
 
-def load_record_blob_from_shards(shards, content_id, attr):
-    '''Load a blob for an app and content_id if given a set of shards.'''
-    if attr not in ('data', 'metadata'):
-        raise RuntimeError('attr must be one of "data" or "metadata"')
+_CONTENT_METADATA_MAX_ENTRIES = 1024
+
+# Older versions of EosShard do not expose where a blob is in its shard
+# file, in which case records can only be read through their streams.
+_BLOBS_HAVE_OFFSETS = hasattr(EosShard.Blob, 'get_offset')
+_LOGGED_MISSING_BLOB_OFFSETS = False
+
+
+def chunk_size_for_content_size(content_size):
+    '''Get the chunk size to read a stream of :content_size: bytes into memory.
+
+    This is meant to be passed to load_all_in_stream_to_bytes. The stream
+    will be read with a single read, plus one byte to detect the end of
+    the stream. If :content_size: is not known, use BYTE_CHUNK_SIZE.
+    '''
+    if not content_size or content_size < 0:
+        return BYTE_CHUNK_SIZE
+
+    return content_size + 1
+
+
+def shard_file_identity(shard_path):
+    '''Get a hashable value that identifies the shard file at :shard_path:.
+
+    The value includes the inode and modification time of the shard file,
+    so that a shard which is replaced on disk, for instance when its
+    application is updated, gets a different value. If the shard file
+    cannot be examined, return None.
+    '''
+    try:
+        shard_stat = os.stat(shard_path)
+    except OSError:
+        return None
+
+    return (shard_path, shard_stat.st_ino, shard_stat.st_mtime_ns)
+
+
+class IdentifiedShards(list):
+    '''A list of shards which knows the shards_identity of its shards.
+
+    Working out the identity means examining every shard file, so it is
+    done once when the shards are loaded for a request, rather than
+    each time something needs it while handling that request.
+    '''
+
+    def __init__(self, shards, identity):
+        '''Initialize with :shards: and their :identity:.'''
+        super().__init__(shards)
+        self.identity = identity
+
+
+def identity_of_shard_files(shard_file_identities):
+    '''Combine the shard_file_identity of each shard into a shards_identity.'''
+    identities = tuple(shard_file_identities)
+
+    if None in identities:
+        return None
+
+    return identities
+
+
+def shards_identity(shards):
+    '''Get a hashable value that identifies the content of :shards:.
+
+    Shard files are not modified in place, so the identity of each shard
+    file identifies its content. If any of the shards does not have a
+    path or cannot be examined, return None, which means that the content
+    cannot be identified.
+
+    If :shards: is an IdentifiedShards, its identity is returned without
+    examining the shard files again.
+    '''
+    if isinstance(shards, IdentifiedShards):
+        return shards.identity
+
+    try:
+        return identity_of_shard_files([
+            shard_file_identity(shard.props.path) for shard in shards
+        ])
+    except AttributeError:
+        return None
+
+
+def shard_routes_cache(cache):
+    '''Get the cache of shard routes attached to :cache:.
+
+    The cache maps (shards_identity, content_id) to the index of the
+    shard which has the record for content_id, or to _NOT_IN_SHARDS
+    if none of the shards have it. Since shard files are never modified
+    once installed, a route stays valid for as long as the shards
+    have the same identity.
+    '''
+    return python_subcache(cache,
+                           'shard-routes',
+                           lambda: LRUCache(max_entries=_SHARD_ROUTES_MAX_ENTRIES))
+
+
+def find_record_in_shards(shards, content_id, routes=None):
+    '''Find the record for :content_id: in :shards:.
+
+    Returns a tuple of the shard and the record, or (None, None) if
+    none of the shards have the record. If :routes: is set, it is used
+    to go straight to the shard which has the record, or to reject
+    a content_id which none of the shards have, and it is updated
+    with the result of walking the shards otherwise.
+    '''
+    identity = shards_identity(shards) if routes is not None else None
+    key = (identity, content_id)
+
+    if identity is not None:
+        index = routes.lookup(key)
+
+        if index == _NOT_IN_SHARDS:
+            return None, None
+
+        if index is not None:
+            record = shards[index].find_record_by_hex_name(content_id)
 
-    for shard in shards:
+            if record:
+                return shards[index], record
+
+    for index, shard in enumerate(shards):
         record = shard.find_record_by_hex_name(content_id)
 
         if not record:
             continue
 
-        return LOAD_FROM_ENGINE_SUCCESS, getattr(record, attr)
+        if identity is not None:
+            routes.insert(key, index)
+
+        return shard, record
+
+    if identity is not None:
+        routes.insert(key, _NOT_IN_SHARDS)
+
+    return None, None
+
+
+def load_record_blob_from_shards(shards, content_id, attr, routes=None):
+    '''Load a blob for an app and content_id if given a set of shards.
+
+    :routes: is an optional shard routes cache, see find_record_in_shards.
+    '''
+    if attr not in ('data', 'metadata'):
+        raise RuntimeError('attr must be one of "data" or "metadata"')
+
+    _, record = find_record_in_shards(shards, content_id, routes=routes)
+
+    if not record:
+        return LOAD_FROM_ENGINE_NO_SUCH_CONTENT, None
+
+    return LOAD_FROM_ENGINE_SUCCESS, getattr(record, attr)
+
+
+def locate_uncompressed_record_data_in_shards(shards, content_id, routes=None):
+    '''Find where the data for content_id is stored in the shard files.
+
+    Returns a tuple of the path to the shard file and the offset of the data
+    within it, or None if the data is compressed, or is not stored in a
+    shard file on disk, in which case it must be read through its stream.
+    '''
+    if not _BLOBS_HAVE_OFFSETS:
+        global _LOGGED_MISSING_BLOB_OFFSETS  # pylint: disable=global-statement
+        if not _LOGGED_MISSING_BLOB_OFFSETS:
+            logging.warning('EosShard.Blob.get_offset is not available, content '
+                            'will always be streamed rather than sent from the '
+                            'shard file')
+            _LOGGED_MISSING_BLOB_OFFSETS = True
+        return None
+
+    shard, record = find_record_in_shards(shards, content_id, routes=routes)
+
+    if not record:
+        return None
+
+    if not isinstance(shard, EosShard.ShardFile):
+        return None
+
+    blob = record.data
 
-    return LOAD_FROM_ENGINE_NO_SUCH_CONTENT, None
+    if blob.get_flags() & EosShard.BlobFlags.COMPRESSED_ZLIB:
+        return None
+
+    return shard.props.path, blob.get_offset()
 
 
 def load_record_from_shards_async(shards,
                                   content_id,
                                   attr,
-                                  callback):
+                                  callback,
+                                  routes=None):
     '''Load bytes from stream for app and content_id.
 
     :attr: must be one of 'data' or 'metadata'.
+    :routes: is an optional shard routes cache, see find_record_in_shards.
 
     Once loading is complete, callback will be invoked with a GAsyncResult,
     use EosCompanionAppService.finish_load_all_in_stream_to_bytes
@@ -69,7 +253,8 @@ def load_record_from_shards_async(shards,
 
     status, blob = load_record_blob_from_shards(shards,
                                                 content_id,
-                                                attr)
+                                                attr,
+                                                routes=routes)
 
     if status == LOAD_FROM_ENGINE_NO_SUCH_CONTENT:
         GLib.idle_add(
@@ -85,6 +270,62 @@ def load_record_from_shards_async(shards,
         return
 
     EosCompanionAppService.load_all_in_stream_to_bytes(blob.get_stream(),
-                                                       chunk_size=BYTE_CHUNK_SIZE,
+                                                       chunk_size=chunk_size_for_content_size(
+                                                           blob.get_content_size()
+                                                       ),
                                                        cancellable=None,
                                                        callback=_callback)
+
+
+def content_metadata_cache(cache):
+    '''Get the cache of parsed content metadata attached to :cache:.
+
+    The cache maps (app_id, content_id, shards_identity) to the
+    metadata dict for content_id.
+    '''
+    return python_subcache(cache,
+                           'content-metadata',
+                           lambda: LRUCache(max_entries=_CONTENT_METADATA_MAX_ENTRIES))
+
+
+def load_content_metadata_from_shards_async(shards,
+                                            app_id,
+                                            content_id,
+                                            cache,
+                                            callback):
+    '''Load and parse the metadata for app_id and content_id.
+
+    The callback gets the metadata as a dict. Parsed metadata is kept
+    in the content metadata cache attached to :cache:, so the dict
+    passed to callback is a shallow copy. Callers may change its keys,
+    but must not change any of the values in place.
+    '''
+    def _on_loaded_metadata_bytes(error, metadata_bytes):
+        '''Parse the metadata and insert it into the cache.'''
+        if error is not None:
+            callback(error, None)
+            return
+
+        metadata = json.loads(EosCompanionAppService.bytes_to_string(metadata_bytes))
+
+        if identity is not None:
+            metadata_cache.insert(key, metadata)
+
+        callback(None, dict(metadata))
+
+    identity = shards_identity(shards)
+    key = (app_id, content_id, identity)
+    metadata_cache = content_metadata_cache(cache)
+
+    if identity is not None:
+        metadata = metadata_cache.lookup(key)
+
+        if metadata is not None:
+            GLib.idle_add(lambda: callback(None, dict(metadata)))
+            return
+
+    load_record_from_shards_async(shards,
+                                  content_id,
+                                  'metadata',
+                                  _on_loaded_metadata_bytes,
+                                  routes=shard_routes_cache(cache))
@@ -18,6 +18,8 @@
 # All rights reserved.
 '''Functions to query an EKN database provider for content.'''
 
+from collections import defaultdict
+
 import urllib
 
 from gi.repository import (
@@ -26,6 +28,7 @@ from gi.repository import (
 )
 
 from .applications_query import application_listing_from_app_info
+from .caching import python_subcache
 from .format import (
     format_app_icon_uri,
     optional_format_thumbnail_uri
@@ -35,6 +38,77 @@ from .format import (
 _GLOBAL_SET_INDICATOR_TAG = ['EknHomePageTag']
 
 
+class SetCatalogue(object):
+    '''All the EknSetObject models of an application, indexed by child tag.'''
+
+    def __init__(self, models):
+        '''Initialize this SetCatalogue with the set models.'''
+        super().__init__()
+        self.models = models
+        self._set_indices_by_child_tag = defaultdict(list)
+
+        for index, model in enumerate(models):
+            for tag in model.get('child_tags', []):
+                self._set_indices_by_child_tag[tag].append(index)
+
+    def sets_for_tags(self, tags):
+        '''Get the sets which have any of :tags: as a child tag.
+
+        Tags starting with 'Ekn' are internal and ignored. The sets
+        are returned in the same order as the models.
+        '''
+        indices = sorted({
+            index
+            for tag in tags
+            if not tag.startswith('Ekn')
+            for index in self._set_indices_by_child_tag.get(tag, [])
+        })
+
+        return [self.models[index] for index in indices]
+
+
+def load_set_catalogue(content_db_conn,
+                       application_listing,
+                       cache,
+                       cancellable,
+                       callback):
+    '''Pass the SetCatalogue for an application to callback.
+
+    The set catalogue for an application only changes when the application
+    itself changes, so it is kept in a python subcache of :cache:. The
+    catalogue has every set, since article rendering needs to find the
+    sets for any tag.
+    '''
+    def _on_queried_sets(error, result):
+        '''Callback function that gets called when we are done querying.'''
+        if error is not None:
+            callback(error, None)
+            return
+
+        _, models = result
+        # If the cache was cleared since the query started, this is the
+        # old subcache and the catalogue will not be used again
+        catalogue = catalogues[key] = SetCatalogue(models)
+        callback(None, catalogue)
+
+    catalogues = python_subcache(cache, 'set-catalogues', dict)
+    key = (application_listing.app_id,
+           application_listing.eknservices_name,
+           application_listing.search_provider_name)
+    catalogue = catalogues.get(key, None)
+
+    if catalogue is not None:
+        GLib.idle_add(callback, None, catalogue)
+        return
+
+    content_db_conn.query(application_listing,
+                          query={
+                              'tags-match-all': ['EknSetObject']
+                          },
+                          cancellable=cancellable,
+                          callback=_on_queried_sets)
+
+
 def ascertain_application_sets_from_models(models,
                                            version,
                                            device_uuid,
@@ -32,7 +32,16 @@ from gi.repository import (
     GLib
 )
 
-from .functional import all_asynchronous_function_calls_closure
+from .ekn_data import (
+    identity_of_shard_files,
+    IdentifiedShards,
+    shard_file_identity
+)
+from .functional import (
+    all_asynchronous_function_calls_closure,
+    propagate_cancellation,
+    single_flight_closure
+)
 
 
 _EKNSERVICES_DBUS_NAME_TEMPLATE = 'com.endlessm.{eknservices_name}.{search_provider_name}'
@@ -199,19 +208,102 @@ def eknservices_feed(conn, cancellable, callback):
     ContentFeed.find_providers(None, _on_received_providers)
 
 
-def _iterate_init_shard_results(shard_init_results):
-    '''Call init_finish on every result in :shard_init_results:.
+def init_shard_async(shard_path, cancellable, callback):
+    '''Create and initialize a single shard, passing it to callback.'''
+    def _on_shard_initialized(shard, result):
+        '''Finish initializing the shard.'''
+        try:
+            shard.init_finish(result)
+        except GLib.Error as error:
+            callback(error, None)
+            return
+
+        callback(None, shard)
+
+    shard = EosShard.ShardFile(path=shard_path)
+    shard.init_async(GLib.PRIORITY_DEFAULT,
+                     cancellable,
+                     _on_shard_initialized)
 
-    If there is an error in initializing any shard, then allow
-    the exception to propagate to the caller.
+
+class ShardFileCache(object):
+    '''A cache of initialized EosShard.ShardFile objects.
+
+    Initializing a shard means opening the shard file and parsing its
+    header, which is wasteful to do on every request since shard files
+    do not change unless the application itself changes.
+
+    Concurrent requests for a shard that is not yet in the cache share
+    a single initialization.
+
+    The hits and misses counters can be used to examine how effective
+    the cache is, as with LRUCache.
     '''
-    for shard, init_result in shard_init_results:
-        shard.init_finish(init_result)
-        yield shard
 
+    def __init__(self):
+        '''Initialize an empty cache.'''
+        super().__init__()
+        self._shards = {}
+        self._in_flight = single_flight_closure()
+        self.hits = 0
+        self.misses = 0
+
+    def load_shard_async(self, shard_path, identity, cancellable, callback):
+        '''Get an initialized shard for :shard_path: and pass it to callback.
+
+        :identity: is the shard_file_identity of :shard_path:, which the
+        caller has already worked out. The shard is not cached if it is None.
+
+        If :cancellable: is cancelled whilst a shared initialization is in
+        flight, the initialization continues for the other callers and
+        a cancellation error is passed to :callback:.
+        '''
+        def _insert_on_success(done):
+            '''Insert the shard into the cache if initialization succeeded.'''
+            def _callback(error, shard):
+                '''Insert the shard, then pass on the result.'''
+                if error is None:
+                    self._shards[identity] = shard
+
+                done(error, shard)
+
+            return _callback
+
+        if identity is None:
+            self.misses += 1
+            init_shard_async(shard_path, cancellable, callback)
+            return
+
+        shard = self._shards.get(identity, None)
+
+        if shard is not None:
+            self.hits += 1
+            # Invoke the callback on idle, so that this function is
+            # always asynchronous, even on a cache hit.
+            GLib.idle_add(lambda: callback(None, shard))
+            return
+
+        self.misses += 1
+        self._in_flight(identity,
+                        lambda done: init_shard_async(shard_path,
+                                                      None,
+                                                      _insert_on_success(done)),
+                        propagate_cancellation(cancellable, callback))
 
-def async_init_all_shards(shard_paths, cancellable, callback):
-    '''Asynchronously create all shards and pass the result to callback.'''
+    def clear(self):
+        '''Drop all shards from the cache.'''
+        self._shards.clear()
+
+
+def async_init_all_shards(shard_paths, cancellable, callback, shard_cache=None):
+    '''Asynchronously create all shards and pass the result to callback.
+
+    If :shard_cache: is set, shards which were already initialized
+    will be re-used and newly initialized shards will be added to it.
+
+    The shards are passed as an IdentifiedShards, so that the shard files
+    are only examined once for each request.
+    '''
     def _on_finished_loading_shards(shard_init_results):
         '''Callback for when shards have finished initializing.
 
@@ -219,29 +311,33 @@ def async_init_all_shards(shard_paths, cancellable, callback):
         otherwise, invoke the callback with the resolved shards
         and metadata now.
         '''
-        try:
-            callback(None,
-                     list(_iterate_init_shard_results(shard_init_results)))
-        except GLib.Error as error:
-            callback(GLib.Error(error.message,  # pylint: disable=no-member
-                                EosCompanionAppService.error_quark(),
-                                EosCompanionAppService.Error.FAILED),
-                     None)
-            return
+        for error, _ in shard_init_results:
+            if error is not None:
+                callback(GLib.Error(error.message,  # pylint: disable=no-member
+                                    EosCompanionAppService.error_quark(),
+                                    EosCompanionAppService.Error.FAILED),
+                         None)
+                return
 
-    def _load_shard_thunk(shard_path):
+        callback(None, IdentifiedShards([shard for _, shard in shard_init_results],
+                                        identity_of_shard_files(identities)))
+
+    def _load_shard_thunk(shard_path, identity):
         '''Asynchronously load a single shard.'''
         def _thunk(callback):
             '''Thunk that gets called.'''
-            shard = EosShard.ShardFile(path=shard_path)
-            shard.init_async(GLib.PRIORITY_DEFAULT,
-                             cancellable,
-                             callback)
+            if shard_cache is not None:
+                shard_cache.load_shard_async(shard_path, identity, cancellable, callback)
+                return
+
+            init_shard_async(shard_path, cancellable, callback)
 
         return _thunk
 
+    identities = [shard_file_identity(path) for path in shard_paths]
     all_asynchronous_function_calls_closure([
-        _load_shard_thunk(path) for path in shard_paths
+        _load_shard_thunk(path, identity)
+        for path, identity in zip(shard_paths, identities)
     ], _on_finished_loading_shards)
 
 
@@ -279,27 +375,89 @@ class EknServicesContentDbConnection(object):
         '''
         super().__init__(*args, **kwargs)
         self._dbus_connection = dbus_connection
+        self._shard_cache = ShardFileCache()
+        self._shard_paths = {}
+        self._shard_paths_in_flight = single_flight_closure()
+
+    def clear_cache(self):
+        '''Drop all cached state.
+
+        This should be called whenever the Flatpak installation state
+        changes, since the shards for an application may have changed.
+        '''
+        self._shard_cache.clear()
+        self._shard_paths = {}
+
+    @staticmethod
+    def _shard_paths_key(application_listing):
+        '''Key for the shard paths of :application_listing:.'''
+        return (application_listing.app_id,
+                application_listing.eknservices_name,
+                application_listing.search_provider_name)
+
+    def _shard_paths_for_application(self, application_listing, callback):
+        '''Ask EknServices for the application's shard paths.
+
+        The reply is remembered until clear_cache is called, since the
+        shard paths for an application only change when the Flatpak
+        installation state changes. Concurrent requests for the same
+        application share a single D-Bus call, which is never cancelled
+        on behalf of a single caller.
+        '''
+        def _request_shard_paths(done):
+            '''Make the D-Bus call and pass the shard paths to done.'''
+            def _internal_callback(src, result):
+                '''Internal GDBusConnection.call callback.'''
+                try:
+                    response = src.call_finish(result)
+                except GLib.Error as error:
+                    done(_dbus_error_to_companion_app_error(error), None)
+                    return
+
+                shard_paths = response.unpack()[0]
+
+                # Don't remember a reply that raced with clear_cache
+                if self._shard_paths is shard_paths_at_request:
+                    self._shard_paths[key] = shard_paths
+
+                done(None, shard_paths)
+
+            eknservices_shards_for_application(self._dbus_connection,
+                                               application_listing.app_id,
+                                               application_listing.eknservices_name,
+                                               application_listing.search_provider_name,
+                                               None,
+                                               _internal_callback)
+
+        key = self._shard_paths_key(application_listing)
+        shard_paths = self._shard_paths.get(key, None)
+
+        if shard_paths is not None:
+            # Invoke the callback on idle, so that this function is
+            # always asynchronous, even on a cache hit.
+            GLib.idle_add(lambda: callback(None, shard_paths))
+            return
+
+        shard_paths_at_request = self._shard_paths
+        self._shard_paths_in_flight(key, _request_shard_paths, callback)
 
     def shards_for_application(self, application_listing, cancellable, callback):
         '''Load shards for application and wrap with EosShard.ShardFile.'''
-        def _internal_callback(src, result):
-            '''Internal GDBusConnection.call callback.'''
-            try:
-                response = src.call_finish(result)
-            except GLib.Error as error:
-                callback(_dbus_error_to_companion_app_error(error), None)
+        def _on_received_shard_paths(error, shard_paths):
+            '''Callback for when we receive the shard paths.'''
+            if error is not None:
+                callback(error, None)
                 return
 
-            shard_paths = response.unpack()[0]
-            async_init_all_shards(shard_paths, cancellable, callback)
-
-        eknservices_shards_for_application(self._dbus_connection,
-                                           application_listing.app_id,
-                                           application_listing.eknservices_name,
-                                           application_listing.search_provider_name,
-                                           cancellable,
-                                           _internal_callback)
+            async_init_all_shards(shard_paths,
+                                  cancellable,
+                                  callback,
+                                  shard_cache=self._shard_cache)
 
+        self._shard_paths_for_application(
+            application_listing,
+            propagate_cancellation(cancellable, _on_received_shard_paths)
+        )
 
     def query(self, application_listing, query, cancellable, callback):
         '''Run a query and wrap the results into a python-friendly format.'''
@@ -327,9 +485,19 @@ class EknServicesContentDbConnection(object):
                 callback(None, [shards, models])
 
             shard_paths, result_tuples = response.unpack()
+
+            # The Query reply carries the shard paths as well, so
+            # remember them for later shards_for_application calls,
+            # unless the reply raced with clear_cache.
+            if self._shard_paths is shard_paths_at_request:
+                self._shard_paths[self._shard_paths_key(application_listing)] = shard_paths
+
             async_init_all_shards(shard_paths,
                                   cancellable,
-                                  _on_finished_loading_shards)
+                                  _on_finished_loading_shards,
+                                  shard_cache=self._shard_cache)
+
+        shard_paths_at_request = self._shard_paths
 
         # Wrap the query in an array of length 1 to satisfy the interface
         eknservices_query(self._dbus_connection,
@@ -18,6 +18,8 @@
 # All rights reserved.
 '''Functional programming helpers.'''
 
+from gi.repository import Gio, GLib
+
 
 def all_asynchronous_function_calls_closure(calls, done_callback):
     '''Wait for each function call in calls to complete, then pass results.
@@ -56,3 +58,81 @@ def all_asynchronous_function_calls_closure(calls, done_callback):
 
     for i, call in enumerate(calls):
         call(callback_thunk(i))
+
+
+def single_flight_closure():
+    '''Create a function that coalesces concurrent asynchronous calls.
+
+    The returned function takes a hashable key, a single-argument asynchronous
+    function and a callback. The asynchronous function is called with
+    a callback of its own, in the same way as the calls passed to
+    all_asynchronous_function_calls_closure. If a call for the same key
+    is still in flight, the asynchronous function is not called again.
+    Instead, the callback is queued and invoked with the same arguments
+    as the callback of the call which is already in flight.
+
+    If the asynchronous function raises instead, the key is forgotten
+    so that later calls are not queued forever, any callbacks which
+    were queued in the meantime get the error and the exception is
+    raised again to the caller.
+    '''
+    pending = {}
+
+    def call(key, func, callback):
+        '''Call func for key, unless there is already a call in flight.'''
+        if key in pending:
+            pending[key].append(callback)
+            return
+
+        waiting_callbacks = [callback]
+        pending[key] = waiting_callbacks
+
+        def _on_done(*args):
+            '''Pass the result to everyone who was waiting for it.'''
+            # If func raised, everyone waiting has been told already
+            if pending.get(key) is not waiting_callbacks:
+                return
+
+            del pending[key]
+            for waiting_callback in waiting_callbacks:
+                waiting_callback(*args)
+
+        try:
+            func(_on_done)
+        except Exception as error:
+            # The callback may already have been called before the
+            # exception, in which case there is nothing left to do.
+            if pending.get(key) is waiting_callbacks:
+                del pending[key]
+                glib_error = (
+                    error if isinstance(error, GLib.Error)
+                    else GLib.Error(str(error), Gio.io_error_quark(), Gio.IOErrorEnum.FAILED)
+                )
+
+                for waiting_callback in waiting_callbacks[1:]:
+                    waiting_callback(glib_error, None)
+
+            raise
+
+    return call
+
+
+def propagate_cancellation(cancellable, callback):
+    '''Wrap :callback: to pass an error instead if :cancellable: was cancelled.
+
+    This is used where a single asynchronous operation is shared by
+    several callers, such that the operation itself cannot be cancelled
+    on behalf of any single caller.
+    '''
+    def _callback(error, result):
+        '''Check :cancellable: before passing the result on.'''
+        try:
+            if cancellable is not None:
+                cancellable.set_error_if_cancelled()
+        except GLib.Error as cancelled_error:
+            callback(cancelled_error, None)
+            return
+
+        callback(error, result)
+
+    return _callback
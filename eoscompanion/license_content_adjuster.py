@@ -148,6 +148,15 @@ class LicenseContentAdjuster(object):
         '''Returns True in every case as licenses always need adjustment.'''
         return content_type in _CONTENT_TYPE_DISPATCH.keys()
 
+    @staticmethod
+    def lookup_adjusted(content_type, version, query, cache):
+        '''Always return None, so that the license is adjusted by render_async.
+
+        The /license route keeps adjusted bodies in its own cache (see
+        file_bodies_cache in v1_routes), so there is nothing to look up here.
+        '''
+        del content_type, version, query, cache
+
     def render_async(self,
                      content_type,
                      content_bytes,
@@ -39,6 +39,7 @@ from gi.repository import (
 )
 from .constants import INACTIVITY_TIMEOUT
 from .eknservices_bridge import EknServicesContentDbConnection
+from .middlewares import DEFAULT_CACHE_CONTROL_POLICIES
 from .service import CompanionAppService
 
 
@@ -144,7 +145,8 @@ class CompanionAppApplication(Gio.Application):
         logging.info('Got session d-bus connection at %s', object_path)
         self._service = CompanionAppService(self,
                                             1110,
-                                            EknServicesContentDbConnection(connection))
+                                            EknServicesContentDbConnection(connection),
+                                            cache_control_policies=get_cache_control_policies())
         return Gio.Application.do_dbus_register(self,
                                                 connection,
                                                 object_path)
@@ -168,6 +170,7 @@ COMPANION_APP_CONFIG_FILES = [
     '/run/host/usr/share/eos-companion-app/config.ini'
 ]
 COMPANION_APP_CONFIG_SECTION = 'Companion App'
+CACHE_CONTROL_CONFIG_SECTION = 'Cache Control'
 LOGLEVEL_CONFIG_NAME = 'loglevel'
 DEFAULT_LOG_LEVEL = logging.INFO
 
@@ -223,6 +226,30 @@ def get_log_level():
     return level
 
 
+def get_cache_control_policies():
+    '''Get the Cache-Control policies for each route.
+
+    Each key in the "Cache Control" section of the eos-companion-app
+    config file is a route name, like content_data, and its value is
+    sent as the Cache-Control header for that route. An empty value
+    means that no Cache-Control header is sent. Routes that are not
+    in the config file use DEFAULT_CACHE_CONTROL_POLICIES.
+    '''
+    policies = dict(DEFAULT_CACHE_CONTROL_POLICIES)
+    keyfile = find_best_matching_config_file()
+
+    if not keyfile or not keyfile.has_group(CACHE_CONTROL_CONFIG_SECTION):
+        return policies
+
+    keys, _ = keyfile.get_keys(CACHE_CONTROL_CONFIG_SECTION)
+    for route_name in keys:
+        policy = keyfile.get_string(CACHE_CONTROL_CONFIG_SECTION,
+                                    route_name).strip()
+        policies[route_name] = policy or None
+
+    return policies
+
+
 def main(args=None):
     '''Entry point function.
 
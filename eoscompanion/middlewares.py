@@ -23,15 +23,138 @@ import itertools
 
 from gi.repository import EosCompanionAppService, EosMetrics, Gio, GLib, Soup
 
+from .caching import LRUCache, python_subcache
 from .constants import INACTIVITY_TIMEOUT
 
 from .responses import (
-    json_response,
+    error_response,
     not_found_response,
-    serialize_error_as_json_object
+    respond_if_error_set
 )
 
 
+# Cache-Control policies for each route, keyed by the last component of
+# the route path so that they apply to every API version. Routes that are
+# not listed here do not send Cache-Control at all.
+#
+# The same EKN ID can refer to different content once an application
+# is updated, and adjusted content has links that depend on the device,
+# so content must be revalidated each time. Its ETag keeps that cheap.
+# Resources and licenses come from the service and the SDK, which only
+# change on updates. The feed and search results change all the time.
+DEFAULT_CACHE_CONTROL_POLICIES = {
+    'content_data': 'private, no-cache',
+    'resource': 'private, max-age=604800',
+    'license': 'private, max-age=604800',
+    'application_icon': 'private, max-age=86400',
+    'application_icons': 'private, max-age=86400',
+    'feed': 'no-store',
+    'search_content': 'no-cache'
+}
+
+
+# Invalid application and content IDs are remembered for a short time,
+# so that a client retrying a stale ID does not go through the whole
+# pipeline each time. They are also forgotten when the Flatpak
+# installation state changes, since the ID may be valid after that.
+_INVALID_IDS_MAX_ENTRIES = 1024
+_INVALID_IDS_TTL = 60
+
+_INVALID_ID_ERRORS = (
+    EosCompanionAppService.Error.INVALID_APP_ID,
+    EosCompanionAppService.Error.INVALID_CONTENT_ID
+)
+
+
+def invalid_ids_cache(cache):
+    '''Get the cache of known invalid IDs attached to :cache:.
+
+    The cache maps (applicationId, contentId) to the domain, code and
+    message of the error that was reported for them, along with the
+    detail that was sent with it. contentId is None if the application
+    ID itself was invalid.
+    '''
+    return python_subcache(cache,
+                           'invalid-ids',
+                           lambda: LRUCache(max_entries=_INVALID_IDS_MAX_ENTRIES,
+                                            ttl=_INVALID_IDS_TTL))
+
+
+def _invalid_ids_key(query, code):
+    '''Key in the invalid IDs cache for the IDs in :query: which caused :code:.'''
+    if code == EosCompanionAppService.Error.INVALID_APP_ID:
+        return (query['applicationId'], None)
+
+    return (query['applicationId'], query.get('contentId', None))
+
+
+def remember_invalid_ids(cache, query, error, detail=None):
+    '''Remember the IDs in :query: if :error: says that they are invalid.
+
+    :detail: is the detail that the error is reported with, so that the
+    same response can be sent again. Nothing is remembered if :error:
+    is None or is some other error.
+    '''
+    if error is None or 'applicationId' not in query:
+        return
+
+    for code in _INVALID_ID_ERRORS:
+        if error.matches(EosCompanionAppService.error_quark(), code):
+            invalid_ids_cache(cache).insert(_invalid_ids_key(query, code),
+                                            (error.domain,
+                                             error.code,
+                                             error.message,  # pylint: disable=no-member
+                                             dict(detail or {})))
+            return
+
+
+def remember_and_respond_if_error_set(msg,
+                                      cache,
+                                      query,
+                                      error,
+                                      detail=None,
+                                      error_mappings=None):
+    '''Remember invalid IDs in :query:, then respond if :error: is set.
+
+    This is remember_invalid_ids followed by respond_if_error_set, with
+    the same :detail:, so that reject_known_invalid_ids sends the same
+    response for the IDs later on. Returns True if :error: was set.
+    '''
+    remember_invalid_ids(cache, query, error, detail)
+    return respond_if_error_set(msg,
+                                error,
+                                detail=detail,
+                                error_mappings=error_mappings)
+
+
+def reject_known_invalid_ids(handler):
+    '''Respond with an error straight away if the IDs are known to be invalid.
+
+    IDs are remembered by remember_invalid_ids. Routes without an
+    applicationId in the query are passed through.
+    '''
+    def middleware(server, msg, path, query, context, cache, *args):
+        '''Middleware to check the IDs against the invalid IDs cache.'''
+        if query and query.get('applicationId', None):
+            invalid_ids = invalid_ids_cache(cache)
+            app_id = query['applicationId']
+            content_id = query.get('contentId', None)
+            invalid = (invalid_ids.lookup((app_id, None)) or
+                       (invalid_ids.lookup((app_id, content_id))
+                        if content_id is not None else None))
+
+            if invalid is not None:
+                domain, code, message, detail = invalid
+                respond_if_error_set(msg,
+                                     GLib.Error(message, domain, code),
+                                     detail=detail)
+                return None
+
+        return handler(server, msg, path, query, context, cache, *args)
+
+    return middleware
+
+
 def compose_middlewares(*middlewares):
     '''Compose middlewares from right to left.
 
@@ -93,6 +216,37 @@ def handle_404_middleware(expected_path):
     return _apply
 
 
+def cache_control_policy_for_path(path, policies):
+    '''Get the Cache-Control policy in :policies: for the route at :path:.
+
+    Returns None if the route has no policy.
+    '''
+    return policies.get(path.rsplit('/', 1)[-1], None)
+
+
+def cache_control_middleware(policy):
+    '''Middleware function to send a Cache-Control :policy: with responses.
+
+    The header is set before the route is invoked, since responses
+    are sent asynchronously. Error responses replace it with no-store,
+    so that the device does not keep showing an error once it has been
+    fixed. If :policy: is None, no header is sent.
+    '''
+    def _apply(handler):
+        '''Apply middleware to the handler.'''
+        def _handler(server, msg, *args):
+            '''Middleware function.'''
+            if policy is not None:
+                msg.get_property('response-headers').replace('Cache-Control',
+                                                             policy)
+
+            return handler(server, msg, *args)
+
+        return _handler
+
+    return _apply
+
+
 def cancellability_middleware(handler):
     '''Middleware function to add cancellability to a request.
 
@@ -136,16 +290,12 @@ def require_query_string_param(param):
             '''Middleware to check the query parameters.'''
             rectified_query = query or {}
             if not rectified_query.get(param, None):
-                return json_response(msg, {
-                    'status': 'error',
-                    'error': serialize_error_as_json_object(
-                        EosCompanionAppService.error_quark(),
-                        EosCompanionAppService.Error.INVALID_REQUEST,
-                        detail={
-                            'missing_querystring_param': param
-                        }
-                    )
-                })
+                return error_response(msg,
+                                      EosCompanionAppService.error_quark(),
+                                      EosCompanionAppService.Error.INVALID_REQUEST,
+                                      detail={
+                                          'missing_querystring_param': param
+                                      })
 
             return handler(server, msg, path, rectified_query, *args)
         return middleware
@@ -0,0 +1,183 @@
+# /eoscompanion/mustache.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''A minimal compiler for the mustache templates shipped with the service.
+
+Only the subset of mustache used by our own templates is supported:
+variables ({{name}} and {{{name}}}), the implicit iterator ({{.}}),
+sections ({{#name}}...{{/name}}) and inverted sections
+({{^name}}...{{/name}}). Standalone section tags are removed along with
+their line, as the mustache specification requires.
+'''
+
+from html import escape
+
+import re
+
+from gi.repository import (
+    EosCompanionAppService,
+    Gio,
+    GLib
+)
+
+
+_RE_STANDALONE_SECTION_TAG = re.compile(r'^[ \t]*(\{\{[#^/][^}]+\}\})[ \t]*\n',
+                                        re.MULTILINE)
+_RE_TAG = re.compile(r'\{\{\{\s*(?P<raw>[^}]+?)\s*\}\}\}|'
+                     r'\{\{(?P<sigil>[#^/]?)\s*(?P<name>[^}]+?)\s*\}\}')
+
+
+def _template_error(message):
+    '''Create a GLib.Error for a template that cannot be compiled.'''
+    return GLib.Error(message,
+                      GLib.quark_to_string(EosCompanionAppService.error_quark()),
+                      EosCompanionAppService.Error.FAILED)
+
+
+def _lookup(name, context):
+    '''Look up :name: in the stack of :context: values, innermost first.'''
+    if name == '.':
+        return context[-1]
+
+    for value in reversed(context):
+        if isinstance(value, dict) and name in value:
+            return value[name]
+
+    return ''
+
+
+def _compile_parts(template, position, section_name):
+    '''Compile :template: from :position: into a list of render functions.
+
+    Returns the render functions and the position after the end of
+    the section called :section_name:, or the end of the template if
+    :section_name: is None.
+    '''
+    parts = []
+
+    while True:
+        match = _RE_TAG.search(template, position)
+
+        if match is None:
+            if section_name is not None:
+                raise _template_error('Unclosed section {}'.format(section_name))
+
+            literal = template[position:]
+            parts.append(lambda context, literal=literal: literal)
+            return parts, len(template)
+
+        literal = template[position:match.start()]
+        parts.append(lambda context, literal=literal: literal)
+        position = match.end()
+
+        if match.group('raw') is not None:
+            name = match.group('raw')
+            parts.append(lambda context, name=name: str(_lookup(name, context)))
+        elif match.group('sigil') == '#':
+            name = match.group('name')
+            section_parts, position = _compile_parts(template, position, name)
+            parts.append(_section(name, section_parts))
+        elif match.group('sigil') == '^':
+            name = match.group('name')
+            section_parts, position = _compile_parts(template, position, name)
+            parts.append(_inverted_section(name, section_parts))
+        elif match.group('sigil') == '/':
+            if match.group('name') != section_name:
+                raise _template_error('Unexpected end of section {}'.format(
+                    match.group('name')
+                ))
+
+            return parts, position
+        else:
+            name = match.group('name')
+            parts.append(lambda context, name=name: escape(str(_lookup(name, context))))
+
+
+def _render_parts(parts, context):
+    '''Render each of :parts: in :context: and join them.'''
+    return ''.join([part(context) for part in parts])
+
+
+def _section(name, parts):
+    '''Create a render function for the section :name: made up of :parts:.'''
+    def _render(context):
+        '''Render the section once per item, once, or not at all.'''
+        value = _lookup(name, context)
+
+        if isinstance(value, (list, tuple)):
+            return ''.join([
+                _render_parts(parts, context + [item]) for item in value
+            ])
+
+        if value:
+            return _render_parts(parts, context + [value])
+
+        return ''
+
+    return _render
+
+
+def _inverted_section(name, parts):
+    '''Create a render function for the inverted section :name: made up of :parts:.'''
+    def _render(context):
+        '''Render the section once if the value is false or empty.'''
+        if _lookup(name, context):
+            return ''
+
+        return _render_parts(parts, context)
+
+    return _render
+
+
+def compile_mustache_template(template):
+    '''Compile :template: into a function that renders it.
+
+    The returned function takes a dictionary of variables and returns
+    the rendered document as a string. GLib.Error is raised if a section
+    is not closed or a section is closed that was not open.
+    '''
+    parts, _ = _compile_parts(_RE_STANDALONE_SECTION_TAG.sub(r'\1', template),
+                              0,
+                              None)
+
+    return lambda variables: _render_parts(parts, [variables])
+
+
+def compiled_resource_template_closure(resource_path):
+    '''Create a function that returns the compiled template at :resource_path:.
+
+    The template is loaded from the registered GResources and compiled on
+    the first call only. GLib.Error is raised if it could not be loaded
+    or compiled.
+    '''
+    compiled = None
+
+    def _compiled_template():
+        '''Get the compiled template, loading it if necessary.'''
+        nonlocal compiled
+
+        if compiled is None:
+            template_bytes = Gio.resources_lookup_data(resource_path,
+                                                       Gio.ResourceLookupFlags.NONE)
+            compiled = compile_mustache_template(
+                EosCompanionAppService.bytes_to_string(template_bytes)
+            )
+
+        return compiled
+
+    return _compiled_template
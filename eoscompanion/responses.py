@@ -18,6 +18,8 @@
 # All rights reserved.
 '''Response handling functions eoscompanion.'''
 
+import gzip
+import hashlib
 import json
 
 from gi.repository import (
@@ -27,6 +29,8 @@ from gi.repository import (
     Soup
 )
 
+from .compression import accepts_gzip, set_compression_headers
+
 
 def serialize_error_as_json_object(domain, code, detail=None):
     '''Serialize a GLib.Error as a JSON object.'''
@@ -37,12 +41,31 @@ def serialize_error_as_json_object(domain, code, detail=None):
     }
 
 
+# JSON responses are built synchronously, so they are compressed inline
+# at the fastest level, and only if they are large enough to benefit.
+_JSON_COMPRESSION_MIN_SIZE = 1024
+_JSON_COMPRESSION_LEVEL = 1
+
+
 def json_response(msg, obj):
-    '''Respond with a JSON object'''
+    '''Respond with a JSON object, compressed if the client accepts it.'''
     msg.set_status(Soup.Status.OK)
+    payload = json.dumps(obj)
+
+    if (len(payload) >= _JSON_COMPRESSION_MIN_SIZE and
+            accepts_gzip(msg.get_property('request-headers'))):
+        compressed = gzip.compress(payload.encode('utf-8'),
+                                   compresslevel=_JSON_COMPRESSION_LEVEL)
+        EosCompanionAppService.set_soup_message_response_bytes(msg,
+                                                               'application/json',
+                                                               GLib.Bytes.new(compressed))
+        set_compression_headers(msg, 'application/json', True)
+        return
+
     EosCompanionAppService.set_soup_message_response(msg,
                                                      'application/json',
-                                                     json.dumps(obj))
+                                                     payload)
+    set_compression_headers(msg, 'application/json', False)
 
 
 def html_response(msg, html):
@@ -76,9 +99,15 @@ def custom_response(msg, content_type, content_bytes):
                                                            content_bytes)
 
 
+def set_no_store(msg):
+    '''Tell the client not to cache the response to :msg:.'''
+    msg.get_property('response-headers').replace('Cache-Control', 'no-store')
+
+
 def error_response(msg, domain, code, detail=None):
     '''Respond with an error with status code 200.'''
     msg.set_status(Soup.Status.OK)
+    set_no_store(msg)
     error = serialize_error_as_json_object(
         domain,
         code,
@@ -93,6 +122,7 @@ def error_response(msg, domain, code, detail=None):
 def not_found_response(msg, path):
     '''Respond with an error message and 404.'''
     msg.set_status(Soup.Status.NOT_FOUND)
+    set_no_store(msg)
     error = serialize_error_as_json_object(
         EosCompanionAppService.error_quark(),
         EosCompanionAppService.Error.INVALID_REQUEST,
@@ -108,6 +138,83 @@ def not_found_response(msg, path):
                                                      }))
 
 
+def format_etag(*parts):
+    '''Format a strong ETag from :parts:, which identify a response body.
+
+    Every part is converted to a string, so the parts should only be
+    things like paths, content IDs, sizes and modification times.
+    '''
+    digest = hashlib.sha1('\0'.join([str(part) for part in parts]).encode('utf-8'))
+    return '"{}"'.format(digest.hexdigest())
+
+
+def format_etag_for_bytes(content_bytes):
+    '''Format a strong ETag from the GLib.Bytes making up a response body.'''
+    return '"{}"'.format(hashlib.sha1(content_bytes.get_data()).hexdigest())
+
+
+def _if_none_match_matches(if_none_match, etag):
+    '''Check whether the If-None-Match header value matches :etag:.
+
+    If-None-Match uses the weak comparison function, so a weak version
+    of :etag: matches as well.
+    '''
+    return any([
+        candidate in ('*', etag, 'W/' + etag)
+        for candidate in [c.strip() for c in if_none_match.split(',')]
+    ])
+
+
+def is_not_modified(request_headers, etag, last_modified=None):
+    '''Check whether the client already has the response identified by :etag:.
+
+    :last_modified: is the modification time of the response body in
+    seconds since the epoch, or None if it is not known. As required by
+    RFC 7232, If-Modified-Since is only considered if the request
+    does not have an If-None-Match header.
+    '''
+    if_none_match = request_headers.get_list('If-None-Match')
+
+    if if_none_match is not None:
+        return _if_none_match_matches(if_none_match, etag)
+
+    if_modified_since = request_headers.get_one('If-Modified-Since')
+
+    if last_modified is None or if_modified_since is None:
+        return False
+
+    since = Soup.Date.new_from_string(if_modified_since)
+    return since is not None and int(last_modified) <= since.to_time_t()
+
+
+def set_cache_validators(msg, etag, last_modified=None):
+    '''Set the ETag and Last-Modified response headers on :msg:.'''
+    response_headers = msg.get_property('response-headers')
+    response_headers.replace('ETag', etag)
+
+    if last_modified is not None:
+        response_headers.replace(
+            'Last-Modified',
+            Soup.Date.new_from_time_t(int(last_modified)).to_string(Soup.DateFormat.HTTP)
+        )
+
+
+def respond_not_modified_if_fresh(msg, etag, last_modified=None):
+    '''Respond with 304 Not Modified and return True if the client is up to date.
+
+    Otherwise return False. This should be checked before doing any
+    expensive work to create the response body.
+    '''
+    if not is_not_modified(msg.get_property('request-headers'),
+                           etag,
+                           last_modified):
+        return False
+
+    set_cache_validators(msg, etag, last_modified)
+    msg.set_status(Soup.Status.NOT_MODIFIED)
+    return True
+
+
 def generate_error_mappings(error_mappings=None):
     '''Yield a three tuple of src_domain, src_code, target_code.
 
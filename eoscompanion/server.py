@@ -23,7 +23,10 @@ import logging
 from gi.repository import Soup
 
 from .middlewares import (
+    DEFAULT_CACHE_CONTROL_POLICIES,
     application_hold_middleware,
+    cache_control_middleware,
+    cache_control_policy_for_path,
     cache_middleware,
     compose_middlewares,
     cancellability_middleware,
@@ -34,8 +37,13 @@ from .routes import create_companion_app_routes
 def create_companion_app_webserver(application,
                                    cache,
                                    content_db_conn,
-                                   middlewares=None):
-    '''Create a HTTP server with companion app routes.'''
+                                   middlewares=None,
+                                   cache_control_policies=None):
+    '''Create a HTTP server with companion app routes.
+
+    :cache_control_policies: maps route names to Cache-Control header
+    values, see DEFAULT_CACHE_CONTROL_POLICIES.
+    '''
     def _on_request_aborted(server, msg, *args):
         '''Signal handler for when a request is aborted.
 
@@ -54,6 +62,9 @@ def create_companion_app_webserver(application,
         cancellable.cancel()
 
 
+    if cache_control_policies is None:
+        cache_control_policies = DEFAULT_CACHE_CONTROL_POLICIES
+
     server = Soup.Server()
     for path, handler in create_companion_app_routes(content_db_conn).items():
         server.add_handler(
@@ -61,6 +72,10 @@ def create_companion_app_webserver(application,
             compose_middlewares(cache_middleware(cache),
                                 cancellability_middleware,
                                 handle_404_middleware(path),
+                                cache_control_middleware(
+                                    cache_control_policy_for_path(path,
+                                                                  cache_control_policies)
+                                ),
                                 application_hold_middleware(application),
                                 *(middlewares or []),
                                 handler)
@@ -18,13 +18,22 @@
 # All rights reserved.
 '''Service class for eoscompanion.'''
 
+import logging
+
 from gi.repository import (
     EosCompanionAppService,
     Gio,
+    GLib,
     GObject
 )
 
+from .caching import clear_python_subcaches
+from .ekn_content_adjuster import (
+    mobile_wrapper_resource_uris,
+    prewarm_templates
+)
 from .server import create_companion_app_webserver
+from .v1_routes import prewarm_file_bodies
 
 
 def yield_monitors_over_changed_file_in_paths(paths, callback):
@@ -36,11 +45,12 @@ def yield_monitors_over_changed_file_in_paths(paths, callback):
         yield monitor
 
 
-def configure_drop_cache_on_changes(cache):
+def configure_drop_cache_on_changes(cache, content_db_conn=None):
     '''Configure :cache: to be dropped when the Flatpak installation state changes.
 
     This creates a Gio.FileMonitor over each of the configured Flatpak
-    installations on the system and drops all caches when they change.
+    installations on the system and drops all caches when they change. If
+    :content_db_conn: is set, its caches will be dropped as well.
 
     Note that we cannot use the Flatpak API here directly as we are running
     from within Flatpak. We are relying on an internal implementation
@@ -52,6 +62,10 @@ def configure_drop_cache_on_changes(cache):
         del args
 
         cache.clear()
+        clear_python_subcaches(cache)
+
+        if content_db_conn is not None:
+            content_db_conn.clear_cache()
 
     return list(
         yield_monitors_over_changed_file_in_paths(
@@ -61,6 +75,17 @@ def configure_drop_cache_on_changes(cache):
     )
 
 
+def _prewarm_on_idle(cache):
+    '''Prewarm templates and the resources articles link to, logging any errors.'''
+    try:
+        prewarm_templates()
+    except GLib.Error as error:
+        logging.warning('Could not prewarm templates: %s', error)
+
+    prewarm_file_bodies(cache, mobile_wrapper_resource_uris())
+    return False
+
+
 class CompanionAppService(GObject.Object):
     '''A container object for the services.'''
 
@@ -70,6 +95,7 @@ class CompanionAppService(GObject.Object):
                  content_db_query,
                  *args,
                  middlewares=None,
+                 cache_control_policies=None,
                  **kwargs):
         '''Initialize the service and create webserver on port.
 
@@ -79,6 +105,8 @@ class CompanionAppService(GObject.Object):
                                                 callback: GAsyncReadyCallback)
                            which can be used by a route to query a content
                            database of some sort for an app_id.
+        :cache_control_policies: maps route names to Cache-Control
+                                 header values, overriding the defaults.
 
         '''
         super().__init__(*args, **kwargs)
@@ -88,15 +116,22 @@ class CompanionAppService(GObject.Object):
         # We want to listen right away as we'll probably be started by
         # socket activation
         self._cache = EosCompanionAppService.ManagedCache()
-        self._monitors = configure_drop_cache_on_changes(self._cache)
+        self._monitors = configure_drop_cache_on_changes(self._cache,
+                                                         content_db_query)
         self._server = create_companion_app_webserver(application,
                                                       self._cache,
                                                       content_db_query,
-                                                      middlewares=middlewares)
+                                                      middlewares=middlewares,
+                                                      cache_control_policies=cache_control_policies)
         EosCompanionAppService.soup_server_listen_on_sd_fd_or_port(self._server,
                                                                    port,
                                                                    0)
 
+        # Compile templates and load the resources that articles link
+        # to once we are listening, so that the first article request
+        # does not have to.
+        GLib.idle_add(_prewarm_on_idle, self._cache)
+
     def stop(self):
         '''Close all connections and de-initialise.
 
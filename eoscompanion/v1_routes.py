@@ -18,7 +18,9 @@
 # All rights reserved.
 '''V1 route definitions for eos-companion-app-service.'''
 
+import base64
 from collections import namedtuple
+import heapq
 import itertools
 import json
 import logging
@@ -36,23 +38,44 @@ from gi.repository import (
 
 from .applications_query import (
     application_listing_from_app_info,
-    list_all_applications
+    list_all_applications,
+    load_application_icon_async
+)
+from .caching import LRUCache, python_subcache
+from .compression import (
+    compress_bytes_cached_async,
+    gzip_etag,
+    negotiated_etag,
+    set_compression_headers,
+    should_compress
 )
 from .content_streaming import (
     conditionally_wrap_blob_stream,
     conditionally_wrap_stream,
-    define_content_range_from_headers_and_size
+    define_content_range_from_headers_and_size,
+    define_multiple_content_ranges_from_headers_and_size,
+    format_multipart_byteranges,
+    read_stream_ranges_async
 )
 from .ekn_content_adjuster import (
-    EknContentAdjuster
+    EknContentAdjuster,
+    device_uuid_placeholder_query,
+    rendered_article_key,
+    splice_device_uuid
 )
 from .ekn_data import (
-    BYTE_CHUNK_SIZE,
     LOAD_FROM_ENGINE_NO_SUCH_CONTENT,
+    chunk_size_for_content_size,
+    load_content_metadata_from_shards_async,
     load_record_blob_from_shards,
-    load_record_from_shards_async
+    locate_uncompressed_record_data_in_shards,
+    shard_routes_cache,
+    shards_identity
+)
+from .ekn_query import (
+    ascertain_application_sets_from_models,
+    load_set_catalogue
 )
-from .ekn_query import ascertain_application_sets_from_models
 from .format import (
     format_app_icon_uri,
     format_thumbnail_uri,
@@ -67,15 +90,21 @@ from .middlewares import (
     add_content_db_conn,
     apply_version_to_all_routes,
     record_metric,
+    reject_known_invalid_ids,
+    remember_and_respond_if_error_set,
     require_query_string_param
 )
 from .responses import (
     custom_response,
     error_response,
+    format_etag,
     json_response,
     not_found_response,
     png_response,
-    respond_if_error_set
+    respond_if_error_set,
+    respond_not_modified_if_fresh,
+    set_cache_validators,
+    set_no_store
 )
 
 
@@ -106,45 +135,63 @@ _CONTENT_ADJUSTERS = {
 }
 
 
-def _get_file_size_and_stream(file_handle, cancellable, callback):
-    '''Query the file size and get a stream for it.
+def _query_file_size_and_modified_time(file_handle, cancellable, callback):
+    '''Query the file size and modification time without opening the file.
 
     This is used by the functions below to work out what the file
-    size is so that it can be streamed properly.
+    size is so that it can be streamed properly, and whether the
+    client already has an up to date copy. The modification time
+    is None if the file does not have one, which is the case
+    for GResources.
     '''
-    def _on_read_stream(_, read_result):
-        '''Callback for once we have the read stream.'''
-        def _on_queried_info(src, query_info_result):
-            '''Callback for once we're done querying file info.'''
-            try:
-                file_info = src.query_info_finish(query_info_result)
-            except GLib.Error as error:
-                callback(error, None)
-                return
+    def _on_queried_info(src, query_info_result):
+        '''Callback for once we're done querying file info.'''
+        try:
+            file_info = src.query_info_finish(query_info_result)
+        except GLib.Error as error:
+            callback(error, None)
+            return
+
+        modified_time = (
+            file_info.get_attribute_uint64(Gio.FILE_ATTRIBUTE_TIME_MODIFIED)
+            if file_info.has_attribute(Gio.FILE_ATTRIBUTE_TIME_MODIFIED)
+            else None
+        )
+        callback(None, (file_info.get_size(), modified_time))
 
-            callback(None, (input_stream, file_info.get_size()))
+    file_handle.query_info_async(attributes=','.join([
+                                     Gio.FILE_ATTRIBUTE_STANDARD_SIZE,
+                                     Gio.FILE_ATTRIBUTE_TIME_MODIFIED
+                                 ]),
+                                 flags=Gio.FileQueryInfoFlags.NONE,
+                                 io_priority=GLib.PRIORITY_DEFAULT,
+                                 cancellable=cancellable,
+                                 callback=_on_queried_info)
 
+
+def _read_file_stream(file_handle, cancellable, callback):
+    '''Open a stream to read :file_handle:, returning it to the callback.'''
+    def _on_read_stream(_, read_result):
+        '''Callback for once we have the read stream.'''
         try:
             input_stream = file_handle.read_finish(read_result)
         except GLib.Error as error:
             callback(error, None)
             return
 
-        input_stream.query_info_async(attributes=Gio.FILE_ATTRIBUTE_STANDARD_SIZE,
-                                      io_priority=GLib.PRIORITY_DEFAULT,
-                                      cancellable=cancellable,
-                                      callback=_on_queried_info)
+        callback(None, input_stream)
 
     file_handle.read_async(io_priority=GLib.PRIORITY_DEFAULT,
                            cancellable=cancellable,
                            callback=_on_read_stream)
 
 
-def _stream_to_bytes(stream, cancellable, callback):
+def _stream_to_bytes(stream, size, cancellable, callback):
     '''Take a GInputStream and convert it to a GBytes returning result to the callback.
 
     This is a simple wrapper to convert load_all_in_stream_to_bytes
-    into a node-style callback.
+    into a node-style callback. :size: is the expected size of the
+    stream, if known.
     '''
     def _callback(_, result):
         '''Called when we get the stream.'''
@@ -157,7 +204,7 @@ def _stream_to_bytes(stream, cancellable, callback):
         callback(None, content_bytes)
 
     EosCompanionAppService.load_all_in_stream_to_bytes(stream,
-                                                       chunk_size=BYTE_CHUNK_SIZE,
+                                                       chunk_size=chunk_size_for_content_size(size),
                                                        cancellable=cancellable,
                                                        callback=_callback)
 
@@ -170,12 +217,226 @@ def _wrapped_stream_to_bytes_handler(cancellable, callback):
             callback(wrapped_stream_error, None)
             return
 
-        stream, _ = wrapped_stream_result
-        _stream_to_bytes(stream, cancellable, callback)
+        stream, size = wrapped_stream_result
+        _stream_to_bytes(stream, size, cancellable, callback)
 
     return _wrapped_stream_callback
 
 
+def _respond_with_body(server,
+                       msg,
+                       content_type,
+                       content_bytes,
+                       cache,
+                       compressed_key,
+                       etag,
+                       modified_time=None):
+    '''Respond to :msg: with :content_bytes:, compressed if the client accepts it.
+
+    The compressed body is cached under :compressed_key:, which must
+    identify :content_bytes: exactly, or None if it should not be cached.
+    :etag: is the ETag from negotiated_etag, or None.
+    '''
+    def _send(error, body_bytes, compressed):
+        '''Send :body_bytes: to the client.'''
+        if respond_if_error_set(msg, error):
+            server.unpause_message(msg)
+            return
+
+        custom_response(msg, content_type, body_bytes)
+        set_compression_headers(msg, content_type, compressed)
+
+        if etag is not None:
+            set_cache_validators(msg, etag, modified_time)
+
+        server.unpause_message(msg)
+
+    if should_compress(msg.get_property('request-headers'), content_type):
+        compress_bytes_cached_async(cache,
+                                    compressed_key,
+                                    content_bytes,
+                                    msg.cancellable,
+                                    lambda error, compressed_bytes: _send(error,
+                                                                          compressed_bytes,
+                                                                          True))
+        return
+
+    _send(None, content_bytes, False)
+
+
+# The same few scripts, stylesheets and licenses are requested along
+# with every article, so keep the bodies of /resource and /license
+# responses in memory rather than reading and adjusting them each time.
+_FILE_BODIES_MAX_SIZE = 8 * 1024 * 1024
+
+
+def file_bodies_cache(cache):
+    '''Get the cache of /resource and /license bodies attached to :cache:.
+
+    The cache maps the keys made by file_body_key to tuples of the size
+    and modification time of the file when it was read, and the body
+    as GLib.Bytes. Adjusted bodies have the deviceUUID placeholder in
+    place of the deviceUUID.
+    '''
+    return python_subcache(cache,
+                           'file-bodies',
+                           lambda: LRUCache(max_size=_FILE_BODIES_MAX_SIZE,
+                                            size_func=lambda entry: entry[2].get_size()))
+
+
+def file_body_key(uri, adjuster_name, version):
+    '''Get the key for the body of the file at :uri: in the file bodies cache.
+
+    The version only matters if the body is adjusted, since adjusting
+    it rewrites links to other routes.
+    '''
+    return (uri, adjuster_name, version if adjuster_name is not None else None)
+
+
+def _serve_file_body(body_key, body, query):
+    '''Get the bytes to serve for a cached file :body: in response to :query:.'''
+    _, adjuster_name, _ = body_key
+
+    if adjuster_name is None:
+        return body
+
+    return splice_device_uuid(body.get_data(), query['deviceUUID'])
+
+
+def lookup_file_body(cache, body_key, file_size, modified_time, query):
+    '''Look up the bytes to serve for a file body in response to :query:.
+
+    Returns None if the body is not cached, or if the file has
+    changed since it was cached.
+    '''
+    entry = file_bodies_cache(cache).lookup(body_key)
+
+    if entry is None:
+        return None
+
+    cached_size, cached_modified_time, body = entry
+
+    if (cached_size, cached_modified_time) != (file_size, modified_time):
+        return None
+
+    return _serve_file_body(body_key, body, query)
+
+
+def _load_file_body(file_handle,
+                    file_size,
+                    content_type,
+                    adjuster,
+                    version,
+                    query,
+                    cache,
+                    cancellable,
+                    callback):
+    '''Read the body of :file_handle:, adjusting it if :adjuster: is set.
+
+    Adjusted bodies are rendered with the deviceUUID placeholder (see
+    device_uuid_placeholder_query), so that they can be cached for
+    every device. The callback gets the body as GLib.Bytes.
+    '''
+    def _on_got_stream(error, input_stream):
+        '''Callback for when we get the stream.'''
+        if error is not None:
+            callback(error, None)
+            return
+
+        if adjuster is None:
+            _stream_to_bytes(input_stream, file_size, cancellable, callback)
+            return
+
+        conditionally_wrap_stream(input_stream,
+                                  file_size,
+                                  content_type,
+                                  version,
+                                  device_uuid_placeholder_query(query),
+                                  adjuster,
+                                  cache,
+                                  cancellable,
+                                  _wrapped_stream_to_bytes_handler(cancellable,
+                                                                   callback))
+
+    _read_file_stream(file_handle, cancellable, _on_got_stream)
+
+
+def _load_and_cache_file_body(file_handle,
+                              body_key,
+                              file_size,
+                              modified_time,
+                              content_type,
+                              adjuster,
+                              version,
+                              query,
+                              cache,
+                              cancellable,
+                              callback):
+    '''Load the body of :file_handle: and insert it into the file bodies cache.
+
+    The callback gets the bytes to serve in response to :query:.
+    '''
+    def _on_loaded_body(error, body):
+        '''Callback for when the body has been loaded.'''
+        if error is not None:
+            callback(error, None)
+            return
+
+        file_bodies_cache(cache).insert(body_key, (file_size, modified_time, body))
+        callback(None, _serve_file_body(body_key, body, query))
+
+    _load_file_body(file_handle,
+                    file_size,
+                    content_type,
+                    adjuster,
+                    version,
+                    query,
+                    cache,
+                    cancellable,
+                    _on_loaded_body)
+
+
+def prewarm_file_bodies(cache, uris):
+    '''Load the unadjusted bodies of the files at :uris: into the cache.
+
+    This is used to load the resources that every article links to
+    before the first article is requested. Errors are only logged.
+    '''
+    def _prewarm_file_body(uri):
+        '''Load the body of the file at :uri:.'''
+        def _on_loaded_body(error, _):
+            '''Log any error.'''
+            if error is not None:
+                logging.debug('Could not prewarm %s: %s', uri, error)
+
+        def _on_queried_file_info(error, file_info_result):
+            '''Callback for when we know the size and modification time.'''
+            if error is not None:
+                _on_loaded_body(error, None)
+                return
+
+            file_size, modified_time = file_info_result
+            _load_and_cache_file_body(file_handle,
+                                      file_body_key(uri, None, None),
+                                      file_size,
+                                      modified_time,
+                                      None,
+                                      None,
+                                      None,
+                                      {},
+                                      cache,
+                                      None,
+                                      _on_loaded_body)
+
+        file_handle = Gio.File.new_for_uri(uri)
+        _query_file_size_and_modified_time(file_handle,
+                                           None,
+                                           _on_queried_file_info)
+
+    for uri in uris:
+        _prewarm_file_body(uri)
+
+
 @require_query_string_param('deviceUUID')
 @require_query_string_param('uri')
 def companion_app_server_resource_route(server,
@@ -220,9 +481,14 @@ def companion_app_server_resource_route(server,
         return
 
     content_adjuster_cls = _CONTENT_ADJUSTERS.get(query.get('adjuster', None), None)
+    adjuster_name = query['adjuster'] if content_adjuster_cls is not None else None
+    body_key = file_body_key(resource_uri, adjuster_name, version)
+    etag = None
+    file_size = None
+    modified_time = None
 
-    def _on_got_wrapped_bytes(error, content_bytes):
-        '''Take the wrapped stream and send it to the client.
+    def _on_got_body(error, content_bytes):
+        '''Send the body to the client.
 
         For now this means reading the entire stream to bytes and
         then sending the bytes payload over. In future we should
@@ -233,36 +499,75 @@ def companion_app_server_resource_route(server,
             server.unpause_message(msg)
             return
 
-        custom_response(msg, return_content_type, content_bytes)
-        server.unpause_message(msg)
+        _respond_with_body(server,
+                           msg,
+                           return_content_type,
+                           content_bytes,
+                           cache,
+                           (body_key,
+                            file_size,
+                            modified_time,
+                            query['deviceUUID'] if adjuster_name is not None else None),
+                           etag,
+                           modified_time)
+
+    def _on_queried_file_info(error, file_info_result):
+        '''Callback for when we know the size and modification time.'''
+        nonlocal etag
+        nonlocal file_size
+        nonlocal modified_time
 
-    def _on_got_stream_and_size(error, on_got_stream_result):
-        '''Callback for when we get the stream and size.'''
         if respond_if_error_set(msg, error):
             server.unpause_message(msg)
             return
 
-        input_stream, file_size = on_got_stream_result
-        if content_adjuster_cls is not None:
-            adjuster = content_adjuster_cls.create_from_resource_query(resource_file.get_path(),
-                                                                       query)
-            conditionally_wrap_stream(input_stream,
-                                      file_size,
-                                      return_content_type,
-                                      version,
-                                      query,
-                                      adjuster,
-                                      cache,
-                                      msg.cancellable,
-                                      _wrapped_stream_to_bytes_handler(msg.cancellable,
-                                                                       _on_got_wrapped_bytes))
+        file_size, modified_time = file_info_result
+
+        # Adjusted resources have links to other routes rewritten for
+        # the API version and deviceUUID, so they are part of the ETag
+        adjusted = content_adjuster_cls is not None
+        etag = format_etag(resource_uri,
+                           file_size,
+                           modified_time,
+                           adjuster_name,
+                           version if adjusted else None,
+                           query['deviceUUID'] if adjusted else None)
+        etag = negotiated_etag(msg.get_property('request-headers'),
+                               return_content_type,
+                               etag)
+
+        if respond_not_modified_if_fresh(msg, etag, modified_time):
+            server.unpause_message(msg)
+            return
+
+        cached_body = lookup_file_body(cache,
+                                       body_key,
+                                       file_size,
+                                       modified_time,
+                                       query)
+
+        if cached_body is not None:
+            _on_got_body(None, cached_body)
             return
 
-        _stream_to_bytes(input_stream, msg.cancellable, _on_got_wrapped_bytes)
+        _load_and_cache_file_body(resource_file,
+                                  body_key,
+                                  file_size,
+                                  modified_time,
+                                  return_content_type,
+                                  (content_adjuster_cls.create_from_resource_query(
+                                      resource_file.get_path(),
+                                      query
+                                  ) if adjusted else None),
+                                  version,
+                                  query,
+                                  cache,
+                                  msg.cancellable,
+                                  _on_got_body)
 
-    _get_file_size_and_stream(resource_file,
-                              msg.cancellable,
-                              _on_got_stream_and_size)
+    _query_file_size_and_modified_time(resource_file,
+                                       msg.cancellable,
+                                       _on_queried_file_info)
     server.pause_message(msg)
 
 
@@ -293,8 +598,13 @@ def companion_app_server_license_route(server,
         not_found_response(msg, path)
         return
 
-    def _on_got_wrapped_bytes(error, content_bytes):
-        '''Take the wrapped stream and send it to the client.
+    body_key = file_body_key(license_file.get_uri(), 'license', version)
+    etag = None
+    file_size = None
+    modified_time = None
+
+    def _on_got_body(error, content_bytes):
+        '''Send the body to the client.
 
         For now this means reading the entire stream to bytes and
         then sending the bytes payload over. In future we should
@@ -305,30 +615,70 @@ def companion_app_server_license_route(server,
             server.unpause_message(msg)
             return
 
-        custom_response(msg, return_content_type, content_bytes)
-        server.unpause_message(msg)
+        _respond_with_body(server,
+                           msg,
+                           return_content_type,
+                           content_bytes,
+                           cache,
+                           (body_key,
+                            file_size,
+                            modified_time,
+                            query['deviceUUID']),
+                           etag,
+                           modified_time)
+
+    def _on_queried_file_info(error, file_info_result):
+        '''Callback for when we know the size and modification time.'''
+        nonlocal etag
+        nonlocal file_size
+        nonlocal modified_time
 
-    def _on_got_stream_and_size(error, on_got_stream_result):
-        '''Callback for when we get the stream and size.'''
         if respond_if_error_set(msg, error):
             server.unpause_message(msg)
             return
 
-        input_stream, file_size = on_got_stream_result
-        conditionally_wrap_stream(input_stream,
+        file_size, modified_time = file_info_result
+
+        # Licenses always have their links rewritten for the API
+        # version and deviceUUID, so they are part of the ETag
+        etag = format_etag(license_file.get_uri(),
+                           file_size,
+                           modified_time,
+                           version,
+                           query['deviceUUID'])
+        etag = negotiated_etag(msg.get_property('request-headers'),
+                               return_content_type,
+                               etag)
+
+        if respond_not_modified_if_fresh(msg, etag, modified_time):
+            server.unpause_message(msg)
+            return
+
+        cached_body = lookup_file_body(cache,
+                                       body_key,
+                                       file_size,
+                                       modified_time,
+                                       query)
+
+        if cached_body is not None:
+            _on_got_body(None, cached_body)
+            return
+
+        _load_and_cache_file_body(license_file,
+                                  body_key,
                                   file_size,
+                                  modified_time,
                                   return_content_type,
+                                  LicenseContentAdjuster(license_file.get_path()),
                                   version,
                                   query,
-                                  LicenseContentAdjuster(license_file.get_path()),
                                   cache,
                                   msg.cancellable,
-                                  _wrapped_stream_to_bytes_handler(msg.cancellable,
-                                                                   _on_got_wrapped_bytes))
+                                  _on_got_body)
 
-    _get_file_size_and_stream(license_file,
-                              msg.cancellable,
-                              _on_got_stream_and_size)
+    _query_file_size_and_modified_time(license_file,
+                                       msg.cancellable,
+                                       _on_queried_file_info)
     server.pause_message(msg)
 
 
@@ -381,17 +731,21 @@ def companion_app_server_list_applications_route(server,
 
 @require_query_string_param('deviceUUID')
 @require_query_string_param('iconName')
-def companion_app_server_application_icon_route(server, msg, path, query, *args):
+def companion_app_server_application_icon_route(server,
+                                                msg,
+                                                path,
+                                                query,
+                                                context,
+                                                cache,
+                                                *args):
     '''Return image/png data with the application icon.'''
     del path
+    del context
     del args
 
-    def _callback(_, result):
+    def _callback(error, icon):
         '''Callback function that gets called when we are done.'''
-        try:
-            image_bytes = EosCompanionAppService.finish_load_application_icon_data_async(result)
-            png_response(msg, image_bytes)
-        except GLib.Error as error:
+        if error is not None:
             json_response(msg, {
                 'status': 'error',
                 'error': {
@@ -402,22 +756,39 @@ def companion_app_server_application_icon_route(server, msg, path, query, *args)
                     }
                 }
             })
+            set_no_store(msg)
+            server.unpause_message(msg)
+            return
+
+        if not respond_not_modified_if_fresh(msg, icon.etag):
+            png_response(msg, icon.image_bytes)
+            set_cache_validators(msg, icon.etag)
+
         server.unpause_message(msg)
 
     logging.debug('Get application icon: clientId=%s, iconName=%s',
                   query['deviceUUID'],
                   query['iconName'])
-    EosCompanionAppService.load_application_icon_data_async(query['iconName'],
-                                                            cancellable=msg.cancellable,
-                                                            callback=_callback)
+    load_application_icon_async(cache,
+                                query['iconName'],
+                                msg.cancellable,
+                                _callback)
     server.pause_message(msg)
 
 
 @require_query_string_param('deviceUUID')
 @require_query_string_param('applicationId')
-def companion_app_server_application_colors_route(server, msg, path, query, *args):
+@reject_known_invalid_ids
+def companion_app_server_application_colors_route(server,
+                                                   msg,
+                                                   path,
+                                                   query,
+                                                   context,
+                                                   cache,
+                                                   *args):
     '''Return a list of web-format primary application colors.'''
     del path
+    del context
     del args
 
     def _callback(_, result):
@@ -431,7 +802,7 @@ def companion_app_server_application_colors_route(server, msg, path, query, *arg
                 }
             })
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId']
             })
 
@@ -441,6 +812,7 @@ def companion_app_server_application_colors_route(server, msg, path, query, *arg
                   query['deviceUUID'],
                   query['applicationId'])
     EosCompanionAppService.load_application_colors(query['applicationId'],
+                                                   cache,
                                                    cancellable=msg.cancellable,
                                                    callback=_callback)
     server.pause_message(msg)
@@ -453,6 +825,7 @@ _SENSIBLE_QUERY_LIMIT = 500
 @require_query_string_param('deviceUUID')
 @require_query_string_param('applicationId')
 @record_metric('c02a5764-7f81-48c7-aea4-1413fd4e829c')
+@reject_known_invalid_ids
 def companion_app_server_list_application_sets_route(server,
                                                      msg,
                                                      path,
@@ -497,11 +870,12 @@ def companion_app_server_list_application_sets_route(server,
             return
 
         EosCompanionAppService.load_application_colors(query['applicationId'],
+                                                       cache,
                                                        cancellable=msg.cancellable,
                                                        callback=_on_loaded_application_colors)
 
-    def _on_queried_sets(error, result):
-        '''Callback function that gets called when we are done querying.'''
+    def _on_loaded_set_catalogue(error, catalogue):
+        '''Callback function that gets called when we have the set catalogue.'''
         if respond_if_error_set(msg,
                                 error,
                                 detail={
@@ -510,8 +884,7 @@ def companion_app_server_list_application_sets_route(server,
             server.unpause_message(msg)
             return
 
-        _, models = result
-        ascertain_application_sets_from_models(models,
+        ascertain_application_sets_from_models(catalogue.models[:_SENSIBLE_QUERY_LIMIT],
                                                version,
                                                query['deviceUUID'],
                                                query['applicationId'],
@@ -524,20 +897,17 @@ def companion_app_server_list_application_sets_route(server,
         try:
             app_info = EosCompanionAppService.finish_load_application_info(result)
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId']
             })
             server.unpause_message(msg)
             return
 
-        application_listing = application_listing_from_app_info(app_info)
-        content_db_conn.query(application_listing,
-                              query={
-                                  'tags-match-all': ['EknSetObject'],
-                                  'limit': _SENSIBLE_QUERY_LIMIT
-                              },
-                              cancellable=msg.cancellable,
-                              callback=_on_queried_sets)
+        load_set_catalogue(content_db_conn,
+                           application_listing_from_app_info(app_info),
+                           cache,
+                           msg.cancellable,
+                           _on_loaded_set_catalogue)
 
 
     logging.debug('List application sets: clientId=%s, applicationId=%s',
@@ -556,6 +926,7 @@ def companion_app_server_list_application_sets_route(server,
 @require_query_string_param('applicationId')
 @require_query_string_param('tags')
 @record_metric('bef3d12c-df9b-43cd-a67c-31abc5361f03')
+@reject_known_invalid_ids
 def companion_app_server_list_application_content_for_tags_route(server,
                                                                  msg,
                                                                  path,
@@ -602,7 +973,7 @@ def companion_app_server_list_application_content_for_tags_route(server,
         try:
             app_info = EosCompanionAppService.finish_load_application_info(result)
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId']
             })
             server.unpause_message(msg)
@@ -659,9 +1030,322 @@ def record_content_data_metric(device_uuid,
                          GLib.Variant('a{ss}', payload))
 
 
+def _splice_stream_to_connection(msg, connection, istream):
+    '''Splice :istream: onto the output stream of :connection: and finish :msg:.'''
+    def on_splice_finished(src, result):
+        '''Callback for when we are done splicing.'''
+        nonlocal msg
+
+        try:
+            src.splice_finish(result)
+        except GLib.Error as splice_error:
+            # Can't really do much here except log server side
+            logging.debug(
+                'Splice operation on file failed: %s', splice_error
+            )
+
+        # In every case, we must mark the message as finished
+        # so that 'finished' signal listeners get invoked
+        # (important to ensure that the application hold count
+        # goes down!)
+        msg.finished()
+
+        # FIXME: This looks strange, but it is very important. It seems
+        # as though accessing `msg` above creates a cyclic reference
+        # since msg itself is an argument to the outer function
+        # and we reference it in the inner function, but the inner
+        # function is referenced by the outer function.
+        #
+        # Unfortunately, failure to finalize this object is a critical
+        # failure for us, since the finalize handler does
+        # things like closing sockets which we only have a finite
+        # pool of. There is no other way to close those sockets
+        # from the libsoup side. Setting this object to None
+        # breaks the reference cycle and allows the object to
+        # be finalized.
+        msg = None
+        return
+
+    ostream = connection.get_output_stream()
+    ostream.splice_async(istream,
+                         Gio.OutputStreamSpliceFlags.CLOSE_TARGET,
+                         GLib.PRIORITY_DEFAULT,
+                         msg.cancellable,
+                         on_splice_finished)
+
+
+def _send_stream_from_offset(server, msg, context, stream, start):
+    '''Skip :start: bytes of :stream:, then splice the rest onto the connection.'''
+    def on_got_offsetted_stream(_, result):
+        '''Use the offsetted stream to stream the rest of the content.'''
+        def on_wrote_headers(_):
+            '''Callback when headers are written.'''
+            _splice_stream_to_connection(msg,
+                                         context.steal_connection(),
+                                         istream)
+
+        # Now that we have the offseted stream, we can continue writing
+        # the message body and insert our spliced stream in place
+        istream = EosCompanionAppService.finish_fast_skip_stream(result)
+        msg.connect('wrote-headers', on_wrote_headers)
+
+        server.unpause_message(msg)
+
+    EosCompanionAppService.fast_skip_stream_async(stream,
+                                                  start,
+                                                  msg.cancellable,
+                                                  on_got_offsetted_stream)
+
+
+def _send_file_range_or_splice(server,
+                               msg,
+                               context,
+                               stream,
+                               start,
+                               length,
+                               record_location):
+    '''Send the data straight from the shard file if possible.
+
+    If the connection does not support it, fall back to seeking
+    the stream and splicing it, like _send_stream_from_offset.
+    '''
+    def on_send_file_range_finished(send_error):
+        '''Callback for when we are done sending a file range.'''
+        nonlocal msg
+
+        if send_error is not None:
+            logging.debug(
+                'Send operation on file failed: %s', send_error
+            )
+
+        # See _splice_stream_to_connection, the same applies here
+        msg.finished()
+        msg = None
+
+    def on_wrote_headers(_):
+        '''Callback when headers are written.'''
+        def on_skipped_stream(_, result):
+            '''Splice the offsetted stream onto the connection.'''
+            try:
+                istream = EosCompanionAppService.finish_fast_skip_stream(result)
+            except GLib.Error as skip_error:
+                # The headers have already been written, so
+                # the best we can do is to close the connection
+                # early, which the client will see as an error.
+                connection.close(None)
+                on_send_file_range_finished(skip_error)
+                return
+
+            _splice_stream_to_connection(msg, connection, istream)
+
+        def on_sent_file_range(_, result):
+            '''Fall back to splicing if sending is not supported.'''
+            try:
+                EosCompanionAppService.finish_send_file_range_to_connection(result)
+            except GLib.Error as send_error:
+                if send_error.matches(Gio.io_error_quark(),
+                                      Gio.IOErrorEnum.NOT_SUPPORTED):
+                    # Nothing has been sent yet, so we can still
+                    # send the stream instead.
+                    EosCompanionAppService.fast_skip_stream_async(
+                        stream,
+                        start,
+                        msg.cancellable,
+                        on_skipped_stream
+                    )
+                    return
+
+                on_send_file_range_finished(send_error)
+                return
+
+            on_send_file_range_finished(None)
+
+        connection = context.steal_connection()
+        shard_path, data_offset = record_location
+        EosCompanionAppService.send_file_range_to_connection_async(
+            connection,
+            shard_path,
+            data_offset + start,
+            length,
+            msg.cancellable,
+            on_sent_file_range
+        )
+
+    msg.connect('wrote-headers', on_wrote_headers)
+    server.unpause_message(msg)
+
+
+def _respond_with_multiple_ranges(server,
+                                  msg,
+                                  content_type,
+                                  stream,
+                                  total_content_size,
+                                  ranges):
+    '''Respond with a multipart/byteranges body for :ranges: of stream.'''
+    def on_read_ranges(error, chunks):
+        '''Callback for when all the ranges have been read.'''
+        if respond_if_error_set(msg, error):
+            server.unpause_message(msg)
+            return
+
+        multipart_content_type, body = format_multipart_byteranges(
+            content_type,
+            total_content_size,
+            ranges,
+            chunks
+        )
+
+        # As with a single range, Accept-Ranges is only sent in
+        # response to a Range request and the Content-Range for
+        # each range goes in its part of the body.
+        response_headers = msg.get_property('response-headers')
+        response_headers.replace('Accept-Ranges', 'bytes')
+        msg.set_status(Soup.Status.PARTIAL_CONTENT)
+        EosCompanionAppService.set_soup_message_response_bytes(msg,
+                                                               multipart_content_type,
+                                                               GLib.Bytes.new(body))
+        server.unpause_message(msg)
+
+    read_stream_ranges_async(stream,
+                             ranges,
+                             msg.cancellable,
+                             on_read_ranges)
+
+
+def _respond_with_stream(server,
+                         msg,
+                         context,
+                         content_type,
+                         stream,
+                         total_content_size,
+                         locate_record_data):
+    '''Respond with the requested range of :stream:, or all of it.
+
+    :locate_record_data: is a function which returns where the data
+    is stored in the shard file on disk, or None if it must be read
+    through :stream:.
+    '''
+    response_headers = msg.get_property('response-headers')
+    request_headers = msg.get_property('request-headers')
+
+    # Some media players ask for several ranges at once. If we
+    # can, send them all back in one multipart/byteranges
+    # response, otherwise just send the first one.
+    multiple_ranges = define_multiple_content_ranges_from_headers_and_size(
+        request_headers,
+        total_content_size
+    )
+
+    if multiple_ranges is not None:
+        _respond_with_multiple_ranges(server,
+                                      msg,
+                                      content_type,
+                                      stream,
+                                      total_content_size,
+                                      multiple_ranges)
+        return
+
+    start, end, length = define_content_range_from_headers_and_size(request_headers,
+                                                                    total_content_size)
+
+    # Note that the length we set here is the number of bytes that will
+    # be contained in the payload, but this is different from the
+    # 'total' that is sent in the Content-Range header
+    #
+    # Essentially, it is end - start + 1, taking into account the
+    # requirements for the end marker below.
+    response_headers.set_content_length(length)
+    response_headers.set_content_type(content_type)
+
+    # If we did not get a Range header, then we do not want to set
+    # Content-Range, nor do we want to respond with PARTIAL_CONTENT as
+    # the status code. If we do that, browsers like Firefox will
+    # handle it fine, but Chrome and VLC just choke. Note that we
+    # not even want to send Accept-Ranges unless the
+    # requested a Range.
+    if request_headers.get_one('Range'):
+        response_headers.replace('Accept-Ranges', 'bytes')
+
+        # The format of this must be
+        #
+        #   'bytes start-end/total'
+        #
+        # The 'end' marker must be one byte less than 'total' and
+        # all bytes up to 'end' must be sent by the implementation.
+        # Browsers like Chrome will, upon seeking, attempt to load
+        # last 6524 bytes of the stream and won't continue until all of
+        # those bytes have been sent by the client (at which point
+        # it actually loads from the correct place).
+        response_headers.replace(
+            'Content-Range',
+            'bytes {start}-{end}/{total}'.format(start=start,
+                                                 end=end,
+                                                 total=total_content_size)
+        )
+        msg.set_status(Soup.Status.PARTIAL_CONTENT)
+    else:
+        msg.set_status(Soup.Status.OK)
+
+    record_location = locate_record_data()
+
+    if record_location is not None:
+        _send_file_range_or_splice(server,
+                                   msg,
+                                   context,
+                                   stream,
+                                   start,
+                                   length,
+                                   record_location)
+        return
+
+    _send_stream_from_offset(server, msg, context, stream, start)
+
+
+def _set_content_data_headers(msg, version, query, content_metadata):
+    '''Set the headers that do not depend on how the content is sent.'''
+    response_headers = msg.get_property('response-headers')
+    response_headers.replace('Connection', 'keep-alive')
+
+    # Add the article thumbnail uri to the header
+    # we only want to add the image when it is content
+    # from a Wikipedia or Wikihow source
+    thumbnail_uri = content_metadata.get('thumbnail', None)
+    is_wiki_source = content_metadata.get('source', None) in ('wikipedia', 'wikihow')
+    if thumbnail_uri is not None and is_wiki_source:
+        formatted_thumbnail_uri = format_thumbnail_uri(version,
+                                                       query['applicationId'],
+                                                       thumbnail_uri,
+                                                       query['deviceUUID'])
+        response_headers.replace('X-Endless-Article-Thumbnail', formatted_thumbnail_uri)
+
+
+def _content_data_etag(shards, query, version, needs_adjustment, compress):
+    '''Get the ETag for content from :shards:, or None if it has none.
+
+    Shard files are never modified once installed, so the
+    content is identified by the shards it comes from. Adjusted
+    content also has links rewritten for the API version and
+    deviceUUID. If the shards cannot be identified, do not send
+    an ETag at all.
+    '''
+    identity = shards_identity(shards)
+
+    if identity is None:
+        return None
+
+    etag_parts = [identity, query['contentId']]
+
+    if needs_adjustment:
+        etag_parts += [version, query['deviceUUID']]
+
+    etag = format_etag(*etag_parts)
+    return gzip_etag(etag) if compress else etag
+
+
 @require_query_string_param('deviceUUID')
 @require_query_string_param('applicationId')
 @require_query_string_param('contentId')
+@reject_known_invalid_ids
 def companion_app_server_content_data_route(server,
                                             msg,
                                             path,
@@ -698,85 +1382,98 @@ def companion_app_server_content_data_route(server,
 
     def _on_got_shards_callback(shards_error, shards):
         '''Callback for when we receive the shards for an application.'''
-        def _on_got_metadata_callback(load_metadata_error, metadata_bytes):
+        def _on_got_metadata_callback(load_metadata_error, content_metadata):
             '''Callback function that gets called when we got the metadata.
 
             From here we can figure out what the content type is and load
             accordingly.
             '''
-            def on_splice_finished(src, result):
-                '''Callback for when we are done splicing.'''
-                nonlocal msg
-
-                try:
-                    src.splice_finish(result)
-                except GLib.Error as splice_error:
-                    # Can't really do much here except log server side
-                    logging.debug(
-                        'Splice operation on file failed: %s', splice_error
+            def _on_got_adjusted_bytes(error, adjusted_bytes):
+                '''Send the whole adjusted content, compressed.'''
+                if respond_if_error_set(msg, error):
+                    server.unpause_message(msg)
+                    return
+
+                rendered_key = rendered_article_key(version, query, shards)
+                _set_content_data_headers(msg, version, query, content_metadata)
+                _respond_with_body(server,
+                                   msg,
+                                   content_type,
+                                   adjusted_bytes,
+                                   cache,
+                                   ((rendered_key, query['deviceUUID'])
+                                    if rendered_key is not None else None),
+                                   etag)
+
+            def _locate_record_data():
+                '''Find the data in the shard files if it can be sent from there.
+
+                Content that does not need adjustment and is stored
+                uncompressed can be sent straight from the shard file,
+                without copying it through userspace.
+                '''
+                if needs_adjustment:
+                    return None
+
+                return locate_uncompressed_record_data_in_shards(
+                    shards,
+                    query['contentId'],
+                    routes=shard_routes_cache(cache)
+                )
+
+            def _on_got_wrapped_stream(error, result):
+                '''Take the wrapped stream, then go to an offset in it.
+
+                Note that this is not a GAsyncReadyCallback, we instead get
+                a tuple of an error or a stream and length.
+                '''
+                if respond_if_error_set(msg, error):
+                    logging.warning(
+                        'Stream wrapping failed %s', error
                     )
+                    server.unpause_message(msg)
+                    return
 
-                # In every case, we must mark the message as finished
-                # so that 'finished' signal listeners get invoked
-                # (important to ensure that the application hold count
-                # goes down!)
-                msg.finished()
-
-                # FIXME: This looks strange, but it is very important. It seems
-                # as though accessing `msg` above creates a cyclic reference
-                # since msg itself is an argument to the outer function
-                # and we reference it in the inner function, but the inner
-                # function is referenced by the outer function.
-                #
-                # Unfortunately, failure to finalize this object is a critical
-                # failure for us, since the finalize handler does
-                # things like closing sockets which we only have a finite
-                # pool of. There is no other way to close those sockets
-                # from the libsoup side. Setting this object to None
-                # breaks the reference cycle and allows the object to
-                # be finalized.
-                msg = None
-                return
+                stream, total_content_size = result
 
-            def on_got_offsetted_stream(_, result):
-                '''Use the offsetted stream to stream the rest of the content.'''
-                def on_wrote_headers(_):
-                    '''Callback when headers are written.'''
-                    stream = context.steal_connection()
-                    ostream = stream.get_output_stream()
-                    ostream.splice_async(istream,
-                                         Gio.OutputStreamSpliceFlags.CLOSE_TARGET,
-                                         GLib.PRIORITY_DEFAULT,
-                                         msg.cancellable,
-                                         on_splice_finished)
-
-                # Now that we have the offseted stream, we can continue writing
-                # the message body and insert our spliced stream in place
-                istream = EosCompanionAppService.finish_fast_skip_stream(result)
-                msg.connect('wrote-headers', on_wrote_headers)
+                # Now that we have the stream, we can post back with how big the
+                # content is
+                _set_content_data_headers(msg, version, query, content_metadata)
 
-                server.unpause_message(msg)
+                if etag is not None:
+                    set_cache_validators(msg, etag)
+
+                if needs_adjustment:
+                    set_compression_headers(msg, content_type, False)
+
+                _respond_with_stream(server,
+                                     msg,
+                                     context,
+                                     content_type,
+                                     stream,
+                                     total_content_size,
+                                     _locate_record_data)
 
             # If an error occurred, return it now
-            if respond_if_error_set(msg,
-                                    load_metadata_error,
-                                    detail={
-                                        'applicationId': query['applicationId'],
-                                        'contentId': query['contentId'],
-                                    }):
+            if remember_and_respond_if_error_set(msg,
+                                                 cache,
+                                                 query,
+                                                 load_metadata_error,
+                                                 detail={
+                                                     'applicationId': query['applicationId'],
+                                                     'contentId': query['contentId'],
+                                                 }):
                 server.unpause_message(msg)
                 return
 
-            # Now that we have the metadata, deserialize it and use the
-            # contentType hint to figure out the best way to load it.
-            content_metadata = json.loads(
-                EosCompanionAppService.bytes_to_string(metadata_bytes)
-            )
+            # Now that we have the metadata, use the contentType hint
+            # to figure out the best way to load it.
             content_type = content_metadata['contentType']
 
             blob_result, blob = load_record_blob_from_shards(shards,
                                                              query['contentId'],
-                                                             'data')
+                                                             'data',
+                                                             routes=shard_routes_cache(cache))
             if blob_result == LOAD_FROM_ENGINE_NO_SUCH_CONTENT:
                 # No corresponding record found, EKN ID must have been invalid,
                 # though it was valid for metadata...
@@ -792,85 +1489,6 @@ def companion_app_server_content_data_route(server,
                 server.unpause_message(msg)
                 return
 
-            def _on_got_wrapped_stream(error, result):
-                '''Take the wrapped stream, then go to an offset in it.
-
-                Note that this is not a GAsyncReadyCallback, we instead get
-                a tuple of an error or a stream and length.
-                '''
-                if respond_if_error_set(msg, error):
-                    logging.warning(
-                        'Stream wrapping failed %s', error
-                    )
-                    server.unpause_message(msg)
-                    return
-
-                stream, total_content_size = result
-
-                # Now that we have the stream, we can post back with how big the
-                # content is
-                response_headers = msg.get_property('response-headers')
-                request_headers = msg.get_property('request-headers')
-
-                start, end, length = define_content_range_from_headers_and_size(request_headers,
-                                                                                total_content_size)
-
-                # Note that the length we set here is the number of bytes that will
-                # be contained in the payload, but this is different from the
-                # 'total' that is sent in the Content-Range header
-                #
-                # Essentially, it is end - start + 1, taking into account the
-                # requirements for the end marker below.
-                response_headers.set_content_length(length)
-                response_headers.set_content_type(content_type)
-                response_headers.replace('Connection', 'keep-alive')
-
-                # Add the article thumbnail uri to the header
-                # we only want to add the image when it is content
-                # from a Wikipedia or Wikihow source
-                thumbnail_uri = content_metadata.get('thumbnail', None)
-                is_wiki_source = content_metadata.get('source', None) in ('wikipedia', 'wikihow')
-                if thumbnail_uri is not None and is_wiki_source:
-                    formatted_thumbnail_uri = format_thumbnail_uri(version,
-                                                                   query['applicationId'],
-                                                                   thumbnail_uri,
-                                                                   query['deviceUUID'])
-                    response_headers.replace('X-Endless-Article-Thumbnail', formatted_thumbnail_uri)
-
-                # If we did not get a Range header, then we do not want to set
-                # Content-Range, nor do we want to respond with PARTIAL_CONTENT as
-                # the status code. If we do that, browsers like Firefox will
-                # handle it fine, but Chrome and VLC just choke. Note that we
-                # not even want to send Accept-Ranges unless the
-                # requested a Range.
-                if request_headers.get_one('Range'):
-                    response_headers.replace('Accept-Ranges', 'bytes')
-
-                    # The format of this must be
-                    #
-                    #   'bytes start-end/total'
-                    #
-                    # The 'end' marker must be one byte less than 'total' and
-                    # all bytes up to 'end' must be sent by the implementation.
-                    # Browsers like Chrome will, upon seeking, attempt to load
-                    # last 6524 bytes of the stream and won't continue until all of
-                    # those bytes have been sent by the client (at which point
-                    # it actually loads from the correct place).
-                    response_headers.replace(
-                        'Content-Range',
-                        'bytes {start}-{end}/{total}'.format(start=start,
-                                                             end=end,
-                                                             total=total_content_size)
-                    )
-                    msg.set_status(Soup.Status.PARTIAL_CONTENT)
-                else:
-                    msg.set_status(Soup.Status.OK)
-
-                EosCompanionAppService.fast_skip_stream_async(stream,
-                                                              start,
-                                                              msg.cancellable,
-                                                              on_got_offsetted_stream)
-
             # Report a metric now
             record_content_data_metric(query['deviceUUID'],
                                        query['applicationId'],
@@ -878,39 +1496,56 @@ def companion_app_server_content_data_route(server,
                                        content_type,
                                        query.get('referrer', None))
 
+            # Adjusted content is already in memory, so it is compressed
+            # if the client accepts it. Anything else is streamed.
+            needs_adjustment = EknContentAdjuster.needs_adjustment(content_type)
+            compress = needs_adjustment and should_compress(msg.get_property('request-headers'),
+                                                            content_type)
+            etag = _content_data_etag(shards, query, version, needs_adjustment, compress)
+
+            if etag is not None and respond_not_modified_if_fresh(msg, etag):
+                server.unpause_message(msg)
+                return
+
             # Need to conditionally wrap the blob in another stream
             # depending on whether it needs to be converted.
+            adjuster = EknContentAdjuster(content_metadata,
+                                          content_db_conn,
+                                          shards)
             conditionally_wrap_blob_stream(blob,
                                            content_type,
                                            version,
                                            query,
-                                           EknContentAdjuster(content_metadata,
-                                                              content_db_conn,
-                                                              shards),
+                                           adjuster,
                                            cache,
                                            msg.cancellable,
-                                           _on_got_wrapped_stream)
-
-        if respond_if_error_set(msg,
-                                shards_error,
-                                detail={
-                                    'applicationId': query['applicationId'],
-                                    'contentId': query['contentId'],
-                                }):
+                                           (_wrapped_stream_to_bytes_handler(msg.cancellable,
+                                                                             _on_got_adjusted_bytes)
+                                            if compress else _on_got_wrapped_stream))
+
+        if remember_and_respond_if_error_set(msg,
+                                             cache,
+                                             query,
+                                             shards_error,
+                                             detail={
+                                                 'applicationId': query['applicationId'],
+                                                 'contentId': query['contentId'],
+                                             }):
             server.unpause_message(msg)
             return
 
-        load_record_from_shards_async(shards,
-                                      query['contentId'],
-                                      'metadata',
-                                      _on_got_metadata_callback)
+        load_content_metadata_from_shards_async(shards,
+                                                query['applicationId'],
+                                                query['contentId'],
+                                                cache,
+                                                _on_got_metadata_callback)
 
     def _on_got_application_info(_, result):
         '''Callback function that gets called when we get the app info.'''
         try:
             app_info = EosCompanionAppService.finish_load_application_info(result)
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId'],
                 'message': str(error)
             })
@@ -945,6 +1580,7 @@ def app_id_to_runtime_version(app_id):
 @require_query_string_param('applicationId')
 @require_query_string_param('contentId')
 @record_metric('3a4eff55-5d01-48c8-a827-fca5732fd767')
+@reject_known_invalid_ids
 def companion_app_server_content_metadata_route(server,
                                                 msg,
                                                 path,
@@ -960,21 +1596,22 @@ def companion_app_server_content_metadata_route(server,
 
     def _on_got_shards_callback(shards_error, shards):
         '''Callback function that gets called when we get our shards.'''
-        def _on_got_metadata_callback(load_metadata_error, metadata_bytes):
+        def _on_got_metadata_callback(load_metadata_error, metadata_json):
             '''Callback function that gets called when we are done.'''
-            if respond_if_error_set(msg,
-                                    load_metadata_error,
-                                    detail={
-                                        'applicationId': query['applicationId'],
-                                    },
-                                    error_mappings={
-                                        # pylint: disable=line-too-long
-                                        (Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND): EosCompanionAppService.Error.INVALID_APP_ID
-                                    }):
+            if remember_and_respond_if_error_set(msg,
+                                                 cache,
+                                                 query,
+                                                 load_metadata_error,
+                                                 detail={
+                                                     'applicationId': query['applicationId'],
+                                                 },
+                                                 error_mappings={
+                                                     # pylint: disable=line-too-long
+                                                     (Gio.io_error_quark(), Gio.IOErrorEnum.NOT_FOUND): EosCompanionAppService.Error.INVALID_APP_ID
+                                                 }):
                 server.unpause_message(msg)
                 return
 
-            metadata_json = json.loads(EosCompanionAppService.bytes_to_string(metadata_bytes))
             metadata_json['version'] = app_id_to_runtime_version(
                 EosCompanionAppService.get_runtime_spec_for_app_id(
                     query['applicationId'],
@@ -988,19 +1625,22 @@ def companion_app_server_content_metadata_route(server,
             })
             server.unpause_message(msg)
 
-        if respond_if_error_set(msg,
-                                shards_error,
-                                detail={
-                                    'applicationId': query['applicationId'],
-                                    'contentId': query['contentId']
-                                }):
+        if remember_and_respond_if_error_set(msg,
+                                             cache,
+                                             query,
+                                             shards_error,
+                                             detail={
+                                                 'applicationId': query['applicationId'],
+                                                 'contentId': query['contentId']
+                                             }):
             server.unpause_message(msg)
             return
 
-        load_record_from_shards_async(shards,
-                                      query['contentId'],
-                                      'metadata',
-                                      _on_got_metadata_callback)
+        load_content_metadata_from_shards_async(shards,
+                                                query['applicationId'],
+                                                query['contentId'],
+                                                cache,
+                                                _on_got_metadata_callback)
 
 
     def _on_got_application_info(_, result):
@@ -1008,7 +1648,7 @@ def companion_app_server_content_metadata_route(server,
         try:
             app_info = EosCompanionAppService.finish_load_application_info(result)
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId']
             })
             server.unpause_message(msg)
@@ -1090,7 +1730,19 @@ def render_result_payload_for_content(version, app_id, model, device_uuid):
     }
 
 
+def render_result_payload_for_application(version, app_id, model, device_uuid):
+    '''Render a result payload for an application whose name matched.'''
+    del version
+    del model
+    del device_uuid
+
+    return {
+        'applicationId': app_id
+    }
+
+
 _MODEL_PAYLOAD_RENDERER_FOR_TYPE = {
+    'application': render_result_payload_for_application,
     'set': render_result_payload_for_set,
     'content': render_result_payload_for_content
 }
@@ -1121,8 +1773,356 @@ def search_models_from_application_models(application_models):
                           model_payload_renderer=model_payload_renderer)
 
 
+def search_models_from_application_names(app_ids, display_names):
+    '''Yield a SearchModel for each application in app_ids.
+
+    :display_names: maps application IDs to their display names.
+    '''
+    for app_id in app_ids:
+        yield SearchModel(app_id=app_id,
+                          display_name=display_names[app_id],
+                          model=None,
+                          model_type='application',
+                          model_payload_renderer=render_result_payload_for_application)
+
+
+def render_search_result(version, search_model, device_uuid):
+    '''Render a single entry in the results of a search.'''
+    return {
+        'displayName': search_model.display_name,
+        'payload': search_model.model_payload_renderer(version,
+                                                       search_model.app_id,
+                                                       search_model.model,
+                                                       device_uuid),
+        'type': search_model.model_type
+    }
+
+
+def merge_search_models_by_display_name(runs):
+    '''Merge the lists of SearchModel in :runs: in order of display name.
+
+    Each run is sorted on its own, then the sorted runs are merged
+    lazily, so taking a slice of the result only looks at the entries
+    up to the end of the slice. Entries with the same display name keep
+    the order of :runs:, as they would with a stable sort of all the
+    entries together.
+    '''
+    return heapq.merge(*[
+        sorted(run, key=lambda m: m.display_name) for run in runs
+    ], key=lambda m: m.display_name)
+
+
+def take_search_models_page(runs, limit):
+    '''Take the next page of up to :limit: SearchModel from :runs:.
+
+    Unlike merge_search_models_by_display_name, the runs are not sorted
+    first. Each run is consumed in its own order, so that what is taken
+    from each run is always a prefix of it and can be recorded as
+    a cursor. The runs are merged on the display name of the next entry
+    in each run, then the page itself is sorted by display name.
+
+    Returns the page and a list of the number of entries taken from
+    each run.
+    '''
+    def _indexed_run(index, run):
+        '''Pair each entry in :run: with the :index: of the run.'''
+        return ((index, m) for m in run)
+
+    taken = [0 for run in runs]
+    page = []
+
+    for index, search_model in itertools.islice(
+            heapq.merge(*[_indexed_run(i, run) for i, run in enumerate(runs)],
+                        key=lambda indexed: indexed[1].display_name),
+            limit
+    ):
+        taken[index] += 1
+        page.append(search_model)
+
+    return sorted(page, key=lambda m: m.display_name), taken
+
+
+def encode_search_continuation_token(search_params, applications_taken, cursors):
+    '''Encode the state of a paginated search as an opaque string.
+
+    :search_params: identifies the search the token belongs to,
+    :applications_taken: is the number of matching application names
+    which have been served already and :cursors: maps the ID of each
+    application that may have more results to the number of its results
+    which have been served already.
+    '''
+    return base64.urlsafe_b64encode(json.dumps({
+        'q': search_params,
+        'a': applications_taken,
+        'c': cursors
+    }).encode('utf-8')).decode('ascii')
+
+
+def decode_search_continuation_token(token, search_params):
+    '''Decode a token from encode_search_continuation_token.
+
+    Returns a tuple of the number of application names served already
+    and the cursors for each application. Raises ValueError if the
+    token is malformed or belongs to a search with other parameters
+    than :search_params:.
+    '''
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except ValueError as error:
+        raise ValueError('Malformed continuation token') from error
+
+    if not isinstance(state, dict) or state.get('q', None) != search_params:
+        raise ValueError('Continuation token does not match the search parameters')
+
+    applications_taken = state.get('a', None)
+    cursors = state.get('c', None)
+
+    if (not isinstance(applications_taken, int) or applications_taken < 0 or
+            not isinstance(cursors, dict) or
+            not all(isinstance(c, int) and c >= 0 for c in cursors.values())):
+        raise ValueError('Malformed continuation token')
+
+    return applications_taken, cursors
+
+
+SearchPaginationState = namedtuple('SearchPaginationState',
+                                   'search_params applications_taken cursors')
+
+
+def search_pagination_state(continuation_token, search_params, limit, offset):
+    '''Get the SearchPaginationState of a search with :continuation_token:.
+
+    Searches are only paginated if the client passes a continuationToken,
+    which is empty for the first page. Returns None if the search is not
+    paginated. The cursors are None on the first page. Raises ValueError
+    if the token cannot be used.
+    '''
+    if continuation_token is None:
+        return None
+
+    if limit is None or offset is not None:
+        raise ValueError('"continuationToken" requires "limit" and cannot '
+                         'be used with "offset"')
+
+    if not continuation_token:
+        return SearchPaginationState(search_params, 0, None)
+
+    return SearchPaginationState(search_params,
+                                 *decode_search_continuation_token(continuation_token,
+                                                                   search_params))
+
+
+def search_model_runs(matched_application_ids,
+                      applications,
+                      model_runs,
+                      applications_taken):
+    '''Get the runs of SearchModel that a page of search results is taken from.
+
+    The first run has the names of the applications in
+    :matched_application_ids:, the others have the models in each of
+    :model_runs:. If :applications_taken: is not None, the search is
+    paginated, so the application names are sorted and the ones which
+    were served already are skipped.
+    '''
+    # We need to construct an in-memory hashtable of application
+    # IDs to names to at least get nlogn lookup
+    applications_hashtable = {
+        a.app_id: a.display_name for a in applications
+    }
+
+    if applications_taken is not None:
+        matched_application_ids = sorted(
+            matched_application_ids,
+            key=lambda app_id: (applications_hashtable[app_id], app_id)
+        )
+
+    application_run = list(search_models_from_application_names(matched_application_ids,
+                                                                applications_hashtable))
+
+    return [application_run[applications_taken or 0:]] + [
+        list(search_models_from_application_models(run))
+        for run in model_runs
+    ]
+
+
+def take_search_continuation_page(runs,
+                                  searched_app_ids,
+                                  failed_app_ids,
+                                  limit,
+                                  pagination_state):
+    '''Take the next page of a search paginated with continuation tokens.
+
+    :runs: is a list with the SearchModel for the matching application
+    names which have not been served yet, followed by a list of SearchModel
+    for each application in :searched_app_ids:. Each application was
+    searched from its cursor, so the page is taken from the start of each
+    run and the cursors are moved past what was taken. Applications in
+    :failed_app_ids: keep their cursor, so that they are searched again
+    for the next page.
+
+    Returns the page, the number of results that were found but not
+    taken and the token for the next page, or None if there are no
+    more results.
+    '''
+    cursors = pagination_state.cursors or {}
+    page, taken = take_search_models_page(runs, limit)
+    next_cursors = {
+        app_id: cursors.get(app_id, 0) + run_taken
+        for app_id, run, run_taken in zip(searched_app_ids, runs[1:], taken[1:])
+        # If an application filled its window, it may have more results
+        if run_taken < len(run) or len(run) >= limit
+    }
+    next_cursors.update({
+        app_id: cursors.get(app_id, 0) for app_id in failed_app_ids
+    })
+    remaining = sum(len(run) for run in runs) - len(page)
+    next_token = (
+        encode_search_continuation_token(pagination_state.search_params,
+                                         pagination_state.applications_taken + taken[0],
+                                         next_cursors)
+        if next_cursors or taken[0] < len(runs[0]) else None
+    )
+
+    return page, remaining, next_token
+
+
+def take_search_slice(runs, limit, offset):
+    '''Take up to :limit: SearchModel from :runs:, starting at :offset:.
+
+    The runs are merged in order of display name. Only the results
+    within the slice are kept, everything else is just counted.
+    Returns the slice and the number of results that did not fit
+    within :limit:.
+    '''
+    # An 'end' of None here essentially means that the list will not
+    # be truncated. This is the choice if limit is set to None
+    start = offset if offset is not None else 0
+    end = start + limit if limit is not None else None
+
+    search_models = list(itertools.islice(
+        merge_search_models_by_display_name(runs),
+        start,
+        end
+    ))
+    total_results = sum(len(run) for run in runs)
+    remaining = max(0, total_results - limit) if limit is not None else 0
+
+    return search_models, remaining
+
+
+def render_search_payload(version,
+                          device_uuid,
+                          search_models,
+                          matched_application_ids,
+                          applications,
+                          remaining):
+    '''Render the payload of a search response.
+
+    The results are :search_models:. Each application in :applications:
+    that has a result, or whose name matched the search term, is also
+    rendered in the "applications" section of the payload.
+    '''
+    # Determine which applications were seen in the truncated model
+    # set or if their name matched the search query and then include
+    # them in the results list
+    seen_application_ids = set(itertools.chain.from_iterable([[
+        m.app_id
+        for m in search_models
+        if m.model_type != 'application'
+    ], [app_id for app_id in matched_application_ids]]))
+    relevant_applications = [
+        a for a in applications if a.app_id in seen_application_ids
+    ]
+
+    return {
+        'remaining': remaining,
+        'applications': [
+            {
+                'applicationId': a.app_id,
+                'displayName': a.display_name,
+                'shortDescription': a.short_description,
+                'icon': format_app_icon_uri(version,
+                                            a.icon,
+                                            device_uuid),
+                'language': a.language
+            }
+            for a in relevant_applications
+        ],
+        'results': [
+            render_search_result(version, m, device_uuid)
+            for m in search_models
+        ]
+    }
+
+
+def search_application_names(search_term, applications):
+    '''Get the IDs of :applications: whose name matches :search_term:.
+
+    The g_desktop_app_info_search function will search all applications
+    using an in-memory index according to its own internal criteria. The
+    returned arrays will be arrays of applications which each have
+    identical scores. Since we don't actually know what the scores
+    are, just chain all the arrays together and fold them into
+    a set. Finally, we only care about content applications, so
+    take the intersection between the returned results.
+    '''
+    matched_application_ids = set([
+        desktop_id[:desktop_id.rfind('.desktop')] for desktop_id in
+        itertools.chain.from_iterable(Gio.DesktopAppInfo.search(search_term))
+    ]) if search_term else set([])
+    matched_application_ids &= set(
+        a.app_id for a in applications
+    )
+
+    return matched_application_ids
+
+
+def collect_search_results(applications, search_results):
+    '''Collect the models from the :search_results: for each of :applications:.
+
+    :search_results: is a list of (error, result) tuples in the same order
+    as :applications:. FAILED is a non-fatal error, since it indicates
+    something wrong with the app or content itself. We just log on those
+    errors and continue the search. Other errors are due to invalid
+    arguments from the caller which should be reported back.
+
+    Returns a tuple of the first error which should be reported, or None,
+    and a tuple of a list with a list of ApplicationModel for each
+    application that was searched, the IDs of those applications and
+    the IDs of the applications that failed.
+    '''
+    model_runs = []
+    searched_app_ids = []
+    failed_app_ids = []
+
+    for application, (error, result) in zip(applications, search_results):
+        if error is not None:
+            if not error.matches(EosCompanionAppService.error_quark(),
+                                 EosCompanionAppService.Error.FAILED):
+                return error, (None, None, None)
+
+            logging.warning(
+                "Encountered error searching application %s: %s",
+                application.app_id,
+                error.message
+            )
+            failed_app_ids.append(application.app_id)
+            continue
+
+        _, models = result
+        searched_app_ids.append(application.app_id)
+        model_runs.append([
+            ApplicationModel(app_id=application.app_id,
+                             model=m)
+            for m in models
+        ])
+
+    return None, (model_runs, searched_app_ids, failed_app_ids)
+
+
 @require_query_string_param('deviceUUID')
 @record_metric('9f06d0f7-677e-43ca-b732-ccbb40847a31')
+@reject_known_invalid_ids
 def companion_app_server_search_content_route(server,
                                               msg,
                                               path,
@@ -1145,24 +2145,30 @@ def companion_app_server_search_content_route(server,
              returned by /list_application_sets],
     “limit”: [machine readable limit integer, default 50],
     “offset”: [machine readable offset integer, default 0],
-    “searchTerm”: [search term, string]
+    “searchTerm”: [search term, string],
+    “continuationToken”: [opaque string, empty for the first page,
+                          then returned by the previous page]
+
+    If a continuationToken is given along with a limit, the response has
+    a continuationToken which can be passed to get the next page, or null
+    if there are no more results.
     '''
     del path
     del context
 
-    def _on_received_results_list(models,
+    def _on_received_results_list(model_runs,
+                                  searched_app_ids,
+                                  failed_app_ids,
                                   matched_application_ids,
                                   applications,
                                   global_limit,
                                   global_offset):
         '''Called when we receive all models as a part of this search.
 
-        truncated_models_for_applications should be a list of
-        ApplicationModel.
-
-        truncated_models_for_applications is guaranteed to be truncated to
-        "limit", if one was specified and offsetted by "offset", if one was
-        specified, at this point.
+        model_runs should be a list with a list of ApplicationModel
+        for each application that was searched and searched_app_ids
+        the ID of the application for each of them. failed_app_ids
+        are the IDs of the applications which could not be searched.
 
         matched_application_ids is a list of application IDs
         for which the application name actually matched the search term.
@@ -1170,87 +2176,42 @@ def companion_app_server_search_content_route(server,
         applications should be a list of ApplicationListing, which is
         all applications that should be included in the "applications"
         section of the response.
-
-        remaining is the number of models which have not been served as a
-        part of this query.
         '''
-        # An 'end' of None here essentially means that the list will not
-        # be truncated. This is the choice if global_limit is set to None
-        start = global_offset if global_offset is not None else 0
-        end = start + global_limit if global_limit is not None else None
-
-        # We need to construct an in-memory hashtable of application
-        # IDs to names to at least get nlogn lookup
-        applications_hashtable = {
-            a.app_id: a.display_name for a in applications
-        }
-
-        # all_results is the application names that matched the search term,
-        # plus all the models that matched the search term
-        all_results = sorted(list(itertools.chain.from_iterable([
-            [
-                {
-                    'displayName': applications_hashtable[app_id],
-                    'payload': {
-                        'applicationId': app_id
-                    },
-                    'type': 'application'
-                }
-                for app_id in matched_application_ids
-            ],
-            [
-                {
-                    'displayName': display_name,
-                    'payload': model_payload_renderer(version,
-                                                      app_id,
-                                                      model,
-                                                      query['deviceUUID']),
-                    'type': model_type
-                }
-                for app_id, display_name, model, model_type, model_payload_renderer in
-                search_models_from_application_models(
-                    models
-                )
-            ]
-        ])), key=lambda r: r['displayName'])
-
-        # Determine which applications were seen in the truncated model
-        # set or if their name matched the search query and then include
-        # them in the results list
-        truncated_results = all_results[start:end]
-
-        seen_application_ids = set(itertools.chain.from_iterable([[
-            r['payload']['applicationId']
-            for r in truncated_results
-            if r['type'] != 'application'
-        ], [app_id for app_id in matched_application_ids]]))
-        relevant_applications = [
-            a for a in applications if a.app_id in seen_application_ids
-        ]
+        # The results are the application names that matched the search
+        # term, plus all the models that matched the search term, in order
+        # of display name.
+        runs = search_model_runs(matched_application_ids,
+                                 applications,
+                                 model_runs,
+                                 (pagination_state.applications_taken
+                                  if pagination_state is not None else None))
+
+        if pagination_state is not None:
+            truncated_search_models, remaining, next_token = take_search_continuation_page(
+                runs,
+                searched_app_ids,
+                failed_app_ids,
+                limit,
+                pagination_state
+            )
+        else:
+            truncated_search_models, remaining = take_search_slice(runs,
+                                                                   global_limit,
+                                                                   global_offset)
 
-        remaining = (
-            max(0, len(all_results) - global_limit)
-            if global_limit is not None else 0
-        )
+        payload = render_search_payload(version,
+                                        query['deviceUUID'],
+                                        truncated_search_models,
+                                        matched_application_ids,
+                                        applications,
+                                        remaining)
+
+        if pagination_state is not None:
+            payload['continuationToken'] = next_token
 
         json_response(msg, {
             'status': 'ok',
-            'payload': {
-                'remaining': remaining,
-                'applications': [
-                    {
-                        'applicationId': a.app_id,
-                        'displayName': a.display_name,
-                        'shortDescription': a.short_description,
-                        'icon': format_app_icon_uri(version,
-                                                    a.icon,
-                                                    query['deviceUUID']),
-                        'language': a.language
-                    }
-                    for a in relevant_applications
-                ],
-                'results': truncated_results
-            }
+            'payload': payload
         })
         server.unpause_message(msg)
 
@@ -1269,59 +2230,23 @@ def companion_app_server_search_content_route(server,
 
             Examine the result of every search call for errors and if so,
             immediately return the error to the client. Otherwise, take all
-            the models and marshal them into a single list, truncated by the
-            search limit and pass to _on_received_results_list.
+            the models for each application and pass them to
+            _on_received_results_list.
             '''
-            all_models = []
-
-            for index, args_tuple in enumerate(search_results):
-                error, result = args_tuple
-
-                if error is not None:
-                    # FAILED is a non-fatal error, since it indicates
-                    # something wrong with the app or content itself. We just
-                    # log on those errors and continue the search. Other
-                    # errors are due to invalid arguments from the caller
-                    # which should be reported back.
-                    if not error.matches(EosCompanionAppService.error_quark(),
-                                         EosCompanionAppService.Error.FAILED):
-                        respond_if_error_set(msg, error)
-                        server.unpause_message(msg)
-                        return
-                    else:
-                        logging.warning(
-                            "Encountered error searching application %s: %s",
-                            applications[index].app_id,
-                            error.message
-                        )
-                        continue
-
-                _, models = result
-                all_models.extend([
-                    ApplicationModel(app_id=applications[index].app_id,
-                                     model=m)
-                    for m in models
-                ])
-
-
-            # Search for applications. The g_desktop_app_info_search function
-            # will search all applications using an in-memory index
-            # according to its own internal criteria. The returned
-            # arrays will be arrays of applications which each have
-            # identical scores. Since we don't actually know what the scores
-            # are, just chain all the arrays together and fold them into
-            # a set. Finally, we only care about content applications, so
-            # take the intersection between the returned results
-            matched_application_ids = set([
-                desktop_id[:desktop_id.rfind('.desktop')] for desktop_id in
-                itertools.chain.from_iterable(Gio.DesktopAppInfo.search(search_term))
-            ]) if search_term else set([])
-            matched_application_ids &= set(
-                a.app_id for a in applications
-            )
+            error, (model_runs,
+                    searched_app_ids,
+                    failed_app_ids) = collect_search_results(applications,
+                                                             search_results)
+
+            if respond_if_error_set(msg, error):
+                server.unpause_message(msg)
+                return
 
-            _on_received_results_list(all_models,
-                                      matched_application_ids,
+            _on_received_results_list(model_runs,
+                                      searched_app_ids,
+                                      failed_app_ids,
+                                      search_application_names(search_term,
+                                                               applications),
                                       applications,
                                       global_limit,
                                       global_offset)
@@ -1351,6 +2276,8 @@ def companion_app_server_search_content_route(server,
         :local_limit: refers to the per-application content limit.
         :local_offset: refers to the offset within each application.
         '''
+        cursors = pagination_state.cursors if pagination_state is not None else None
+
         def _search_application_thunk(application):
             '''Partially applied function to search a single application.
 
@@ -1360,11 +2287,20 @@ def companion_app_server_search_content_route(server,
             '''
             def _thunk(callback):
                 '''Thunk that gets called.'''
+                # When continuing a paginated search, applications without
+                # a cursor have no more results, the others continue from
+                # their cursor.
+                if cursors is not None and application.app_id not in cursors:
+                    callback(None, (None, []))
+                    return None
+
                 return search_single_application(content_db_conn,
                                                  application_listing=application,
                                                  tags=tags,
                                                  limit=local_limit,
-                                                 offset=local_offset,
+                                                 offset=(cursors[application.app_id]
+                                                         if cursors is not None
+                                                         else local_offset),
                                                  search_term=search_term,
                                                  cancellable=msg.cancellable,
                                                  callback=callback)
@@ -1414,7 +2350,7 @@ def companion_app_server_search_content_route(server,
         try:
             info = EosCompanionAppService.finish_load_application_info(result)
         except GLib.Error as error:
-            respond_if_error_set(msg, error, detail={
+            remember_and_respond_if_error_set(msg, cache, query, error, detail={
                 'applicationId': query['applicationId']
             })
             server.unpause_message(msg)
@@ -1435,12 +2371,26 @@ def companion_app_server_search_content_route(server,
     tags = query.get('tags', None)
     limit = query.get('limit', None)
     offset = query.get('offset', None)
+    application_id = query.get('applicationId', None)
+    search_term = query.get('searchTerm', None)
 
     # Convert to int if defined, otherwise keep as None
     try:
         limit = int(limit) if limit else None
         offset = int(offset) if offset else None
         tags = tags.split(';') if tags else None
+
+        if not any([application_id, search_term, tags]):
+            raise ValueError('One of "applicationId", "searchTerm", or "tags" '
+                             'must be specified')
+
+        # Searches with a continuationToken are paginated. Each application
+        # is then only asked for the results after the ones it has already
+        # served, rather than limit + offset results.
+        pagination_state = search_pagination_state(query.get('continuationToken', None),
+                                                   [application_id, tags, search_term, limit],
+                                                   limit,
+                                                   offset)
     except ValueError as error:
         # Client made an invalid request, return now
         error_response(
@@ -1453,20 +2403,6 @@ def companion_app_server_search_content_route(server,
         )
         return
 
-    application_id = query.get('applicationId', None)
-    search_term = query.get('searchTerm', None)
-
-    if not any([application_id, search_term, tags]):
-        error_response(
-            msg,
-            EosCompanionAppService.error_quark(),
-            EosCompanionAppService.Error.INVALID_REQUEST,
-            detail={
-                'message': 'One of "applicationId", "searchTerm", or "tags" must be specified'
-            }
-        )
-        return
-
     # If we got an applicationId, the assumption is that the applicationId
     # should match something so immediately list the contents of that
     # application then marshal it into an ApplicationListing format that
@@ -18,7 +18,8 @@
 # All rights reserved.
 '''V2 route definitions for eos-companion-app-service.'''
 
-from collections import defaultdict
+import base64
+from collections import defaultdict, OrderedDict
 import logging
 import os
 
@@ -30,7 +31,8 @@ from gi.repository import (
 )
 
 from .applications_query import (
-    application_listing_from_app_info
+    application_listing_from_app_info,
+    load_application_icon_async
 )
 from .format import (
     format_app_icon_uri,
@@ -46,6 +48,7 @@ from .middlewares import (
     require_query_string_param
 )
 from .responses import (
+    error_response,
     json_response,
     respond_if_error_set
 )
@@ -502,6 +505,84 @@ def companion_app_server_feed_route(server,
     server.pause_message(msg)
 
 
+# Clients should split larger batches of icons into several requests,
+# since the whole response is built in memory.
+_MAX_APPLICATION_ICONS_PER_REQUEST = 100
+
+
+@require_query_string_param('deviceUUID')
+@require_query_string_param('iconNames')
+def companion_app_server_application_icons_route(server,
+                                                 msg,
+                                                 path,
+                                                 query,
+                                                 context,
+                                                 cache,
+                                                 version):
+    '''Return the PNG data for several application icons at once.
+
+    The querystring param "iconNames" is a semicolon-separated list of
+    icon names. The response maps each icon name to its base64 encoded
+    PNG data, or null if that icon could not be loaded, so that one
+    missing icon does not fail the whole batch.
+    '''
+    del path
+    del context
+    del version
+
+    def _load_application_icon_thunk(icon_name):
+        '''Thunk to load a single icon.'''
+        def _internal(callback):
+            '''Load the icon and pass it to callback.'''
+            load_application_icon_async(cache,
+                                        icon_name,
+                                        msg.cancellable,
+                                        callback)
+
+        return _internal
+
+    def _on_loaded_all_icons(results):
+        '''Called when all the icons have been loaded, or failed to load.'''
+        for icon_name, (error, _) in zip(icon_names, results):
+            if error is not None:
+                logging.debug('Could not load icon %s: %s', icon_name, error)
+
+        json_response(msg, {
+            'status': 'ok',
+            'payload': {
+                icon_name: (
+                    base64.b64encode(icon.image_bytes.get_data()).decode('ascii')
+                    if error is None else None
+                )
+                for icon_name, (error, icon) in zip(icon_names, results)
+            }
+        })
+        server.unpause_message(msg)
+
+    icon_names = list(OrderedDict.fromkeys([
+        icon_name for icon_name in query['iconNames'].split(';') if icon_name
+    ]))
+
+    if not 0 < len(icon_names) <= _MAX_APPLICATION_ICONS_PER_REQUEST:
+        error_response(msg,
+                       EosCompanionAppService.error_quark(),
+                       EosCompanionAppService.Error.INVALID_REQUEST,
+                       detail={
+                           'message': 'Between 1 and {} icon names must be given'.format(
+                               _MAX_APPLICATION_ICONS_PER_REQUEST
+                           )
+                       })
+        return
+
+    logging.debug('Get application icons: clientId=%s, iconNames=%s',
+                  query['deviceUUID'],
+                  icon_names)
+    all_asynchronous_function_calls_closure([
+        _load_application_icon_thunk(icon_name) for icon_name in icon_names
+    ], _on_loaded_all_icons)
+    server.pause_message(msg)
+
+
 def create_companion_app_routes_v2(content_db_conn):
     '''Create fully-applied routes from the passed content_db_conn.
 
@@ -516,6 +597,7 @@ def create_companion_app_routes_v2(content_db_conn):
         '/device_authenticate': companion_app_server_device_authenticate_route,
         '/list_applications': companion_app_server_list_applications_route,
         '/application_icon': companion_app_server_application_icon_route,
+        '/application_icons': companion_app_server_application_icons_route,
         '/application_colors': companion_app_server_application_colors_route,
         '/list_application_sets': add_content_db_conn(
             companion_app_server_list_application_sets_route,
@@ -25,7 +25,11 @@
 #include "eos-companion-app-service-managed-cache-private.h"
 #include "eos-companion-app-integration-helper.h"
 
+#include <errno.h>
+#include <fcntl.h>
 #include <string.h>
+#include <sys/sendfile.h>
+#include <unistd.h>
 
 /* To avoid having to include systemd in the runtime, we can just
  * listen for socket activation file descriptors starting from
@@ -738,30 +742,32 @@ load_application_info (const gchar                         *app_id,
                                                  search_provider_name);
 }
 
+/* Task data for the tasks which look something up about an application
+ * by its name, such as its info or its colors, using a cache. */
 typedef struct {
   gchar                              *name;
   EosCompanionAppServiceManagedCache *cache;
-} LoadApplicationInfoData;
+} ApplicationCacheTaskData;
 
-static LoadApplicationInfoData *
-load_application_info_data_new (const gchar                        *name,
-                                EosCompanionAppServiceManagedCache *cache)
+static ApplicationCacheTaskData *
+application_cache_task_data_new (const gchar                        *name,
+                                 EosCompanionAppServiceManagedCache *cache)
 {
-  LoadApplicationInfoData *load_application_info_data = g_new0 (LoadApplicationInfoData, 1);
+  ApplicationCacheTaskData *data = g_new0 (ApplicationCacheTaskData, 1);
 
-  load_application_info_data->name = g_strdup (name);
-  load_application_info_data->cache = g_object_ref (cache);
+  data->name = g_strdup (name);
+  data->cache = g_object_ref (cache);
 
-  return load_application_info_data;
+  return data;
 }
 
 static void
-load_application_info_data_free (LoadApplicationInfoData *load_application_info_data)
+application_cache_task_data_free (ApplicationCacheTaskData *data)
 {
-  g_clear_pointer (&load_application_info_data->name, g_free);
-  g_clear_object (&load_application_info_data->cache);
+  g_clear_pointer (&data->name, g_free);
+  g_clear_object (&data->cache);
 
-  g_free (load_application_info_data);
+  g_free (data);
 }
 
 static void
@@ -771,7 +777,7 @@ load_application_info_thread (GTask        *task,
                               GCancellable *cancellable)
 {
   g_autoptr(GError) local_error = NULL;
-  LoadApplicationInfoData *load_application_info_data = task_data;
+  ApplicationCacheTaskData *load_application_info_data = task_data;
   g_autoptr(EosCompanionAppServiceAppInfo) info = load_application_info (load_application_info_data->name,
                                                                          load_application_info_data->cache,
                                                                          &local_error);
@@ -796,8 +802,8 @@ eos_companion_app_service_load_application_info (const gchar
 
   g_task_set_return_on_cancel (task, TRUE);
   g_task_set_task_data (task,
-                        load_application_info_data_new (name, cache),
-                        (GDestroyNotify) load_application_info_data_free);
+                        application_cache_task_data_new (name, cache),
+                        (GDestroyNotify) application_cache_task_data_free);
   g_task_run_in_thread (task, load_application_info_thread);
 }
 
@@ -947,6 +953,46 @@ load_colors_for_app_id (const gchar  *app_id,
   return NULL;
 }
 
+#define APPLICATION_COLORS_KEY_NAME "application-colors"
+
+/* Returns a copy of the colors for app_id from the cache, or NULL
+ * if they are not cached. */
+static GStrv
+lookup_application_colors_cache (const gchar                        *app_id,
+                                 EosCompanionAppServiceManagedCache *cache)
+{
+  GHashTable *subcache =
+    eos_companion_app_service_managed_cache_lock_subcache (cache,
+                                                           APPLICATION_COLORS_KEY_NAME,
+                                                           (GDestroyNotify) g_strfreev);
+  GStrv colors = g_strdupv (g_hash_table_lookup (subcache, app_id));
+
+  eos_companion_app_service_managed_cache_unlock_subcache (cache,
+                                                           APPLICATION_COLORS_KEY_NAME);
+  return colors;
+}
+
+/* Records a copy of colors for app_id in the cache, unless the cache
+ * was cleared since generation, in which case the colors may have been
+ * loaded from an application which is no longer installed. */
+static void
+record_application_colors_cache (const gchar                        *app_id,
+                                 EosCompanionAppServiceManagedCache *cache,
+                                 guint                               generation,
+                                 GStrv                               colors)
+{
+  GHashTable *subcache =
+    eos_companion_app_service_managed_cache_lock_subcache (cache,
+                                                           APPLICATION_COLORS_KEY_NAME,
+                                                           (GDestroyNotify) g_strfreev);
+
+  if (eos_companion_app_service_managed_cache_get_generation (cache) == generation)
+    g_hash_table_insert (subcache, g_strdup (app_id), g_strdupv (colors));
+
+  eos_companion_app_service_managed_cache_unlock_subcache (cache,
+                                                           APPLICATION_COLORS_KEY_NAME);
+}
+
 static void
 load_application_colors_thread (GTask        *task,
                                 gpointer      source,
@@ -954,13 +1000,30 @@ load_application_colors_thread (GTask        *task,
                                 GCancellable *cancellable)
 {
   g_autoptr(GError) local_error = NULL;
-  g_auto(GStrv) colors = load_colors_for_app_id ((const gchar *) task_data,
-                                                 &local_error);
-
+  ApplicationCacheTaskData *load_application_colors_data = task_data;
+  guint generation =
+    eos_companion_app_service_managed_cache_get_generation (load_application_colors_data->cache);
+  g_auto(GStrv) colors = lookup_application_colors_cache (load_application_colors_data->name,
+                                                          load_application_colors_data->cache);
+
+  /* The subcache is not locked while the colors are loaded, so that
+   * loading colors for one application does not block the others. Two
+   * threads may load the same colors at once, but the result is the same. */
   if (colors == NULL)
     {
-      g_task_return_error (task, g_steal_pointer (&local_error));
-      return;
+      colors = load_colors_for_app_id (load_application_colors_data->name,
+                                       &local_error);
+
+      if (colors == NULL)
+        {
+          g_task_return_error (task, g_steal_pointer (&local_error));
+          return;
+        }
+
+      record_application_colors_cache (load_application_colors_data->name,
+                                       load_application_colors_data->cache,
+                                       generation,
+                                       colors);
     }
 
   g_task_return_pointer (task,
@@ -969,15 +1032,18 @@ load_application_colors_thread (GTask        *task,
 }
 
 void
-eos_companion_app_service_load_application_colors (const gchar         *app_id,
-                                                   GCancellable        *cancellable,
-                                                   GAsyncReadyCallback  callback,
-                                                   gpointer             user_data)
+eos_companion_app_service_load_application_colors (const gchar                        *app_id,
+                                                   EosCompanionAppServiceManagedCache *cache,
+                                                   GCancellable                       *cancellable,
+                                                   GAsyncReadyCallback                 callback,
+                                                   gpointer                            user_data)
 {
   g_autoptr(GTask) task = g_task_new (NULL, cancellable, callback, user_data);
 
   g_task_set_return_on_cancel (task, TRUE);
-  g_task_set_task_data (task, g_strdup (app_id), g_free);
+  g_task_set_task_data (task,
+                        application_cache_task_data_new (app_id, cache),
+                        (GDestroyNotify) application_cache_task_data_free);
   g_task_run_in_thread (task, load_application_colors_thread);
 }
 
@@ -1146,6 +1212,7 @@ load_all_in_stream_to_bytes_thread_func (GTask        *task,
   ReadBufferInfo *info = task_data;
   gsize allocated = 0;
   gsize read_bytes = 0;
+  gsize to_read = MAX (info->chunk_size, 1);
   g_autofree gpointer buffer = NULL;
 
   /* If this is the case, we still have more work to do */
@@ -1153,12 +1220,12 @@ load_all_in_stream_to_bytes_thread_func (GTask        *task,
     {
       g_autoptr(GError) local_error = NULL;
       gsize bytes_read_on_this_iteration;
-      allocated += info->chunk_size;
+      allocated += to_read;
       buffer = g_realloc (buffer, allocated * sizeof (gchar));
 
       if (!g_input_stream_read_all (info->stream,
                                     ((gchar *) buffer + read_bytes),
-                                    info->chunk_size,
+                                    to_read,
                                     &bytes_read_on_this_iteration,
                                     cancellable,
                                     &local_error))
@@ -1172,6 +1239,11 @@ load_all_in_stream_to_bytes_thread_func (GTask        *task,
        * and go around. If we read fewer bytes than allocated, then
        * we're done */
       read_bytes += bytes_read_on_this_iteration;
+
+      /* Double the buffer size on each iteration, so that reading
+       * a stream that is much larger than the initial chunk size
+       * only needs a logarithmic number of reads and reallocations. */
+      to_read = allocated;
     }
 
   /* Truncate, store as bytes and transfer to task */
@@ -1292,6 +1364,183 @@ eos_companion_app_service_finish_fast_skip_stream (GAsyncResult  *result,
   return g_task_propagate_pointer (G_TASK (result), error);
 }
 
+typedef struct _SendFileRangeData
+{
+  GIOStream *connection;
+  gchar     *path;
+  goffset    offset;
+  gsize      count;
+} SendFileRangeData;
+
+static SendFileRangeData *
+send_file_range_data_new (GIOStream   *connection,
+                          const gchar *path,
+                          goffset      offset,
+                          gsize        count)
+{
+  SendFileRangeData *data = g_slice_new0 (SendFileRangeData);
+
+  data->connection = g_object_ref (connection);
+  data->path = g_strdup (path);
+  data->offset = offset;
+  data->count = count;
+
+  return data;
+}
+
+static void
+send_file_range_data_free (SendFileRangeData *data)
+{
+  g_clear_object (&data->connection);
+  g_clear_pointer (&data->path, g_free);
+
+  g_slice_free (SendFileRangeData, data);
+}
+
+static GSocket *
+socket_for_connection (GIOStream *connection)
+{
+  if (G_IS_SOCKET_CONNECTION (connection))
+    return g_socket_connection_get_socket (G_SOCKET_CONNECTION (connection));
+
+  /* soup_client_context_steal_connection wraps the underlying
+   * connection, but attaches its GSocket to the stream it returns */
+  return g_object_get_data (G_OBJECT (connection), "GSocket");
+}
+
+static void
+send_file_range_thread_func (GTask        *task,
+                             gpointer      source,
+                             gpointer      task_data,
+                             GCancellable *cancellable)
+{
+  SendFileRangeData *data = task_data;
+  GSocket *socket = socket_for_connection (data->connection);
+  off_t offset = data->offset;
+  gsize remaining = data->count;
+  int fd;
+
+  if (socket == NULL)
+    {
+      g_task_return_new_error (task,
+                               G_IO_ERROR,
+                               G_IO_ERROR_NOT_SUPPORTED,
+                               "Connection does not have a socket to send to");
+      return;
+    }
+
+  fd = open (data->path, O_RDONLY | O_CLOEXEC);
+
+  if (fd == -1)
+    {
+      int saved_errno = errno;
+      g_task_return_new_error (task,
+                               G_IO_ERROR,
+                               g_io_error_from_errno (saved_errno),
+                               "Could not open %s: %s",
+                               data->path,
+                               g_strerror (saved_errno));
+      return;
+    }
+
+  while (remaining > 0)
+    {
+      g_autoptr(GError) local_error = NULL;
+      ssize_t sent;
+
+      if (g_cancellable_set_error_if_cancelled (cancellable, &local_error))
+        {
+          close (fd);
+          g_task_return_error (task, g_steal_pointer (&local_error));
+          return;
+        }
+
+      /* The kernel copies straight from the page cache to the socket
+       * here, the data never passes through userspace */
+      sent = sendfile (g_socket_get_fd (socket), fd, &offset, remaining);
+
+      if (sent == -1)
+        {
+          int saved_errno = errno;
+
+          if (saved_errno == EINTR)
+            continue;
+
+          /* The socket is non-blocking, so wait until it can be written
+           * to again. */
+          if (saved_errno == EAGAIN || saved_errno == EWOULDBLOCK)
+            {
+              if (!g_socket_condition_wait (socket,
+                                            G_IO_OUT,
+                                            cancellable,
+                                            &local_error))
+                {
+                  close (fd);
+                  g_task_return_error (task, g_steal_pointer (&local_error));
+                  return;
+                }
+
+              continue;
+            }
+
+          close (fd);
+          g_task_return_new_error (task,
+                                   G_IO_ERROR,
+                                   g_io_error_from_errno (saved_errno),
+                                   "Could not send %s: %s",
+                                   data->path,
+                                   g_strerror (saved_errno));
+          return;
+        }
+
+      if (sent == 0)
+        {
+          close (fd);
+          g_task_return_new_error (task,
+                                   G_IO_ERROR,
+                                   G_IO_ERROR_FAILED,
+                                   "Unexpected end of file in %s",
+                                   data->path);
+          return;
+        }
+
+      remaining -= sent;
+    }
+
+  close (fd);
+
+  /* Same as G_OUTPUT_STREAM_SPLICE_CLOSE_TARGET */
+  g_output_stream_close (g_io_stream_get_output_stream (data->connection),
+                         cancellable,
+                         NULL);
+  g_task_return_boolean (task, TRUE);
+}
+
+void
+eos_companion_app_service_send_file_range_to_connection_async (GIOStream           *connection,
+                                                               const gchar         *path,
+                                                               goffset              offset,
+                                                               gsize                count,
+                                                               GCancellable        *cancellable,
+                                                               GAsyncReadyCallback  callback,
+                                                               gpointer             user_data)
+{
+  g_autoptr(GTask) task = g_task_new (NULL, cancellable, callback, user_data);
+  g_task_set_task_data (task,
+                        send_file_range_data_new (connection, path, offset, count),
+                        (GDestroyNotify) send_file_range_data_free);
+  g_task_run_in_thread (task, send_file_range_thread_func);
+}
+
+gboolean
+eos_companion_app_service_finish_send_file_range_to_connection (GAsyncResult  *result,
+                                                                GError       **error)
+{
+  g_return_val_if_fail (g_task_is_valid (G_TASK (result), NULL), FALSE);
+
+  return g_task_propagate_boolean (G_TASK (result), error);
+}
+
 static GStrv
 hardcoded_flatpak_install_dirs (void)
 {
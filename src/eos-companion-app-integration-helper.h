@@ -206,18 +206,21 @@ EosCompanionAppServiceAppInfo * eos_companion_app_service_finish_load_applicatio
 /**
  * eos_companion_app_service_load_application_colors:
  * @app_id: The app ID of the application to load colors for
+ * @cache: An #EosCompanionAppServiceManagedCache
  * @cancellable: (nullable): A #GCancellable
  * @callback: A #GAsyncReadyCallback
  * @user_data: Closure for @callback
  *
  * Asynchronously load the application colors from the application's
  * internal reosurce file for the given application name,
- * passing back a GStrv to the provided @callback.
+ * passing back a GStrv to the provided @callback. The colors are
+ * kept in @cache, so they are only loaded again once @cache is cleared.
  */
-void eos_companion_app_service_load_application_colors (const gchar         *app_id,
-                                                        GCancellable        *cancellable,
-                                                        GAsyncReadyCallback  callback,
-                                                        gpointer             user_data);
+void eos_companion_app_service_load_application_colors (const gchar                        *app_id,
+                                                        EosCompanionAppServiceManagedCache *cache,
+                                                        GCancellable                       *cancellable,
+                                                        GAsyncReadyCallback                 callback,
+                                                        gpointer                            user_data);
 
 /**
  * eos_companion_app_service_finish_load_application_colors:
@@ -235,11 +238,13 @@ GStrv eos_companion_app_service_finish_load_application_colors (GAsyncResult  *r
 /**
  * eos_companion_app_service_load_all_in_stream_to_bytes:
  * @stream: A #GInputStream
- * @chunk_size: The chunk size to use in bytes when loading the stream.
- *              Higher chunk sizes will result in greater thoroughput due
- *              to less overhead, but will also consume greater amounts
- *              of memory. The final buffer size will always be truncated to
- *              the size of the read data.
+ * @chunk_size: The size in bytes of the first read from the stream. If
+ *              the stream turns out to be larger, the buffer is doubled
+ *              in size for each subsequent read. If the size of the
+ *              stream is known in advance, pass one more than that size,
+ *              so that the entire stream is read with a single read and
+ *              a single allocation. The final buffer size will always be
+ *              truncated to the size of the read data.
  * @cancellable: (nullable): A #GCancellable
  * @callback: A #GAsyncReadyCallback
  * @callback_data: Closure for @callback
@@ -347,6 +352,50 @@ void eos_companion_app_service_fast_skip_stream_async (GInputStream        *stre
 GInputStream * eos_companion_app_service_finish_fast_skip_stream (GAsyncResult  *result,
                                                                   GError       **error);
 
+/**
+ * eos_companion_app_service_send_file_range_to_connection_async
+ * @connection: (transfer none): A #GIOStream, usually stolen from a
+ *              #SoupClientContext.
+ * @path: The path of the file to send
+ * @offset: The offset in bytes in the file to start sending from
+ * @count: The number of bytes to send
+ * @cancellable: (nullable): A #GCancellable
+ * @callback: A callback that will be invoked on success or failure once
+ *            sending is complete.
+ * @user_data: The closure for @callback
+ *
+ * Send @count bytes of the file at @path, starting at @offset, to the
+ * socket underlying @connection using sendfile(2), in a separate thread.
+ * Unlike g_output_stream_splice_async, the data is never copied into
+ * userspace. The output stream of @connection is closed once all the
+ * data has been sent.
+ *
+ * Since this writes to the socket directly, it must not be used with
+ * TLS connections. If @connection does not have an underlying #GSocket,
+ * the operation fails with %G_IO_ERROR_NOT_SUPPORTED before anything
+ * is sent, so the caller can fall back to splicing.
+ */
+void eos_companion_app_service_send_file_range_to_connection_async (GIOStream           *connection,
+                                                                    const gchar         *path,
+                                                                    goffset              offset,
+                                                                    gsize                count,
+                                                                    GCancellable        *cancellable,
+                                                                    GAsyncReadyCallback  callback,
+                                                                    gpointer             user_data);
+
+/**
+ * eos_companion_app_service_finish_send_file_range_to_connection
+ * @result: A #GAsyncResult
+ * @error: A #GError
+ *
+ * Complete the call to
+ * eos_companion_app_service_send_file_range_to_connection_async.
+ *
+ * Returns: %TRUE if all the data was sent, %FALSE with @error set otherwise.
+ */
+gboolean eos_companion_app_service_finish_send_file_range_to_connection (GAsyncResult  *result,
+                                                                         GError       **error);
+
 /**
  * eos_companion_app_service_flatpak_install_dirs
  *
@@ -26,5 +26,6 @@ GHashTable * eos_companion_app_service_managed_cache_lock_subcache (EosCompanion
                                                                     GDestroyNotify                      value_destroy);
 void eos_companion_app_service_managed_cache_unlock_subcache (EosCompanionAppServiceManagedCache *cache,
                                                               const gchar                        *key);
+guint eos_companion_app_service_managed_cache_get_generation (EosCompanionAppServiceManagedCache *cache);
 
 G_END_DECLS
@@ -26,6 +26,7 @@ typedef struct _EosCompanionAppServiceManagedCachePrivate
 {
   GMutex mutex;
   GHashTable *cache_tree;
+  gint generation;
 } EosCompanionAppServiceManagedCachePrivate;
 
 G_DEFINE_TYPE_WITH_PRIVATE (EosCompanionAppServiceManagedCache,
@@ -86,11 +87,33 @@ eos_companion_app_service_managed_cache_clear (EosCompanionAppServiceManagedCach
 {
   EosCompanionAppServiceManagedCachePrivate *priv = eos_companion_app_service_managed_cache_get_instance_private (cache);
 
+  g_atomic_int_inc (&priv->generation);
+
   g_mutex_lock (&priv->mutex);
   g_hash_table_remove_all (priv->cache_tree);
   g_mutex_unlock (&priv->mutex);
 }
 
+/**
+ * eos_companion_app_service_managed_cache_get_generation: (skip)
+ * @cache: An #EosCompanionAppServiceManagedCache.
+ *
+ * Get a number which changes each time @cache is cleared. A thread which
+ * loads a value without holding the lock on its subcache can get the
+ * generation before loading and compare it again before recording the
+ * value, so that a value loaded before the cache was cleared is not
+ * recorded afterwards.
+ *
+ * Returns: The current generation of @cache.
+ */
+guint
+eos_companion_app_service_managed_cache_get_generation (EosCompanionAppServiceManagedCache *cache)
+{
+  EosCompanionAppServiceManagedCachePrivate *priv = eos_companion_app_service_managed_cache_get_instance_private (cache);
+
+  return (guint) g_atomic_int_get (&priv->generation);
+}
+
 /**
  * eos_companion_app_service_managed_cache_lock_subcache: (skip)
  * @cache: An #EosCompanionAppServiceManagedCache.
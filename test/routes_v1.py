@@ -27,9 +27,12 @@
 '''Tests for the /v1 routes.'''
 
 
+import gzip
+import os
 import re
 
-from unittest.mock import Mock
+from tempfile import NamedTemporaryFile
+from unittest.mock import Mock, patch
 
 from test.service_test_helpers import (
     autoquit,
@@ -41,6 +44,7 @@ from test.service_test_helpers import (
     Holdable,
     handle_headers_bytes,
     handle_json,
+    handle_status_headers_bytes,
     json_http_request_with_uuid,
     local_endpoint,
     matches_uri_query,
@@ -70,7 +74,8 @@ gi.require_version('EosShard', '0')
 
 from gi.repository import (
     EosCompanionAppService,
-    GLib
+    GLib,
+    Soup
 )
 
 from eoscompanion.service import CompanionAppService
@@ -378,6 +383,110 @@ class CompanionAppServiceRoutesV1(object):
                                     handle_json(autoquit(on_received_response,
                                                          quit_cb)))
 
+    def hide_video_app_gresource(self):
+        '''Move the video app's GResource file away until the test ends.
+
+        This means that the application colors can no longer be loaded
+        from the application, only from the cache.
+        '''
+        gresource_path = os.path.join(self.__class__.flatpak_installation_dir,
+                                      'app',
+                                      'org.test.VideoApp',
+                                      'current',
+                                      'active',
+                                      'files',
+                                      'share',
+                                      'org.test.VideoApp',
+                                      'app.gresource')
+        hidden_path = gresource_path + '.hidden'
+        os.rename(gresource_path, hidden_path)
+        self.addCleanup(os.rename, hidden_path, gresource_path)
+
+    def request_video_app_colors(self, callback):
+        '''Make a query for the video app's colors.'''
+        json_http_request_with_uuid(FAKE_UUID,
+                                    local_endpoint(self.port,
+                                                   'application_colors'),
+                                    {
+                                        'applicationId': 'org.test.VideoApp'
+                                    },
+                                    callback)
+
+    @with_main_loop
+    def test_get_application_colors_video_app_cached(self, quit_cb):
+        '''/v1/application_colors should use the colors it loaded before.'''
+        def on_received_second_response(response):
+            '''Called when we receive the second response from the server.'''
+            self.assertThat(response['payload']['colors'],
+                            MatchesSetwise(Equals('#4573d9'), Equals('#98b8ff')))
+
+        def on_received_first_response(response):
+            '''Called when we receive the first response from the server.'''
+            self.assertThat(response['payload']['colors'],
+                            MatchesSetwise(Equals('#4573d9'), Equals('#98b8ff')))
+
+            # The colors can now only come from the application-colors subcache
+            self.hide_video_app_gresource()
+            self.request_video_app_colors(handle_json(autoquit(on_received_second_response,
+                                                               quit_cb)))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        self.request_video_app_colors(handle_json(quit_on_fail(on_received_first_response,
+                                                               quit_cb)))
+
+    @with_main_loop
+    def test_get_application_colors_video_app_reloaded_on_changes(self, quit_cb):
+        '''/v1/application_colors should load colors again when Flatpak installations change.'''
+        def on_received_second_response(response):
+            '''Called when we receive the second response from the server.'''
+            # The cache was cleared, so the colors were loaded again and
+            # the application no longer has any
+            self.assertThat(response, ContainsDict({
+                'status': Equals('error'),
+                'error': ContainsDict({
+                    'code': Equals('INVALID_APP_ID')
+                })
+            }))
+
+        def on_contents_replaced(*args):
+            '''Called when the contents of the .changed file have been replaced.
+
+            Make the request again after a timeout, to account for the
+            time it takes the file monitor to notice the change.
+            '''
+            del args
+
+            GLib.timeout_add(
+                100,
+                lambda: self.request_video_app_colors(
+                    handle_json(autoquit(on_received_second_response, quit_cb))
+                )
+            )
+
+        def on_received_first_response(response):
+            '''Called when we receive the first response from the server.'''
+            self.assertThat(response['payload']['colors'],
+                            MatchesSetwise(Equals('#4573d9'), Equals('#98b8ff')))
+
+            self.hide_video_app_gresource()
+
+            # Keep the same runtime, only the .changed file matters here
+            modify_app_runtime(self.__class__.flatpak_installation_dir,
+                               'org.test.VideoApp',
+                               'com.endlessm.apps.Platform',
+                               '3',
+                               'com.endlessm.apps.Sdk',
+                               '3',
+                               quit_on_fail(on_contents_replaced, quit_cb))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        self.request_video_app_colors(handle_json(quit_on_fail(on_received_first_response,
+                                                               quit_cb)))
+
     @with_main_loop
     def test_get_application_sets_video_app_colors(self, quit_cb):
         '''/v1/list_application_sets should include colors.'''
@@ -957,6 +1066,125 @@ class CompanionAppServiceRoutesV1(object):
                                on_received_ekn_id,
                                quit_cb)
 
+    @with_main_loop
+    def test_get_content_metadata_bad_content_id_repeated(self, quit_cb):
+        '''/v1/content_metadata remembers a bad contentId for repeated requests.'''
+        content_db_conn = FakeContentDbConnection(FAKE_SHARD_CONTENT)
+        content_db_conn.shards_for_application = Mock(
+            wraps=content_db_conn.shards_for_application
+        )
+
+        responses = []
+
+        def on_received_second_response(response):
+            '''Called when we receive the second response from the server.'''
+            # The second request is answered without loading the shards again,
+            # with exactly the same error as the first time
+            self.assertEqual(content_db_conn.shards_for_application.call_count, 1)
+            self.assertEqual(response, responses[0])
+
+        def on_received_first_response(response):
+            '''Called when we receive the first response from the server.'''
+            self.assertEqual(content_db_conn.shards_for_application.call_count, 1)
+            self.assertThat(response, ContainsDict({
+                'status': Equals('error'),
+                'error': ContainsDict({
+                    'code': Equals('INVALID_CONTENT_ID'),
+                    'detail': ContainsDict({
+                        'applicationId': Equals('org.test.VideoApp'),
+                        'contentId': Equals('nonexistent')
+                    })
+                })
+            }))
+            responses.append(response)
+            request_bad_content_id(handle_json(autoquit(on_received_second_response,
+                                                        quit_cb)))
+
+        def request_bad_content_id(callback):
+            '''Make a query using a bad EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_metadata'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': 'nonexistent'
+                                        },
+                                        callback)
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           content_db_conn)
+        request_bad_content_id(handle_json(on_received_first_response))
+
+    @with_main_loop
+    def test_get_content_metadata_bad_content_id_forgotten_on_changes(self, quit_cb):
+        '''/v1/content_metadata forgets bad contentIds when Flatpak installations change.'''
+        content_db_conn = FakeContentDbConnection(FAKE_SHARD_CONTENT)
+        content_db_conn.shards_for_application = Mock(
+            wraps=content_db_conn.shards_for_application
+        )
+
+        def on_received_second_response(response):
+            '''Called when we receive the second response from the server.'''
+            # The installation changed, so the shards are loaded again
+            self.assertEqual(content_db_conn.shards_for_application.call_count, 2)
+            self.assertThat(response, ContainsDict({
+                'status': Equals('error'),
+                'error': ContainsDict({
+                    'code': Equals('INVALID_CONTENT_ID')
+                })
+            }))
+
+        def on_contents_replaced(*args):
+            '''Called when the contents of the .changed file have been replaced.
+
+            Make the request again after a timeout, to account for the
+            time it takes the file monitor to notice the change.
+            '''
+            del args
+
+            GLib.timeout_add(
+                100,
+                lambda: request_bad_content_id(handle_json(autoquit(on_received_second_response,
+                                                                    quit_cb)))
+            )
+
+        def on_received_first_response(response):
+            '''Called when we receive the first response from the server.'''
+            self.assertEqual(content_db_conn.shards_for_application.call_count, 1)
+            self.assertThat(response, ContainsDict({
+                'status': Equals('error'),
+                'error': ContainsDict({
+                    'code': Equals('INVALID_CONTENT_ID')
+                })
+            }))
+
+            # Keep the same runtime, only the .changed file matters here
+            modify_app_runtime(self.__class__.flatpak_installation_dir,
+                               'org.test.VideoApp',
+                               'com.endlessm.apps.Platform',
+                               '3',
+                               'com.endlessm.apps.Sdk',
+                               '3',
+                               quit_on_fail(on_contents_replaced, quit_cb))
+
+        def request_bad_content_id(callback):
+            '''Make a query using a bad EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_metadata'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': 'nonexistent'
+                                        },
+                                        callback)
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           content_db_conn)
+        request_bad_content_id(handle_json(quit_on_fail(on_received_first_response,
+                                                        quit_cb)))
+
     @with_main_loop
     def test_get_content_data_video_app(self, quit_cb):
         '''/v1/content_data returns some expected video content data.'''
@@ -1012,7 +1240,143 @@ class CompanionAppServiceRoutesV1(object):
                                             'contentId': ekn_id
                                         },
                                         handle_headers_bytes(autoquit(on_received_response,
-                                                                      quit_cb)))
+                                                                      quit_cb)),
+                                        headers={
+                                            'Accept-Encoding': 'identity'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.ContentApp',
+                               ['First Tag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    def give_fake_shards_an_identity(self):
+        '''Pretend that the fake shards are files on disk.
+
+        Content is only sent with an ETag if its shards can be identified,
+        which the fake shards cannot.
+        '''
+        patcher = patch('eoscompanion.v1_routes.shards_identity',
+                        return_value=(('/fake/shard', 1, 1),))
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    @with_main_loop
+    def test_get_content_data_content_app_gzip(self, quit_cb):
+        '''/v1/content_data compresses content app data if the client accepts it.'''
+        self.give_fake_shards_an_identity()
+
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            body = gzip.decompress(msg_bytes.get_data()).decode('utf-8')
+
+            self.assertTrue(re.match(r'^.*<img src="\/v1/content_data.*$',
+                                     body,
+                                     flags=re.MULTILINE | re.DOTALL) != None)
+
+            self.assertEqual(headers.get_one('Content-Encoding'), 'gzip')
+            self.assertThat(headers.get_list('Vary'), Contains('Accept-Encoding'))
+            self.assertTrue(headers.get_one('ETag').endswith('-gzip"'))
+            self.assertEqual(headers.get_content_length(), msg_bytes.get_size())
+            self.assertEqual(headers.get_content_type()[0], 'text/html')
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.ContentApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)),
+                                        headers={
+                                            'Accept-Encoding': 'gzip'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.ContentApp',
+                               ['First Tag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_content_app_no_gzip(self, quit_cb):
+        '''/v1/content_data does not compress if the client does not accept it.'''
+        self.give_fake_shards_an_identity()
+
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            body = msg_bytes.get_data().decode('utf-8')
+
+            self.assertTrue(re.match(r'^.*<img src="\/v1/content_data.*$',
+                                     body,
+                                     flags=re.MULTILINE | re.DOTALL) != None)
+
+            self.assertEqual(headers.get_one('Content-Encoding'), None)
+            self.assertThat(headers.get_list('Vary'), Contains('Accept-Encoding'))
+            self.assertFalse(headers.get_one('ETag').endswith('-gzip"'))
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.ContentApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)),
+                                        headers={
+                                            'Accept-Encoding': 'gzip;q=0'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.ContentApp',
+                               ['First Tag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_content_app_ranges_not_compressed(self, quit_cb):
+        '''/v1/content_data never compresses responses to Range requests.'''
+        self.give_fake_shards_an_identity()
+
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            self.assertEqual(headers.get_one('Content-Encoding'), None)
+            self.assertFalse(headers.get_one('ETag').endswith('-gzip"'))
+            self.assertEqual(headers.get_content_length(), 10)
+            self.assertEqual(msg_bytes.get_size(), 10)
+            self.assertTrue(headers.get_one('Content-Range').startswith('bytes 0-9/'))
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.ContentApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)),
+                                        headers={
+                                            'Accept-Encoding': 'gzip',
+                                            'Range': 'bytes=0-9'
+                                        })
 
         self.service = CompanionAppService(Holdable(),
                                            self.port,
@@ -1063,6 +1427,634 @@ class CompanionAppServiceRoutesV1(object):
                                on_received_ekn_id,
                                quit_cb)
 
+    def send_uncompressed_video_data_from_file(self):
+        '''Pretend that the video app data is stored uncompressed on disk.
+
+        The fake shards are not real shard files, so put the data into
+        a file, after some padding, and make the routes send it from there.
+        '''
+        padding = b'padding'
+        shard_file = NamedTemporaryFile()
+        shard_file.write(padding + VIDEO_APP_FAKE_CONTENT.encode('utf-8'))
+        shard_file.flush()
+        self.addCleanup(shard_file.close)
+
+        patcher = patch('eoscompanion.v1_routes.locate_uncompressed_record_data_in_shards',
+                        return_value=(shard_file.name, len(padding)))
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    @with_main_loop
+    def test_get_content_data_video_app_uncompressed(self, quit_cb):
+        '''/v1/content_data sends uncompressed data straight from the shard.'''
+        locate_record_data = self.send_uncompressed_video_data_from_file()
+
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            test_string = VIDEO_APP_FAKE_CONTENT
+            self.assertEqual(msg_bytes.get_data().decode('utf-8'), test_string)
+            self.assertEqual(headers.get_content_length(), len(test_string))
+            self.assertEqual(headers.get_content_type()[0], 'video/mp4')
+            self.assertTrue(locate_record_data.called)
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.VideoApp',
+                               ['EknHomePageTag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_video_app_uncompressed_ranges(self, quit_cb):
+        '''/v1/content_data sends uncompressed ranges from the right offset.'''
+        locate_record_data = self.send_uncompressed_video_data_from_file()
+
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            # Range is inclusive, python ranges are exclusive, so add 1
+            test_string = VIDEO_APP_FAKE_CONTENT
+            self.assertEqual(msg_bytes.get_data().decode('utf-8'), test_string[1:11])
+            self.assertEqual(headers.get_content_length(), 10)
+            self.assertEqual(
+                headers.get_one('Content-Range'),
+                'bytes 1-10/{}'.format(len(test_string))
+            )
+            self.assertTrue(locate_record_data.called)
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)),
+                                        headers={
+                                            'Range': 'bytes=1-10'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.VideoApp',
+                               ['EknHomePageTag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_default_cache_control(self, quit_cb):
+        '''/v1/content_data must be revalidated by default.'''
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            del msg_bytes
+
+            self.assertEqual(headers.get_one('Cache-Control'), 'private, no-cache')
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.VideoApp',
+                               ['EknHomePageTag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_cache_control(self, quit_cb):
+        '''/v1/content_data sends the configured Cache-Control policy.'''
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            del msg_bytes
+
+            self.assertEqual(headers.get_one('Cache-Control'), 'max-age=60')
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT),
+                                           cache_control_policies={
+                                               'content_data': 'max-age=60'
+                                           })
+        fetch_first_content_id('org.test.VideoApp',
+                               ['EknHomePageTag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    def revalidate(self,
+                   route,
+                   query,
+                   headers,
+                   conditional_headers,
+                   on_revalidated,
+                   quit_cb):
+        '''Request :route: twice, the second time with conditional headers.
+
+        :conditional_headers: is called with the headers of the first
+        response and returns the headers to add to :headers: for the
+        second request. :on_revalidated: is called with the status,
+        body and headers of the second response.
+        '''
+        def on_received_first_response(msg_bytes, first_headers):
+            '''Make the conditional request.'''
+            del msg_bytes
+
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port, route),
+                                        dict(query),
+                                        handle_status_headers_bytes(
+                                            autoquit(on_revalidated, quit_cb)
+                                        ),
+                                        headers={
+                                            **headers,
+                                            **conditional_headers(first_headers)
+                                        })
+
+        json_http_request_with_uuid(FAKE_UUID,
+                                    local_endpoint(self.port, route),
+                                    dict(query),
+                                    handle_headers_bytes(quit_on_fail(on_received_first_response,
+                                                                      quit_cb)),
+                                    headers=headers)
+
+    def revalidate_content_data(self,
+                                headers,
+                                conditional_headers,
+                                on_revalidated,
+                                quit_cb):
+        '''Request content app data twice, the second time conditionally.'''
+        self.give_fake_shards_an_identity()
+
+        def on_received_ekn_id(ekn_id):
+            '''Make the requests using the EKN ID.'''
+            self.revalidate('content_data',
+                            {
+                                'applicationId': 'org.test.ContentApp',
+                                'contentId': ekn_id
+                            },
+                            headers,
+                            conditional_headers,
+                            on_revalidated,
+                            quit_cb)
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.ContentApp',
+                               ['First Tag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    def assert_not_modified(self, status, msg_bytes, headers, etag, cache_control):
+        '''Check that a response is a 304 which keeps its validators.'''
+        self.assertEqual(status, Soup.Status.NOT_MODIFIED)
+        self.assertEqual(msg_bytes.get_size(), 0)
+        self.assertEqual(headers.get_one('ETag'), etag)
+        self.assertEqual(headers.get_one('Cache-Control'), cache_control)
+
+    @with_main_loop
+    def test_get_content_data_if_none_match(self, quit_cb):
+        '''/v1/content_data responds with 304 if the ETag matches.'''
+        etags = []
+
+        def conditional_headers(headers):
+            '''Send back the ETag from the first response.'''
+            etags.append(headers.get_one('ETag'))
+            return {'If-None-Match': etags[0]}
+
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assert_not_modified(status,
+                                     msg_bytes,
+                                     headers,
+                                     etags[0],
+                                     'private, no-cache')
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     conditional_headers,
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_if_none_match_star(self, quit_cb):
+        '''/v1/content_data responds with 304 if If-None-Match is *.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del msg_bytes
+            del headers
+
+            self.assertEqual(status, Soup.Status.NOT_MODIFIED)
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     lambda headers: {'If-None-Match': '*'},
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_if_none_match_weak(self, quit_cb):
+        '''/v1/content_data responds with 304 if a weak ETag matches.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del msg_bytes
+            del headers
+
+            self.assertEqual(status, Soup.Status.NOT_MODIFIED)
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     lambda headers: {
+                                         'If-None-Match': 'W/' + headers.get_one('ETag')
+                                     },
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_if_none_match_list(self, quit_cb):
+        '''/v1/content_data responds with 304 if any ETag in a list matches.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del msg_bytes
+            del headers
+
+            self.assertEqual(status, Soup.Status.NOT_MODIFIED)
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     lambda headers: {
+                                         'If-None-Match': '"other", {}'.format(
+                                             headers.get_one('ETag')
+                                         )
+                                     },
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_if_none_match_changed(self, quit_cb):
+        '''/v1/content_data sends the content if the ETag does not match.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertEqual(headers.get_content_length(), msg_bytes.get_size())
+            self.assertTrue(msg_bytes.get_size() > 0)
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     lambda headers: {'If-None-Match': '"other"'},
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_if_modified_since_ignored(self, quit_cb):
+        '''/v1/content_data has no modification time to compare If-Modified-Since with.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del headers
+
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertTrue(msg_bytes.get_size() > 0)
+
+        self.revalidate_content_data({'Accept-Encoding': 'identity'},
+                                     lambda headers: {
+                                         'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'
+                                     },
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_gzip_etag_not_modified(self, quit_cb):
+        '''/v1/content_data responds with 304 if the compressed ETag matches.'''
+        etags = []
+
+        def conditional_headers(headers):
+            '''Send back the ETag from the first response.'''
+            etags.append(headers.get_one('ETag'))
+            return {'If-None-Match': etags[0]}
+
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assertTrue(etags[0].endswith('-gzip"'))
+            self.assert_not_modified(status,
+                                     msg_bytes,
+                                     headers,
+                                     etags[0],
+                                     'private, no-cache')
+
+        self.revalidate_content_data({'Accept-Encoding': 'gzip'},
+                                     conditional_headers,
+                                     on_revalidated,
+                                     quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_gzip_etag_other_encoding(self, quit_cb):
+        '''/v1/content_data sends uncompressed content for a compressed ETag.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertEqual(headers.get_one('Content-Encoding'), None)
+            self.assertFalse(headers.get_one('ETag').endswith('-gzip"'))
+            self.assertTrue(msg_bytes.get_size() > 0)
+
+        self.give_fake_shards_an_identity()
+
+        def on_received_ekn_id(ekn_id):
+            '''Make the requests using the EKN ID.'''
+            query = {
+                'applicationId': 'org.test.ContentApp',
+                'contentId': ekn_id
+            }
+
+            def on_received_compressed_response(msg_bytes, headers):
+                '''Ask for the uncompressed content with the compressed ETag.'''
+                del msg_bytes
+
+                json_http_request_with_uuid(FAKE_UUID,
+                                            local_endpoint(self.port,
+                                                           'content_data'),
+                                            dict(query),
+                                            handle_status_headers_bytes(
+                                                autoquit(on_revalidated, quit_cb)
+                                            ),
+                                            headers={
+                                                'Accept-Encoding': 'identity',
+                                                'If-None-Match': headers.get_one('ETag')
+                                            })
+
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        dict(query),
+                                        handle_headers_bytes(
+                                            quit_on_fail(on_received_compressed_response,
+                                                         quit_cb)
+                                        ),
+                                        headers={
+                                            'Accept-Encoding': 'gzip'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.ContentApp',
+                               ['First Tag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
+    def create_resource_file(self):
+        '''Create a stylesheet and return a URI for /v1/resource.'''
+        resource_file = NamedTemporaryFile(suffix='.css')
+        resource_file.write(b'body { color: red; }\n')
+        resource_file.flush()
+        self.addCleanup(resource_file.close)
+
+        return GLib.filename_to_uri(resource_file.name, None)
+
+    def revalidate_resource(self,
+                            headers,
+                            conditional_headers,
+                            on_revalidated,
+                            quit_cb):
+        '''Request a resource twice, the second time conditionally.'''
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        self.revalidate('resource',
+                        {
+                            'uri': self.create_resource_file()
+                        },
+                        headers,
+                        conditional_headers,
+                        on_revalidated,
+                        quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_none_match(self, quit_cb):
+        '''/v1/resource responds with 304 if the ETag matches.'''
+        etags = []
+
+        def conditional_headers(headers):
+            '''Send back the ETag from the first response.'''
+            etags.append(headers.get_one('ETag'))
+            return {'If-None-Match': etags[0]}
+
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assert_not_modified(status,
+                                     msg_bytes,
+                                     headers,
+                                     etags[0],
+                                     'private, max-age=604800')
+            self.assertNotEqual(headers.get_one('Last-Modified'), None)
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 conditional_headers,
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_none_match_weak(self, quit_cb):
+        '''/v1/resource responds with 304 if a weak ETag matches.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del msg_bytes
+            del headers
+
+            self.assertEqual(status, Soup.Status.NOT_MODIFIED)
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 lambda headers: {
+                                     'If-None-Match': 'W/' + headers.get_one('ETag')
+                                 },
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_none_match_changed(self, quit_cb):
+        '''/v1/resource sends the resource if the ETag does not match.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertEqual(msg_bytes.get_data(), b'body { color: red; }\n')
+            self.assertEqual(headers.get_content_type()[0], 'text/css')
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 lambda headers: {'If-None-Match': '"other"'},
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_modified_since(self, quit_cb):
+        '''/v1/resource responds with 304 if it was not modified since the date.'''
+        etags = []
+
+        def conditional_headers(headers):
+            '''Send back the modification time from the first response.'''
+            etags.append(headers.get_one('ETag'))
+            return {'If-Modified-Since': headers.get_one('Last-Modified')}
+
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assert_not_modified(status,
+                                     msg_bytes,
+                                     headers,
+                                     etags[0],
+                                     'private, max-age=604800')
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 conditional_headers,
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_modified_since_modified(self, quit_cb):
+        '''/v1/resource sends the resource if it was modified since the date.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del headers
+
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertEqual(msg_bytes.get_data(), b'body { color: red; }\n')
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 lambda headers: {
+                                     'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'
+                                 },
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_if_none_match_wins(self, quit_cb):
+        '''/v1/resource ignores If-Modified-Since if If-None-Match is sent.'''
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            del headers
+
+            self.assertEqual(status, Soup.Status.OK)
+            self.assertEqual(msg_bytes.get_data(), b'body { color: red; }\n')
+
+        self.revalidate_resource({'Accept-Encoding': 'identity'},
+                                 lambda headers: {
+                                     'If-None-Match': '"other"',
+                                     'If-Modified-Since': headers.get_one('Last-Modified')
+                                 },
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_resource_gzip_etag_not_modified(self, quit_cb):
+        '''/v1/resource responds with 304 if the compressed ETag matches.'''
+        etags = []
+
+        def conditional_headers(headers):
+            '''Send back the ETag from the first response.'''
+            etags.append(headers.get_one('ETag'))
+            return {'If-None-Match': etags[0]}
+
+        def on_revalidated(status, msg_bytes, headers):
+            '''Called when we receive the conditional response.'''
+            self.assertTrue(etags[0].endswith('-gzip"'))
+            self.assert_not_modified(status,
+                                     msg_bytes,
+                                     headers,
+                                     etags[0],
+                                     'private, max-age=604800')
+
+        self.revalidate_resource({'Accept-Encoding': 'gzip'},
+                                 conditional_headers,
+                                 on_revalidated,
+                                 quit_cb)
+
+    @with_main_loop
+    def test_get_content_data_video_app_multiple_ranges(self, quit_cb):
+        '''/v1/content_data returns multiple ranges as multipart/byteranges.'''
+        def on_received_response(msg_bytes, headers):
+            '''Called when we receive a response from the server.'''
+            test_string = VIDEO_APP_FAKE_CONTENT
+            content_type, params = headers.get_content_type()
+            body = msg_bytes.get_data().decode('utf-8')
+            self.assertEqual(content_type, 'multipart/byteranges')
+            self.assertEqual(headers.get_one('Accept-Ranges'), 'bytes')
+            self.assertEqual(headers.get_one('Content-Range'), None)
+            self.assertEqual(body, (
+                '--{boundary}\r\n'
+                'Content-Type: video/mp4\r\n'
+                'Content-Range: bytes 1-3/{total}\r\n'
+                '\r\n'
+                '{first}\r\n'
+                '--{boundary}\r\n'
+                'Content-Type: video/mp4\r\n'
+                'Content-Range: bytes 8-10/{total}\r\n'
+                '\r\n'
+                '{second}\r\n'
+                '--{boundary}--\r\n'
+            ).format(boundary=params['boundary'],
+                     total=len(test_string),
+                     first=test_string[1:4],
+                     second=test_string[8:11]))
+
+        def on_received_ekn_id(ekn_id):
+            '''Make a query using the EKN ID.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'content_data'),
+                                        {
+                                            'applicationId': 'org.test.VideoApp',
+                                            'contentId': ekn_id
+                                        },
+                                        handle_headers_bytes(autoquit(on_received_response,
+                                                                      quit_cb)),
+                                        headers={
+                                            'Range': 'bytes=1-3,8-10'
+                                        })
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        fetch_first_content_id('org.test.VideoApp',
+                               ['EknHomePageTag'],
+                               self.port,
+                               on_received_ekn_id,
+                               quit_cb)
+
     @with_main_loop
     def test_get_content_data_video_app_cancel(self, quit_cb):
         '''/v1/content_data when cancelled returns error.'''
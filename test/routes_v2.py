@@ -21,6 +21,7 @@
 '''Tests for the /v2 routes.'''
 
 
+import base64
 import re
 
 from unittest.mock import Mock
@@ -52,6 +53,8 @@ from testtools.matchers import (
     Contains,
     ContainsDict,
     Equals,
+    HasLength,
+    LessThan,
     MatchesSetwise,
     MatchesListwise,
     Not
@@ -316,6 +319,33 @@ class CompanionAppServiceRoutesV2(object):
                                     handle_headers_bytes(autoquit(on_received_response,
                                                                   quit_cb)))
 
+    @with_main_loop
+    def test_get_application_icons(self, quit_cb):
+        '''/v2/application_icons returns base64 encoded icons for each icon name.'''
+        def on_received_response(response):
+            '''Called when we receive a response from the server.'''
+            self.assertEqual(response['status'], 'ok')
+            self.assertEqual(sorted(response['payload'].keys()),
+                             ['org.test.ContentApp', 'org.test.VideoApp'])
+
+            for encoded_icon in response['payload'].values():
+                self.assertTrue(
+                    base64.b64decode(encoded_icon).startswith(b'\x89PNG')
+                )
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        json_http_request_with_uuid(FAKE_UUID,
+                                    local_endpoint(self.port,
+                                                   'application_icons',
+                                                   version='v2'),
+                                    {
+                                        'iconNames': 'org.test.VideoApp;org.test.ContentApp'
+                                    },
+                                    handle_json(autoquit(on_received_response,
+                                                         quit_cb)))
+
     @with_main_loop
     def test_get_application_icon_video_app_error_no_device_uuid(self, quit_cb):
         '''/v2/application_icon should return an error if deviceUUID not set.'''
@@ -1042,7 +1072,10 @@ class CompanionAppServiceRoutesV2(object):
                                             'contentId': ekn_id
                                         },
                                         handle_headers_bytes(autoquit(on_received_response,
-                                                                      quit_cb)))
+                                                                      quit_cb)),
+                                        headers={
+                                            'Accept-Encoding': 'identity'
+                                        })
 
         self.service = CompanionAppService(Holdable(),
                                            self.port,
@@ -1621,6 +1654,97 @@ class CompanionAppServiceRoutesV2(object):
                                     handle_json(autoquit(on_received_response,
                                                          quit_cb)))
 
+    @with_main_loop
+    def test_search_content_continuation_token(self, quit_cb):
+        '''/v2/search_content pages through all results with continuation tokens.'''
+        display_names = []
+
+        def request_page(continuation_token):
+            '''Request the page after continuation_token.'''
+            json_http_request_with_uuid(FAKE_UUID,
+                                        local_endpoint(self.port,
+                                                       'search_content',
+                                                       version='v2'),
+                                        {
+                                            'searchTerm': 'Sampl',
+                                            'limit': 2,
+                                            'continuationToken': continuation_token
+                                        },
+                                        handle_json(on_received_response))
+
+        def on_received_response(response):
+            '''Called when we receive a page from the server.'''
+            results = response['payload']['results']
+            self.assertThat(len(results), LessThan(3))
+            display_names.extend([r['displayName'] for r in results])
+
+            continuation_token = response['payload']['continuationToken']
+            if continuation_token is not None:
+                request_page(continuation_token)
+                return
+
+            self.assertThat(sorted(display_names), Equals([
+                'Sample Article 1',
+                'Sample Article 2',
+                'Sample Video'
+            ]))
+            quit_cb()
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        request_page('')
+
+    @with_main_loop
+    def test_search_content_limit_without_continuation_token(self, quit_cb):
+        '''/v2/search_content only paginates with continuation tokens on request.'''
+        def on_received_response(response):
+            '''Called when we receive a response from the server.'''
+            self.assertThat(response['payload'], Not(Contains('continuationToken')))
+            self.assertThat(response['payload']['results'], HasLength(2))
+            self.assertThat(response['payload']['remaining'], Equals(1))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        json_http_request_with_uuid(FAKE_UUID,
+                                    local_endpoint(self.port,
+                                                   'search_content',
+                                                   version='v2'),
+                                    {
+                                        'searchTerm': 'Sampl',
+                                        'limit': 2
+                                    },
+                                    handle_json(autoquit(on_received_response,
+                                                         quit_cb)))
+
+    @with_main_loop
+    def test_search_content_error_bad_continuation_token(self, quit_cb):
+        '''/v2/search_content returns an error if the continuation token is malformed.'''
+        def on_received_response(response):
+            '''Called when we receive a response from the server.'''
+            self.assertThat(response, ContainsDict({
+                'status': Equals('error'),
+                'error': ContainsDict({
+                    'code': Equals('INVALID_REQUEST')
+                })
+            }))
+
+        self.service = CompanionAppService(Holdable(),
+                                           self.port,
+                                           FakeContentDbConnection(FAKE_SHARD_CONTENT))
+        json_http_request_with_uuid(FAKE_UUID,
+                                    local_endpoint(self.port,
+                                                   'search_content',
+                                                   version='v2'),
+                                    {
+                                        'searchTerm': 'Sampl',
+                                        'limit': 2,
+                                        'continuationToken': 'not a token'
+                                    },
+                                    handle_json(autoquit(on_received_response,
+                                                         quit_cb)))
+
     @with_main_loop
     def test_search_content_applications(self, quit_cb):
         '''/v2/search_content is able to search for applications.'''
@@ -163,6 +163,9 @@ def soup_uri_with_query_object(uri, query_object):
 def json_http_request_with_uuid(uuid, uri, query, callback, headers=None):
     '''Send a new HTTP request with the UUID in the header.'''
     session = Soup.Session.new()
+    # Do not let the session negotiate and decode compression itself,
+    # so that tests see exactly what the service sends.
+    session.remove_feature_by_type(Soup.ContentDecoder)
     query.update({
         'deviceUUID': uuid
     })
@@ -241,6 +244,25 @@ def handle_headers_bytes(handler):
     return soup_bytestream_handler
 
 
+def handle_status_headers_bytes(handler):
+    '''Handler middleware that returns the response status, headers and bytes.'''
+    def soup_bytestream_handler(request_obj, result):
+        '''Handle the bytestream.'''
+        def bytes_loaded(_, result):
+            '''Handle the loaded bytes.'''
+            msg_bytes = EosCompanionAppService.finish_load_all_in_stream_to_bytes(result)
+            message = request_obj.get_message()
+            handler(message.status_code, msg_bytes, message.response_headers)
+
+        stream = request_obj.send_finish(result)
+        EosCompanionAppService.load_all_in_stream_to_bytes(stream,
+                                                           chunk_size=1024,
+                                                           cancellable=None,
+                                                           callback=bytes_loaded)
+
+    return soup_bytestream_handler
+
+
 class GLibEnvironmentPreservationContext(object):
     '''A class to keep track of environment variables set with GLib.setenv.
 
@@ -726,6 +748,9 @@ class FakeContentDbConnection(object):
 
         return GLib.idle_add(callback, None, self.data.feed_models)
 
+    def clear_cache(self):
+        '''Nothing is cached, so there is nothing to do here.'''
+
 
 def modify_app_runtime(flatpak_installation_dir,
                        app_id,
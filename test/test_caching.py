@@ -0,0 +1,520 @@
+# /test/test_caching.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Tests for the caches used by the service.'''
+
+# pylint: disable=wrong-import-order
+import gi
+
+gi.require_version('ContentFeed', '0')
+gi.require_version('Eknr', '0')
+gi.require_version('Endless', '0')
+gi.require_version('EosCompanionAppService', '1.0')
+gi.require_version('EosMetrics', '0')
+gi.require_version('EosShard', '0')
+
+from tempfile import NamedTemporaryFile
+from unittest.mock import Mock, patch
+
+from gi.repository import EosCompanionAppService, GLib
+
+from eoscompanion.applications_query import (
+    ApplicationListing,
+    load_application_icon_async
+)
+from eoscompanion.caching import clear_python_subcaches, python_subcache
+from eoscompanion.ekn_content_adjuster import device_uuid_placeholder_query
+from eoscompanion.ekn_data import (
+    find_record_in_shards,
+    IdentifiedShards,
+    load_content_metadata_from_shards_async,
+    locate_uncompressed_record_data_in_shards,
+    shard_routes_cache,
+    shard_file_identity,
+    shards_identity
+)
+from eoscompanion.ekn_query import load_set_catalogue
+from eoscompanion.eknservices_bridge import (
+    async_init_all_shards,
+    ShardFileCache
+)
+from eoscompanion.v1_routes import (
+    file_bodies_cache,
+    file_body_key,
+    lookup_file_body
+)
+
+from testtools import TestCase
+
+
+def run_until_called(callbacks):
+    '''Iterate the default main context until each of :callbacks: was called.'''
+    context = GLib.main_context_default()
+    while not all(callback.called for callback in callbacks):
+        context.iteration(True)
+
+
+class TestShardFileCache(TestCase):
+    '''Tests for ShardFileCache.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Create a file to stand in for a shard.'''
+        super().setUp()
+        # pylint: disable=consider-using-with
+        shard_file = NamedTemporaryFile()
+        self.addCleanup(shard_file.close)
+        self.shard_path = shard_file.name
+
+    def test_unchanged_shard_is_a_hit(self):
+        '''Loading an unchanged shard again does not initialize it again.'''
+        shard = object()
+        init_shard_async = Mock(
+            side_effect=lambda path, cancellable, callback: callback(None, shard)
+        )
+        cache = ShardFileCache()
+        # Callbacks return None, so that idle sources are not repeated
+        first_callback = Mock(return_value=None)
+        second_callback = Mock(return_value=None)
+
+        with patch('eoscompanion.eknservices_bridge.init_shard_async',
+                   init_shard_async):
+            cache.load_shard_async(self.shard_path,
+                                   shard_file_identity(self.shard_path),
+                                   None,
+                                   first_callback)
+            run_until_called([first_callback])
+            cache.load_shard_async(self.shard_path,
+                                   shard_file_identity(self.shard_path),
+                                   None,
+                                   second_callback)
+            run_until_called([second_callback])
+
+        self.assertEqual(init_shard_async.call_count, 1)
+        first_callback.assert_called_once_with(None, shard)
+        second_callback.assert_called_once_with(None, shard)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+
+
+class TestShardsIdentity(TestCase):
+    '''Tests for working out the identity of shards once per request.'''
+
+    def test_identified_shards_are_not_examined(self):
+        '''The identity of an IdentifiedShards is used as is.'''
+        with patch('eoscompanion.ekn_data.shard_file_identity') as identity:
+            self.assertEqual(shards_identity(IdentifiedShards([object()],
+                                                              (('/shard', 1, 1),))),
+                             (('/shard', 1, 1),))
+
+        identity.assert_not_called()
+
+    def test_each_shard_is_examined_once(self):
+        '''Loading shards examines each shard file once.'''
+        identity = Mock(side_effect=lambda path: (path, 1, 1))
+        init_shard_async = Mock(
+            side_effect=lambda path, cancellable, callback: callback(None, object())
+        )
+        callback = Mock(return_value=None)
+
+        with patch('eoscompanion.eknservices_bridge.shard_file_identity', identity), \
+                patch('eoscompanion.eknservices_bridge.init_shard_async', init_shard_async):
+            async_init_all_shards(['/first', '/second'],
+                                  None,
+                                  callback,
+                                  shard_cache=ShardFileCache())
+            run_until_called([callback])
+
+        error, shards = callback.call_args[0]
+        self.assertIsNone(error)
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(shards_identity(shards),
+                         (('/first', 1, 1), ('/second', 1, 1)))
+        self.assertEqual(identity.call_count, 2)
+
+
+class TestLocateUncompressedRecordData(TestCase):
+    '''Tests for locate_uncompressed_record_data_in_shards.'''
+
+    def test_missing_blob_offsets_are_logged_once(self):
+        '''Without EosShard.Blob.get_offset, data is streamed and a warning logged once.'''
+        with patch('eoscompanion.ekn_data._BLOBS_HAVE_OFFSETS', False), \
+                patch('eoscompanion.ekn_data._LOGGED_MISSING_BLOB_OFFSETS', False), \
+                patch('eoscompanion.ekn_data.find_record_in_shards') as find_record:
+            with self.assertLogs(level='WARNING') as logs:
+                self.assertIsNone(locate_uncompressed_record_data_in_shards([], 'id'))
+                self.assertIsNone(locate_uncompressed_record_data_in_shards([], 'id'))
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('EosShard.Blob.get_offset', logs.output[0])
+        find_record.assert_not_called()
+
+
+def fake_shard(records):
+    '''Create a fake shard which has :records:, keyed by content ID.'''
+    shard = Mock()
+    shard.find_record_by_hex_name.side_effect = records.get
+    return shard
+
+
+class TestFindRecordInShards(TestCase):
+    '''Tests for routing record lookups with the shard routes cache.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Create two shards, the second of which has a record.'''
+        super().setUp()
+        self.routes = shard_routes_cache(EosCompanionAppService.ManagedCache())
+        self.record = object()
+        self.first_shard = fake_shard({})
+        self.second_shard = fake_shard({'a1b2c3': self.record})
+
+    def shards(self, identity):
+        '''Get the two shards, with :identity: as their shards_identity.'''
+        return IdentifiedShards([self.first_shard, self.second_shard], identity)
+
+    def probe_counts(self):
+        '''Get the number of lookups made in each shard so far.'''
+        return (self.first_shard.find_record_by_hex_name.call_count,
+                self.second_shard.find_record_by_hex_name.call_count)
+
+    def test_found_record_is_routed_to_its_shard(self):
+        '''A record found before is looked up in its shard only.'''
+        find_record_in_shards(self.shards(('identity',)), 'a1b2c3', routes=self.routes)
+        self.assertEqual(self.probe_counts(), (1, 1))
+
+        self.assertEqual(find_record_in_shards(self.shards(('identity',)),
+                                               'a1b2c3',
+                                               routes=self.routes),
+                         (self.second_shard, self.record))
+        self.assertEqual(self.probe_counts(), (1, 2))
+
+    def test_missing_record_is_not_looked_up_again(self):
+        '''A record which none of the shards have is rejected straight away.'''
+        find_record_in_shards(self.shards(('identity',)), 'missing', routes=self.routes)
+        self.assertEqual(self.probe_counts(), (1, 1))
+
+        self.assertEqual(find_record_in_shards(self.shards(('identity',)),
+                                               'missing',
+                                               routes=self.routes),
+                         (None, None))
+        self.assertEqual(self.probe_counts(), (1, 1))
+
+    def test_changed_shards_are_looked_up_again(self):
+        '''A record which was missing is looked up again once the shards change.'''
+        find_record_in_shards(self.shards(('identity',)), 'missing', routes=self.routes)
+        find_record_in_shards(self.shards(('changed-identity',)),
+                              'missing',
+                              routes=self.routes)
+
+        self.assertEqual(self.probe_counts(), (2, 2))
+
+    def test_unidentified_shards_are_not_routed(self):
+        '''Shards whose files cannot be identified are always walked.'''
+        find_record_in_shards(self.shards(None), 'missing', routes=self.routes)
+        find_record_in_shards(self.shards(None), 'missing', routes=self.routes)
+
+        self.assertEqual(self.probe_counts(), (2, 2))
+        self.assertEqual(len(self.routes), 0)
+
+
+class TestLoadContentMetadata(TestCase):
+    '''Tests for load_content_metadata_from_shards_async.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Replace loading the metadata record from the shards.'''
+        super().setUp()
+        self.load_record = Mock(
+            side_effect=lambda shards, content_id, attr, callback, routes: callback(
+                None,
+                GLib.Bytes.new(b'{"title": "Title", "tags": ["First Tag"]}')
+            )
+        )
+        patcher = patch('eoscompanion.ekn_data.load_record_from_shards_async',
+                        self.load_record)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_cached_metadata_is_a_copy(self):
+        '''Changing the metadata passed to the callback does not change the cache.'''
+        cache = EosCompanionAppService.ManagedCache()
+        shards = IdentifiedShards([], ('identity',))
+        first_callback = Mock()
+        second_callback = Mock(return_value=None)
+
+        load_content_metadata_from_shards_async(shards,
+                                                'org.test.ContentApp',
+                                                'a1b2c3',
+                                                cache,
+                                                first_callback)
+        first_metadata = first_callback.call_args[0][1]
+        first_metadata['version'] = '2'
+
+        load_content_metadata_from_shards_async(shards,
+                                                'org.test.ContentApp',
+                                                'a1b2c3',
+                                                cache,
+                                                second_callback)
+        run_until_called([second_callback])
+        second_metadata = second_callback.call_args[0][1]
+
+        self.assertEqual(self.load_record.call_count, 1)
+        self.assertIsNot(first_metadata, second_metadata)
+        self.assertEqual(second_metadata, {
+            'title': 'Title',
+            'tags': ['First Tag']
+        })
+
+
+class TestPythonSubcache(TestCase):
+    '''Tests for python_subcache.'''
+
+    def test_same_subcache_until_cleared(self):
+        '''The same subcache is returned until the cache is cleared.'''
+        cache = EosCompanionAppService.ManagedCache()
+        subcache = python_subcache(cache, 'test', dict)
+        subcache['key'] = 'value'
+
+        self.assertIs(python_subcache(cache, 'test', dict), subcache)
+
+        clear_python_subcaches(cache)
+
+        self.assertIsNot(python_subcache(cache, 'test', dict), subcache)
+        self.assertEqual(subcache, {})
+
+
+class TestFileBodiesCache(TestCase):
+    '''Tests for the cache of /resource and /license bodies.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Create a cache.'''
+        super().setUp()
+        self.cache = EosCompanionAppService.ManagedCache()
+
+    def insert_file_body(self, body_key, body):
+        '''Insert :body: for a file of size 10 modified at time 100.'''
+        file_bodies_cache(self.cache).insert(body_key,
+                                             (10, 100, GLib.Bytes.new(body)))
+
+    def test_unchanged_file_body_is_served(self):
+        '''The cached body is served while the file is unchanged.'''
+        body_key = file_body_key('file:///style.css', None, 'v1')
+        self.insert_file_body(body_key, b'body {}')
+
+        served = lookup_file_body(self.cache, body_key, 10, 100, {})
+
+        self.assertEqual(served.get_data(), b'body {}')
+
+    def test_changed_modified_time_invalidates_file_body(self):
+        '''The cached body is not served once the file has been modified.'''
+        body_key = file_body_key('file:///style.css', None, 'v1')
+        self.insert_file_body(body_key, b'body {}')
+
+        self.assertIsNone(lookup_file_body(self.cache, body_key, 10, 200, {}))
+
+    def test_changed_size_invalidates_file_body(self):
+        '''The cached body is not served once the file has changed size.'''
+        body_key = file_body_key('file:///style.css', None, 'v1')
+        self.insert_file_body(body_key, b'body {}')
+
+        self.assertIsNone(lookup_file_body(self.cache, body_key, 20, 100, {}))
+
+    def test_adjusted_file_body_is_served_per_device(self):
+        '''Each device gets the adjusted body with its own deviceUUID.'''
+        body_key = file_body_key('file:///license.html', 'license', 'v1')
+        placeholder = device_uuid_placeholder_query({})['deviceUUID']
+        self.insert_file_body(
+            body_key,
+            '<a href="/v1/license?deviceUUID={}">'.format(placeholder).encode('utf-8')
+        )
+
+        first = lookup_file_body(self.cache,
+                                 body_key,
+                                 10,
+                                 100,
+                                 {'deviceUUID': 'first device'})
+        second = lookup_file_body(self.cache,
+                                  body_key,
+                                  10,
+                                  100,
+                                  {'deviceUUID': 'second'})
+
+        self.assertEqual(first.get_data(),
+                         b'<a href="/v1/license?deviceUUID=first+device">')
+        self.assertEqual(second.get_data(),
+                         b'<a href="/v1/license?deviceUUID=second">')
+
+
+APPLICATION_LISTING = ApplicationListing('org.test.ContentApp',
+                                         'Content App',
+                                         'A content app',
+                                         'org.test.ContentApp',
+                                         'en',
+                                         'EknServices2',
+                                         'SearchProviderV2')
+
+
+class FakeSetQueries(object):
+    '''A content database connection which answers set queries on demand.'''
+
+    def __init__(self):
+        '''Initialize the list of queries.'''
+        super().__init__()
+        self.queries = []
+
+    def query(self, application_listing, query, cancellable, callback):
+        '''Remember the query, so that the test can answer it.'''
+        del application_listing
+        del cancellable
+
+        self.queries.append((query, callback))
+
+    def answer(self, index, models):
+        '''Answer query number :index: with :models:.'''
+        self.queries[index][1](None, (None, models))
+
+
+class TestLoadSetCatalogue(TestCase):
+    '''Tests for load_set_catalogue.'''
+
+    def test_queries_every_set(self):
+        '''The catalogue is not limited to the first few sets.'''
+        content_db_conn = FakeSetQueries()
+        load_set_catalogue(content_db_conn,
+                           APPLICATION_LISTING,
+                           EosCompanionAppService.ManagedCache(),
+                           None,
+                           Mock())
+
+        query, _ = content_db_conn.queries[0]
+        self.assertEqual(query, {'tags-match-all': ['EknSetObject']})
+
+    def test_catalogue_is_cached(self):
+        '''The catalogue is only queried once.'''
+        cache = EosCompanionAppService.ManagedCache()
+        content_db_conn = FakeSetQueries()
+        callback = Mock(return_value=None)
+
+        load_set_catalogue(content_db_conn, APPLICATION_LISTING, cache, None, Mock())
+        content_db_conn.answer(0, [{'child_tags': ['First Tag']}])
+        load_set_catalogue(content_db_conn, APPLICATION_LISTING, cache, None, callback)
+        run_until_called([callback])
+
+        self.assertEqual(len(content_db_conn.queries), 1)
+        self.assertEqual(callback.call_args[0][1].models,
+                         [{'child_tags': ['First Tag']}])
+
+    def test_catalogue_loaded_before_clear_is_not_cached(self):
+        '''A catalogue queried before the cache was cleared is not kept.'''
+        cache = EosCompanionAppService.ManagedCache()
+        content_db_conn = FakeSetQueries()
+
+        load_set_catalogue(content_db_conn, APPLICATION_LISTING, cache, None, Mock())
+        clear_python_subcaches(cache)
+        content_db_conn.answer(0, [{'child_tags': ['Old Tag']}])
+
+        load_set_catalogue(content_db_conn, APPLICATION_LISTING, cache, None, Mock())
+
+        self.assertEqual(len(content_db_conn.queries), 2)
+
+
+class TestLoadApplicationIcon(TestCase):
+    '''Tests for load_application_icon_async.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Replace the icon loading functions from the helper library.'''
+        super().setUp()
+        self.loads = []
+        service = Mock()
+        service.load_application_icon_data_async.side_effect = (
+            lambda icon_name, cancellable, callback: self.loads.append(callback)
+        )
+        service.finish_load_application_icon_data_async.side_effect = lambda result: result
+        patcher = patch('eoscompanion.applications_query.EosCompanionAppService',
+                        service)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def finish_load(self, index, data):
+        '''Finish load number :index: with :data: as the icon.'''
+        self.loads[index](None, GLib.Bytes.new(data))
+
+    def test_icon_is_cached(self):
+        '''An icon is only loaded once.'''
+        cache = EosCompanionAppService.ManagedCache()
+        callback = Mock(return_value=None)
+
+        load_application_icon_async(cache, 'icon', None, Mock())
+        self.finish_load(0, b'icon')
+        load_application_icon_async(cache, 'icon', None, callback)
+        run_until_called([callback])
+
+        self.assertEqual(len(self.loads), 1)
+        self.assertEqual(callback.call_args[0][1].image_bytes.get_data(), b'icon')
+
+    def test_concurrent_loads_are_shared(self):
+        '''Requests for an icon which is loading share the load.'''
+        cache = EosCompanionAppService.ManagedCache()
+        first_callback = Mock()
+        second_callback = Mock()
+
+        load_application_icon_async(cache, 'icon', None, first_callback)
+        load_application_icon_async(cache, 'icon', None, second_callback)
+        self.finish_load(0, b'icon')
+
+        self.assertEqual(len(self.loads), 1)
+        self.assertIs(first_callback.call_args[0][1], second_callback.call_args[0][1])
+
+    def test_least_recently_used_icon_is_evicted(self):
+        '''Icons beyond the size budget are evicted, least recently used first.'''
+        cache = EosCompanionAppService.ManagedCache()
+
+        with patch('eoscompanion.applications_query._APPLICATION_ICONS_MAX_SIZE', 8):
+            load_application_icon_async(cache, 'first', None, Mock())
+            self.finish_load(0, b'first')
+            load_application_icon_async(cache, 'second', None, Mock())
+            self.finish_load(1, b'other')
+
+        callback = Mock(return_value=None)
+        load_application_icon_async(cache, 'second', None, callback)
+        run_until_called([callback])
+        self.assertEqual(len(self.loads), 2)
+
+        load_application_icon_async(cache, 'first', None, Mock())
+        self.assertEqual(len(self.loads), 3)
+
+    def test_icon_loaded_before_clear_is_not_used(self):
+        '''An icon which was loading when the cache was cleared is not reused.'''
+        cache = EosCompanionAppService.ManagedCache()
+        callback = Mock(return_value=None)
+
+        load_application_icon_async(cache, 'icon', None, Mock())
+        clear_python_subcaches(cache)
+        load_application_icon_async(cache, 'icon', None, callback)
+        self.finish_load(0, b'old icon')
+        self.finish_load(1, b'new icon')
+
+        load_application_icon_async(cache, 'icon', None, callback)
+        run_until_called([callback])
+
+        self.assertEqual(len(self.loads), 2)
+        self.assertEqual([call[0][1].image_bytes.get_data() for call in callback.call_args_list],
+                         [b'new icon', b'new icon'])
@@ -0,0 +1,235 @@
+# /test/test_ekn_content_adjuster.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Tests for the EKN content adjuster.'''
+
+# pylint: disable=wrong-import-order
+import gi
+
+gi.require_version('ContentFeed', '0')
+gi.require_version('Eknr', '0')
+gi.require_version('EosCompanionAppService', '1.0')
+gi.require_version('EosShard', '0')
+
+from unittest.mock import Mock, patch
+
+from gi.repository import EosCompanionAppService, GLib
+
+# pylint: disable=protected-access
+from eoscompanion import caching, ekn_content_adjuster
+from eoscompanion.caching import clear_python_subcaches
+from eoscompanion.ekn_content_adjuster import (
+    any_url_rewriter,
+    device_uuid_placeholder_query,
+    ekn_url_rewriter,
+    license_url_rewriter,
+    link_resolution_index_for_shards,
+    lookup_rendered_article,
+    rendered_articles_cache,
+    resource_url_rewriter,
+    served_articles_cache
+)
+from eoscompanion.ekn_data import IdentifiedShards
+
+from testtools import TestCase
+
+
+QUERY = {
+    'applicationId': 'org.test.ContentApp',
+    'deviceUUID': 'some device'
+}
+
+PAGE_WITH_URLS = '''<html>
+<a href="ekn:///a1b2c3">Article</a><a href="ekn://org.test/d4e5f6">Other</a>
+<img src="resource:///com/endlessm/image.png"/>
+<link href="file:///usr/share/style.css"/><a href="license://CC-BY-SA%204.0">License</a>
+<a href="https://example.com/not-rewritten">External</a>
+<img src="resource:///adjacent.png""ekn:///f00"/>
+</html>'''
+
+
+class TestRewriteUrls(TestCase):
+    '''Tests for rewriting the URLs embedded in a rendered article.'''
+
+    def test_single_pass_matches_one_pass_per_kind(self):
+        '''Rewriting all URLs at once is the same as rewriting each kind in turn.'''
+        expected = PAGE_WITH_URLS
+        for regex, rewriter in (
+                (ekn_content_adjuster._RE_EKN_URL_CAPTURE, ekn_url_rewriter),
+                (ekn_content_adjuster._RE_RESOURCE_URL_CAPTURE, resource_url_rewriter),
+                (ekn_content_adjuster._RE_LICENSE_URL_CAPTURE, license_url_rewriter)
+        ):
+            expected = regex.sub(rewriter('v1', QUERY), expected)
+
+        rewritten = ekn_content_adjuster._RE_ANY_URL_CAPTURE.sub(
+            any_url_rewriter('v1', QUERY),
+            PAGE_WITH_URLS
+        )
+
+        self.assertEqual(rewritten, expected)
+        self.assertNotIn('ekn://', rewritten)
+        self.assertNotIn('"resource://', rewritten)
+        self.assertNotIn('"file://', rewritten)
+        self.assertNotIn('"license://', rewritten)
+        self.assertIn('"https://example.com/not-rewritten"', rewritten)
+
+
+RENDERED_KEY = ('org.test.ContentApp', 'a1b2c3', ('shard-identity',), 'v1')
+
+
+def render_placeholder_article():
+    '''Render an article for any device, as the HTML adjuster would.'''
+    placeholder_query = device_uuid_placeholder_query(QUERY)
+    return '<a href="/v1/content_data?deviceUUID={}">Link</a>'.format(
+        placeholder_query['deviceUUID']
+    ).encode('utf-8')
+
+
+class TestServedArticles(TestCase):
+    '''Tests for the cache of articles served to each device.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Put a rendered article in a new cache.'''
+        super().setUp()
+        self.cache = EosCompanionAppService.ManagedCache()
+        self.now = GLib.get_monotonic_time()
+        self.patch_monotonic_time()
+
+    def patch_monotonic_time(self):
+        '''Make the caches use self.now as the current time.'''
+        patcher = patch.object(caching.GLib,
+                               'get_monotonic_time',
+                               side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def insert_rendered_article(self, rendered_key):
+        '''Insert a rendered article for :rendered_key: into the cache.'''
+        rendered_articles_cache(self.cache).insert(rendered_key,
+                                                   render_placeholder_article())
+
+    def test_served_article_is_reused(self):
+        '''Looking up an article again for a device uses what was served before.'''
+        self.insert_rendered_article(RENDERED_KEY)
+
+        first = lookup_rendered_article(self.cache, RENDERED_KEY, 'device')
+        second = lookup_rendered_article(self.cache, RENDERED_KEY, 'device')
+
+        self.assertIs(first, second)
+        self.assertEqual(served_articles_cache(self.cache).hits, 1)
+        self.assertEqual(rendered_articles_cache(self.cache).hits, 1)
+
+    def test_served_article_expires(self):
+        '''A served article is spliced again from the rendered article once it expires.'''
+        self.insert_rendered_article(RENDERED_KEY)
+
+        first = lookup_rendered_article(self.cache, RENDERED_KEY, 'device')
+        self.now += (ekn_content_adjuster._SERVED_ARTICLES_TTL + 1) * GLib.USEC_PER_SEC
+        second = lookup_rendered_article(self.cache, RENDERED_KEY, 'device')
+
+        self.assertIsNot(first, second)
+        self.assertEqual(first.get_data(), second.get_data())
+        self.assertEqual(served_articles_cache(self.cache).hits, 0)
+        self.assertEqual(rendered_articles_cache(self.cache).hits, 2)
+
+    def test_served_articles_are_evicted(self):
+        '''Served articles beyond the size budget are evicted, oldest first.'''
+        self.insert_rendered_article(RENDERED_KEY)
+
+        # The deviceUUIDs are shorter than the placeholder, so there is
+        # room for one served article, but not for two
+        with patch.object(ekn_content_adjuster,
+                          '_SERVED_ARTICLES_MAX_SIZE',
+                          len(render_placeholder_article())):
+            lookup_rendered_article(self.cache, RENDERED_KEY, 'first')
+            lookup_rendered_article(self.cache, RENDERED_KEY, 'second')
+
+        served = served_articles_cache(self.cache)
+        self.assertEqual(len(served), 1)
+        self.assertIsNone(served.lookup((RENDERED_KEY, 'first')))
+        self.assertIsNotNone(served.lookup((RENDERED_KEY, 'second')))
+
+
+def link_table_shard(links):
+    '''Create a fake shard with a link table mapping :links:.'''
+    link_table_record = Mock()
+    link_table_record.data.load_as_dictionary.return_value.lookup_key = links.get
+    shard = Mock()
+    shard.find_record_by_hex_name.return_value = link_table_record
+    return shard
+
+
+class TestLinkResolutionIndex(TestCase):
+    '''Tests for re-using link resolution indices.'''
+
+    # pylint: disable=invalid-name
+    def setUp(self):
+        '''Create a cache and some shards with a link table.'''
+        super().setUp()
+        self.cache = EosCompanionAppService.ManagedCache()
+        self.shard = link_table_shard({
+            'https://example.com/article': 'ekn:///a1b2c3'
+        })
+
+    def test_index_is_reused_for_the_same_shards(self):
+        '''The link tables are only loaded once for the same shards.'''
+        first = link_resolution_index_for_shards(
+            IdentifiedShards([self.shard], ('shard-identity',)),
+            self.cache
+        )
+        second = link_resolution_index_for_shards(
+            IdentifiedShards([self.shard], ('shard-identity',)),
+            self.cache
+        )
+
+        self.assertIs(first, second)
+        self.assertEqual(second.resolve('https://example.com/article'),
+                         'ekn:///a1b2c3')
+        self.assertIsNone(second.resolve('https://example.com/missing'))
+        self.assertEqual(self.shard.find_record_by_hex_name.call_count, 1)
+
+    def test_changed_shards_get_a_new_index(self):
+        '''Shards which have changed on disk get their own index.'''
+        first = link_resolution_index_for_shards(
+            IdentifiedShards([self.shard], ('shard-identity',)),
+            self.cache
+        )
+        second = link_resolution_index_for_shards(
+            IdentifiedShards([self.shard], ('changed-shard-identity',)),
+            self.cache
+        )
+
+        self.assertIsNot(first, second)
+        self.assertEqual(self.shard.find_record_by_hex_name.call_count, 2)
+
+    def test_index_is_dropped_when_cache_is_cleared(self):
+        '''A new index is created once the cache has been cleared.'''
+        shards = IdentifiedShards([self.shard], ('shard-identity',))
+        first = link_resolution_index_for_shards(shards, self.cache)
+        clear_python_subcaches(self.cache)
+        second = link_resolution_index_for_shards(shards, self.cache)
+
+        self.assertIsNot(first, second)
+
+    def test_unidentified_shards_are_not_reused(self):
+        '''Shards whose files cannot be identified always get a new index.'''
+        shards = IdentifiedShards([self.shard], None)
+
+        self.assertIsNot(link_resolution_index_for_shards(shards, self.cache),
+                         link_resolution_index_for_shards(shards, self.cache))
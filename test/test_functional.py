@@ -0,0 +1,145 @@
+# /test/test_functional.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Tests for the functional programming helpers.'''
+
+from unittest.mock import Mock
+
+from gi.repository import Gio, GLib
+
+from eoscompanion.functional import (
+    propagate_cancellation,
+    single_flight_closure
+)
+
+from testtools import TestCase
+
+
+class TestSingleFlightClosure(TestCase):
+    '''Tests for single_flight_closure.'''
+
+    def test_concurrent_calls_are_coalesced(self):
+        '''Calls for a key which is in flight share the same result.'''
+        call = single_flight_closure()
+        in_flight = []
+        func = Mock(side_effect=in_flight.append)
+        first_callback = Mock()
+        second_callback = Mock()
+
+        call('key', func, first_callback)
+        call('key', func, second_callback)
+
+        self.assertEqual(func.call_count, 1)
+        first_callback.assert_not_called()
+
+        in_flight[0](None, 'result')
+
+        first_callback.assert_called_once_with(None, 'result')
+        second_callback.assert_called_once_with(None, 'result')
+
+    def test_calls_for_other_keys_are_not_coalesced(self):
+        '''Calls for different keys each call the function.'''
+        call = single_flight_closure()
+        func = Mock()
+
+        call('first', func, Mock())
+        call('second', func, Mock())
+
+        self.assertEqual(func.call_count, 2)
+
+    def test_finished_calls_are_not_coalesced(self):
+        '''A call after the previous one finished calls the function again.'''
+        call = single_flight_closure()
+        func = Mock(side_effect=lambda callback: callback(None, 'result'))
+
+        call('key', func, Mock())
+        call('key', func, Mock())
+
+        self.assertEqual(func.call_count, 2)
+
+    def test_raising_function_forgets_key(self):
+        '''A function which raises does not block later calls for its key.'''
+        call = single_flight_closure()
+        callback = Mock()
+
+        self.assertRaises(RuntimeError,
+                          call,
+                          'key',
+                          Mock(side_effect=RuntimeError('failed')),
+                          callback)
+        callback.assert_not_called()
+
+        call('key', lambda done: done(None, 'result'), callback)
+        callback.assert_called_once_with(None, 'result')
+
+    def test_raising_function_passes_error_to_queued_callbacks(self):
+        '''Callbacks queued before the function raised get the error.'''
+        call = single_flight_closure()
+        queued_callback = Mock()
+
+        def _func(_):
+            '''Queue another call for the same key, then fail.'''
+            call('key', Mock(), queued_callback)
+            raise RuntimeError('failed')
+
+        self.assertRaises(RuntimeError, call, 'key', _func, Mock())
+
+        error, result = queued_callback.call_args[0]
+        self.assertTrue(error.matches(Gio.io_error_quark(), Gio.IOErrorEnum.FAILED))
+        self.assertIsNone(result)
+
+
+class TestPropagateCancellation(TestCase):
+    '''Tests for propagate_cancellation.'''
+
+    def test_passes_result_if_not_cancelled(self):
+        '''The result is passed on if the cancellable was not cancelled.'''
+        callback = Mock()
+
+        propagate_cancellation(Gio.Cancellable(), callback)(None, 'result')
+
+        callback.assert_called_once_with(None, 'result')
+
+    def test_passes_result_without_cancellable(self):
+        '''The result is passed on if there is no cancellable.'''
+        callback = Mock()
+
+        propagate_cancellation(None, callback)(None, 'result')
+
+        callback.assert_called_once_with(None, 'result')
+
+    def test_passes_cancelled_error_if_cancelled(self):
+        '''A cancelled error is passed on instead of the result.'''
+        callback = Mock()
+        cancellable = Gio.Cancellable()
+        cancellable.cancel()
+
+        propagate_cancellation(cancellable, callback)(None, 'result')
+
+        error, result = callback.call_args[0]
+        self.assertTrue(error.matches(Gio.io_error_quark(), Gio.IOErrorEnum.CANCELLED))
+        self.assertIsNone(result)
+
+    def test_passes_error_if_not_cancelled(self):
+        '''An error from the operation is passed on as is.'''
+        callback = Mock()
+        error = GLib.Error('failed', Gio.io_error_quark(), Gio.IOErrorEnum.FAILED)
+
+        propagate_cancellation(Gio.Cancellable(), callback)(error, None)
+
+        callback.assert_called_once_with(error, None)
@@ -0,0 +1,157 @@
+# /test/test_mustache.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Tests for the mustache template compiler.'''
+
+# pylint: disable=wrong-import-order
+import gi
+
+gi.require_version('Eknr', '0')
+gi.require_version('EosCompanionAppService', '1.0')
+
+import os
+
+from gi.repository import Eknr, EosCompanionAppService, Gio, GLib
+
+from eoscompanion.mustache import compile_mustache_template
+
+from testtools import TestCase
+
+
+TOPLEVEL_DIRECTORY = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+MOBILE_WRAPPER_TEMPLATE = os.path.join(TOPLEVEL_DIRECTORY,
+                                       'data',
+                                       'templates',
+                                       'mobile-article-wrapper.mst')
+
+
+def render(template, variables):
+    '''Compile :template: and render it with :variables:.'''
+    return compile_mustache_template(template)(variables)
+
+
+class TestMustache(TestCase):
+    '''Tests for the mustache template compiler.'''
+
+    def test_variable_is_escaped(self):
+        '''A double mustache variable has its HTML escaped.'''
+        self.assertEqual(render('<p>{{text}}</p>', {'text': '<b>"Tom" & Jerry</b>'}),
+                         '<p>&lt;b&gt;&quot;Tom&quot; &amp; Jerry&lt;/b&gt;</p>')
+
+    def test_triple_mustache_is_not_escaped(self):
+        '''A triple mustache variable is inserted as is.'''
+        self.assertEqual(render('<p>{{{text}}}</p>', {'text': '<b>Tom & Jerry</b>'}),
+                         '<p><b>Tom & Jerry</b></p>')
+
+    def test_missing_variable_is_empty(self):
+        '''A variable that was not provided renders as nothing.'''
+        self.assertEqual(render('[{{missing}}]', {}), '[]')
+
+    def test_list_section_renders_each_item(self):
+        '''A section over a list renders once for each item.'''
+        self.assertEqual(render('{{#items}}<{{.}}>{{/items}}', {
+            'items': ['a', 'b&c']
+        }), '<a><b&amp;c>')
+
+    def test_empty_list_section_renders_nothing(self):
+        '''A section over an empty list renders nothing.'''
+        self.assertEqual(render('[{{#items}}<{{.}}>{{/items}}]', {'items': []}),
+                         '[]')
+
+    def test_list_section_items_can_be_mappings(self):
+        '''Names inside a section are looked up on the item first.'''
+        self.assertEqual(render('{{#items}}{{name}}:{{title}};{{/items}}', {
+            'items': [{'name': 'a'}, {'name': 'b'}],
+            'title': 'outer'
+        }), 'a:outer;b:outer;')
+
+    def test_true_section_renders_once(self):
+        '''A section over a true value renders once.'''
+        self.assertEqual(render('[{{#flag}}yes{{/flag}}]', {'flag': True}),
+                         '[yes]')
+
+    def test_false_section_renders_nothing(self):
+        '''A section over a false value renders nothing.'''
+        self.assertEqual(render('[{{#flag}}yes{{/flag}}]', {'flag': False}),
+                         '[]')
+
+    def test_inverted_section(self):
+        '''An inverted section only renders for false or empty values.'''
+        template = '[{{^items}}none{{/items}}]'
+        self.assertEqual(render(template, {'items': []}), '[none]')
+        self.assertEqual(render(template, {'items': False}), '[none]')
+        self.assertEqual(render(template, {'items': ['a']}), '[]')
+
+    def test_standalone_section_tags_are_removed(self):
+        '''Section tags alone on their line do not leave blank lines.'''
+        self.assertEqual(render('<ul>\n'
+                                '  {{#items}}\n'
+                                '  <li>{{.}}</li>\n'
+                                '  {{/items}}\n'
+                                '</ul>\n', {'items': ['a', 'b']}),
+                         '<ul>\n'
+                         '  <li>a</li>\n'
+                         '  <li>b</li>\n'
+                         '</ul>\n')
+
+    def test_unclosed_section_is_an_error(self):
+        '''A section which is not closed raises a service error.'''
+        error = self.assertRaises(GLib.Error, compile_mustache_template, '{{#items}}')
+        self.assertTrue(error.matches(EosCompanionAppService.error_quark(),
+                                      EosCompanionAppService.Error.FAILED))
+
+    def test_unexpected_end_of_section_is_an_error(self):
+        '''Closing a section which is not open raises a service error.'''
+        error = self.assertRaises(GLib.Error,
+                                  compile_mustache_template,
+                                  '{{#items}}{{/other}}')
+        self.assertTrue(error.matches(EosCompanionAppService.error_quark(),
+                                      EosCompanionAppService.Error.FAILED))
+
+    def test_mobile_wrapper_matches_eknr_renderer(self):
+        '''The article wrapper renders the same as with Eknr.Renderer.'''
+        variables = {
+            'css-files': ['clipboard.css', 'share-actions.css'],
+            'custom-css-files': [],
+            'javascript-files': [
+                'jquery-min.js',
+                'collapse-infotable.js',
+                'crosslink.js'
+            ],
+            'content': '<p>Some <em>content</em> & more</p>',
+            'crosslink-data': '["ekn:///a", "ekn:///b"]',
+            'content-metadata': '{"title": "Title & <Subtitle>"}',
+            'title': 'Title & <Subtitle>'
+        }
+        expected = Eknr.Renderer().render_mustache_document_from_file(
+            Gio.File.new_for_path(MOBILE_WRAPPER_TEMPLATE),
+            GLib.Variant('a{sv}', {
+                'css-files': GLib.Variant('as', variables['css-files']),
+                'custom-css-files': GLib.Variant('as', variables['custom-css-files']),
+                'javascript-files': GLib.Variant('as', variables['javascript-files']),
+                'content': GLib.Variant('s', variables['content']),
+                'crosslink-data': GLib.Variant('s', variables['crosslink-data']),
+                'content-metadata': GLib.Variant('s', variables['content-metadata']),
+                'title': GLib.Variant('s', variables['title'])
+            })
+        )
+
+        with open(MOBILE_WRAPPER_TEMPLATE, encoding='utf-8') as template_file:
+            template = template_file.read()
+
+        self.assertEqual(render(template, variables), expected)
@@ -0,0 +1,88 @@
+# /test/test_v1_routes.py
+#
+# Copyright (C) 2018 Endless Mobile, Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+'''Tests for the helpers used by the /v1 routes.'''
+
+# pylint: disable=wrong-import-order
+import gi
+
+gi.require_version('ContentFeed', '0')
+gi.require_version('Eknr', '0')
+gi.require_version('Endless', '0')
+gi.require_version('EosCompanionAppService', '1.0')
+gi.require_version('EosMetrics', '0')
+gi.require_version('EosShard', '0')
+
+import itertools
+
+from eoscompanion.v1_routes import (
+    merge_search_models_by_display_name,
+    SearchModel
+)
+
+from testtools import TestCase
+
+
+def search_model(app_id, display_name):
+    '''Create a SearchModel for :display_name: in :app_id:.'''
+    return SearchModel(app_id=app_id,
+                       display_name=display_name,
+                       model=None,
+                       model_type='content',
+                       model_payload_renderer=None)
+
+
+class TestMergeSearchModelsByDisplayName(TestCase):
+    '''Tests for merge_search_models_by_display_name.'''
+
+    def test_merge_matches_sorting_all_entries(self):
+        '''Merging the runs gives the same order as sorting all the entries together.'''
+        runs = [
+            [
+                search_model('org.test.First', 'Banana'),
+                search_model('org.test.First', 'Apple'),
+                search_model('org.test.First', 'Cherry')
+            ],
+            [
+                search_model('org.test.Second', 'Cherry'),
+                search_model('org.test.Second', 'Apple')
+            ],
+            [
+                search_model('org.test.Third', 'Apple'),
+                search_model('org.test.Third', 'Date')
+            ]
+        ]
+
+        merged = list(merge_search_models_by_display_name(runs))
+
+        self.assertEqual(merged,
+                         sorted(itertools.chain.from_iterable(runs),
+                                key=lambda m: m.display_name))
+
+    def test_equal_display_names_keep_order_of_runs(self):
+        '''Entries with the same display name stay in the order of the runs.'''
+        runs = [
+            [search_model('org.test.First', 'Apple')],
+            [search_model('org.test.Second', 'Apple')],
+            [search_model('org.test.Third', 'Apple')]
+        ]
+
+        merged = merge_search_models_by_display_name(runs)
+
+        self.assertEqual([m.app_id for m in merged],
+                         ['org.test.First', 'org.test.Second', 'org.test.Third'])
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# Measure the throughput of EosCompanionAppService.load_all_in_stream_to_bytes
+# for a few stream sizes and chunk size policies.
+#
+#     Usage: benchmark_load_all_in_stream_to_bytes.py [--iterations N]
+#                                                     [--sizes SIZE ...]
+#
+# The "doubling" policy passes a first chunk size of 256 bytes, which
+# the helper doubles on each read, as happens when the service does not
+# know the size of the stream. The "sized" policy passes the size of
+# the stream plus one byte, which is what the service does when the
+# size is known.
+#
+# Both policies run through the chunk size handling of the library this
+# script is run against, so neither measures the fixed 256 byte reads
+# that older versions of the helper library did. To measure those, run
+# this script against an older build as well, with LD_LIBRARY_PATH and
+# GI_TYPELIB_PATH pointing at its build directory, and compare the
+# "doubling" results.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+# All rights reserved.
+
+import argparse
+import os
+import tempfile
+import time
+
+import gi
+
+gi.require_version('EosCompanionAppService', '1.0')
+
+from gi.repository import EosCompanionAppService, Gio, GLib
+
+
+_CHUNK_SIZE_POLICIES = {
+    'doubling': lambda size: 256,
+    'sized': lambda size: size + 1
+}
+
+
+def load_stream_synchronously(stream, chunk_size):
+    '''Run load_all_in_stream_to_bytes on a main loop and return the bytes.'''
+    loop = GLib.MainLoop()
+    result_holder = {}
+
+    def _callback(_, result):
+        '''Finish loading and quit the loop.'''
+        result_holder['bytes'] = EosCompanionAppService.finish_load_all_in_stream_to_bytes(result)
+        loop.quit()
+
+    EosCompanionAppService.load_all_in_stream_to_bytes(stream,
+                                                       chunk_size=chunk_size,
+                                                       cancellable=None,
+                                                       callback=_callback)
+    loop.run()
+    return result_holder['bytes']
+
+
+def benchmark(path, size, policy, iterations):
+    '''Return the throughput in MiB/s of loading the file at path.'''
+    chunk_size = _CHUNK_SIZE_POLICIES[policy](size)
+    start = time.perf_counter()
+
+    for _ in range(iterations):
+        stream = Gio.File.new_for_path(path).read(None)
+        loaded = load_stream_synchronously(stream, chunk_size)
+        assert loaded.get_size() == size
+
+    elapsed = time.perf_counter() - start
+    return (size * iterations) / elapsed / (1024 * 1024)
+
+
+def main():
+    '''Entry point.'''
+    parser = argparse.ArgumentParser('Benchmark load_all_in_stream_to_bytes')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024])
+    arguments = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in arguments.sizes:
+            path = os.path.join(directory, str(size))
+
+            with open(path, 'wb') as fileobj:
+                fileobj.write(os.urandom(size))
+
+            for policy in sorted(_CHUNK_SIZE_POLICIES.keys()):
+                print('{size:>10} bytes {policy:>8}: {throughput:10.2f} MiB/s'.format(
+                    size=size,
+                    policy=policy,
+                    throughput=benchmark(path, size, policy, arguments.iterations)
+                ))
+
+
+if __name__ == '__main__':
+    main()